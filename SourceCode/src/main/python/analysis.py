@@ -0,0 +1,2291 @@
+"""
+Image analysis core for MyelTracer.
+
+Everything in here is pure OpenCV/NumPy, so it can be imported without PyQt5
+or a display, e.g. in notebooks, worker processes or benchmarks. The GUI in
+main.py is a client of this module.
+"""
+import ast
+import heapq
+import json
+import os
+import re
+import struct
+import threading
+import uuid
+import weakref
+import zlib
+from enum import Enum
+from math import sqrt, pi, floor
+
+import numpy as np
+import cv2 as cv
+
+# Versions of the software whose session files can be opened
+COMPATIBLE_VERSIONS = [
+    '0.1',
+    '0.2',
+    '0.3',
+    '0.4',
+    '0.5',
+    '0.6',
+    '0.7',
+    '1.0',
+    '1.1',
+    '1.2',
+    '1.3',
+    '1.3.1',
+    '1.4.0'
+]
+
+# Version of the binary session container, see write_session
+SESSION_FORMAT = 1
+# Version of the edit journals written next to backups, see EditJournal
+JOURNAL_FORMAT = 1
+
+NUM_FEATURES = 3 # number of features in a complete axon (outer, inner, axon)
+
+# Names of the selection groups, as stored in session files
+AXON = 'axon'
+INNER_MYELIN = 'inner myelin'
+OUTER_MYELIN = 'outer myelin'
+MISC = 'misc'
+SELECTION_GROUPS = (AXON, INNER_MYELIN, OUTER_MYELIN, MISC)
+
+# Names of the selection groups before version 1.0
+LEGACY_GROUPS = {
+    'Axon': AXON,
+    'Myelin_In': INNER_MYELIN,
+    'Myelin_Out': OUTER_MYELIN
+}
+
+class Colors(Enum):
+    """These are colors for use within the software"""
+    WHITE = (255, 255, 255)
+    BLACK = (0, 0, 0)
+    RED = (0, 0, 255)
+    GREEN = (0, 255, 0)
+    BLUE = (255, 0, 0)
+    YELLOW = (0, 255, 255)
+    PINK = (228, 20, 255)
+    PURPLE = (255, 20, 232)
+    LIME = (5, 247, 150)
+    RED_HIGHLIGHT = (135, 135, 255)
+    GREEN_HIGHLIGHT = (138, 255, 175)
+    CYAN_HIGHLIGHT = (241, 245, 132)
+    ORANGE_HIGHLIGHT = (0, 153, 255)
+    YELLOW_HIGHLIGHT = (128, 251, 255)
+
+class Pairing:
+    """The result of pairing up selections into axon units"""
+    def __init__(self):
+        self.pairs = [] # (outer, inner, axon) tuples, sorted by area
+        self.pairless = [] # contours that are not part of a complete unit
+        self.pairless_grouped = { # the same contours, by selection group
+            AXON: [],
+            INNER_MYELIN: [],
+            OUTER_MYELIN: []
+        }
+
+    def flat_pairs(self):
+        """Returns the complete units as a flat list, NUM_FEATURES per unit"""
+        return [c for unit in self.pairs for c in unit]
+
+def empty_selections():
+    """Returns an empty dictionary of saved contours for every group"""
+    return {group: [] for group in SELECTION_GROUPS}
+
+def normalize_selections(saved_contours):
+    """
+    Renames selection groups from old session files and adds any groups
+    they are missing, in place
+    """
+    for old_name, new_name in LEGACY_GROUPS.items():
+        if old_name in saved_contours:
+            saved_contours[new_name] = saved_contours.pop(old_name)
+    for group in SELECTION_GROUPS:
+        saved_contours.setdefault(group, [])
+    return saved_contours
+
+def load_image(filename):
+    """Loads the image at filename (str) as a BGR array"""
+    return cv.imdecode(np.fromfile(filename, dtype=np.uint8), cv.IMREAD_COLOR)
+
+def adjust_image(image, quality):
+    """Resizes image (np.array) to the percent indicated by quality (float)"""
+    return cv.resize(image, None, fx=quality, fy=quality,
+                     interpolation=cv.INTER_AREA)
+
+def grayscale_image(image):
+    """Converts image (np.array) from BGR to grayscale"""
+    return cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+
+def blur_image(imgray, blur):
+    """Applies a bilateral filter of size blur (int, 0 for none) to imgray"""
+    if blur == 0:
+        return imgray
+    return cv.bilateralFilter(imgray, 1+blur, 75, 75)
+
+def binarize_image(blurred_image, threshold):
+    """Thresholds blurred_image at threshold (int, 0-255) to a binary image"""
+    _, thresholded = cv.threshold(blurred_image, threshold, 255,
+                                  cv.THRESH_TRUNC)
+    _, thresholded = cv.threshold(thresholded, threshold*15/16, 255,
+                                  cv.THRESH_BINARY)
+    return thresholded
+
+def threshold_level(threshold):
+    """
+    Returns the gray level binarize_image cuts at for threshold (int): the
+    binary image is exactly the pixels brighter than this level
+    """
+    if threshold <= 0:
+        return 255 # everything is truncated to 0, nothing is white
+    return (15 * threshold) // 16
+
+def threshold_image(image, blur, threshold):
+    """
+    Converts image to the binary image contours are extracted from
+
+    Arguments:
+        image (np.array): the BGR image
+        blur (int): the bilateral filter size, 0 for none
+        threshold (int): the boundary threshold, 0-255
+
+    Returns:
+        thresholded (np.array): the binary image
+    """
+    # 1. Convert to grayscale
+    imgray = grayscale_image(image)
+
+    # 2. Apply blur kernel
+    blurred_image = blur_image(imgray, blur)
+
+    # 3. Apply thresholding filter
+    return binarize_image(blurred_image, threshold)
+
+def extract_contours(binary):
+    """Returns all contours of binary (np.array), as cv.findContours"""
+    contour_data = cv.findContours(binary, cv.RETR_TREE,
+                                   cv.CHAIN_APPROX_SIMPLE)
+    if len(contour_data) == 2:
+        return contour_data[0]
+    return contour_data[1]
+
+def draw_lines(binary, lines):
+    """Draws the cut and draw lines (Strokes or list) on binary"""
+    if not isinstance(lines, Strokes):
+        lines = Strokes(lines)
+    for thickness, color, points in lines:
+        cv.polylines(binary, [points], False, color, thickness)
+
+class ThresholdSweep:
+    """
+    The candidate contours of one blurred image across the threshold range.
+
+    The binary image at a threshold is the set of pixels brighter than
+    threshold_level(threshold), so these sets are nested as the threshold
+    moves and 256 thresholds collapse into 241 levels. Each level is
+    segmented once, the first time it is needed, and kept with the area of
+    every contour. After that, moving the threshold back to that level, or
+    changing the size limits, is a lookup and a vectorized size filter
+    instead of a threshold and findContours over the whole image.
+
+    Levels are evicted least recently used once max_bytes is exceeded.
+    """
+    def __init__(self, blurred_image, lines, max_bytes=256 * 2**20):
+        """
+        Arguments:
+            blurred_image (np.array): the blurred grayscale image
+            lines (list): the cut and draw lines drawn on every level
+            max_bytes (int): memory budget for the stored contours
+        """
+        self.blurred_image = blurred_image
+        self.lines = lines
+        self.max_bytes = max_bytes
+        self.levels = {} # level -> (contours, areas, bytes), in LRU order
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+
+    def has_level(self, level):
+        """Returns True if level (int) is already segmented"""
+        with self._lock:
+            return level in self.levels
+
+    def get_level(self, level, cancelled=None):
+        """
+        Returns the contours at level (int) with 5 or more points and their
+        areas as (contours, areas), or None if cancelled
+        """
+        with self._lock:
+            if level in self.levels:
+                entry = self.levels.pop(level)
+                self.levels[level] = entry # most recently used
+                return entry[0], entry[1]
+
+        binary = np.where(self.blurred_image > level, 255, 0).astype(np.uint8)
+        draw_lines(binary, self.lines)
+        if cancelled is not None and cancelled():
+            return None
+        contours = [c for c in extract_contours(binary) if len(c) >= 5]
+        if cancelled is not None and cancelled():
+            return None
+        areas = np.array([cv.contourArea(c) for c in contours],
+                         dtype=np.float64)
+        num_bytes = areas.nbytes + sum(c.nbytes for c in contours)
+
+        with self._lock:
+            if level not in self.levels:
+                self.levels[level] = (contours, areas, num_bytes)
+                self.total_bytes += num_bytes
+                while (self.total_bytes > self.max_bytes and
+                       len(self.levels) > 1):
+                    oldest = next(iter(self.levels))
+                    self.total_bytes -= self.levels.pop(oldest)[2]
+        return contours, areas
+
+    def segment(self, threshold, min_size, max_size, cancelled=None):
+        """Returns the contours at threshold within the size limits"""
+        level = self.get_level(threshold_level(threshold), cancelled)
+        if level is None:
+            return None
+        contours, areas = level
+        keep = np.flatnonzero((areas >= min_size) & (areas <= max_size))
+        return [contours[i] for i in keep]
+
+class PreprocessCache:
+    """
+    Keeps the grayscale, blurred and thresholded versions of an image, so
+    each stage is only recomputed when its own parameters change. Dragging
+    the threshold only redoes the threshold, not the bilateral filter.
+
+    The cache can be shared between threads. The returned images are shared
+    as well, copy them before drawing on them.
+    """
+    def __init__(self, image):
+        """
+        Arguments:
+            image (np.array): the BGR image, already scaled to the quality
+        """
+        self.image = image
+        self._lock = threading.RLock()
+        self._grayscale = None
+        self._blurred = (None, None) # (blur, image)
+        self._thresholded = (None, None) # ((blur, threshold), image)
+        self._sweep = (None, None) # ((blur, lines), ThresholdSweep)
+
+    def grayscale(self):
+        """Returns the grayscale image"""
+        with self._lock:
+            if self._grayscale is None:
+                self._grayscale = grayscale_image(self.image)
+            return self._grayscale
+
+    def blurred(self, blur):
+        """Returns the grayscale image blurred by blur (int)"""
+        with self._lock:
+            if self._blurred[0] != blur:
+                self._blurred = (blur, blur_image(self.grayscale(), blur))
+            return self._blurred[1]
+
+    def thresholded(self, blur, threshold):
+        """Returns the binary image for blur (int) and threshold (int)"""
+        key = (blur, threshold)
+        with self._lock:
+            if self._thresholded[0] != key:
+                self._thresholded = (key, binarize_image(self.blurred(blur),
+                                                         threshold))
+            return self._thresholded[1]
+
+    def sweep(self, blur, lines):
+        """Returns the ThresholdSweep for blur (int) and lines (Strokes)"""
+        key = (blur, lines_key(lines))
+        with self._lock:
+            if self._sweep[0] != key:
+                lines = Strokes(lines) # a snapshot, lines keep changing
+                self._sweep = (key, ThresholdSweep(self.blurred(blur), lines))
+            return self._sweep[1]
+
+def lines_key(lines):
+    """Returns a hashable snapshot of lines (Strokes or list)"""
+    if not isinstance(lines, Strokes):
+        lines = Strokes(lines)
+    return lines.key()
+
+def segment(image, params, cache=None, cancelled=None):
+    """
+    Extracts the candidate contours from an image
+
+    Arguments:
+        image (np.array): the BGR image, already scaled to the import quality
+        params (dict): 'threshold', 'blur', 'min_size' and 'max_size', and
+                       optionally 'lines', the cut and draw lines as
+                       Strokes or [thickness, color, points], and 'sweep', to keep the
+                       contours of every threshold level (see
+                       ThresholdSweep, needs cache)
+        cache (PreprocessCache): reuses the preprocessing of image if given
+        cancelled (function): checked between steps, returning True stops
+                              the segmentation early
+
+    Returns:
+        contours (list): the contours within the size limits, or None if
+                         cancelled
+    """
+    lines = params.get('lines', [])
+    if cache is not None and params.get('sweep'):
+        sweep = cache.sweep(params['blur'], lines)
+        return sweep.segment(params['threshold'], params['min_size'],
+                             params['max_size'], cancelled)
+
+    if cache is None:
+        thresholded = threshold_image(image, params['blur'],
+                                      params['threshold'])
+    else:
+        thresholded = cache.thresholded(params['blur'], params['threshold'])
+        if lines: # don't draw into the cached image
+            thresholded = thresholded.copy()
+
+    if cancelled is not None and cancelled():
+        return None
+
+    # 4. Draw cut and draw lines on the image
+    draw_lines(thresholded, lines)
+
+    # 5. Extract contours from the image
+    contours = extract_contours(thresholded)
+
+    if cancelled is not None and cancelled():
+        return None
+
+    # 6. Filter out contours based on min and max size
+    return [c for c in contours
+        if (len(c) >= 5 and
+            params['min_size'] <= cv.contourArea(c) <= params['max_size'])]
+
+class LabelMap:
+    """
+    Answers which contour contains a point with a single array read.
+
+    Every pixel holds the index of the smallest contour strictly containing
+    it (cv.pointPolygonTest > 0), or -1. Contours are painted from largest
+    to smallest so the smallest wins, and each one is painted without its
+    own outline, as points on the outline aren't inside it.
+    """
+    def __init__(self, contours, shape):
+        """
+        Arguments:
+            contours (list): the contours to look up
+            shape (tuple): the shape of the image the contours are in
+        """
+        self.contours = contours
+        self.labels = np.full(shape[:2], -1, dtype=np.int32)
+        areas = [cv.contourArea(c) for c in contours]
+        # ties go to the first contour, like min(contours, key=cv.contourArea)
+        order = sorted(range(len(contours)), key=lambda i: (-areas[i], -i))
+        for i in order:
+            x, y, w, h = cv.boundingRect(contours[i])
+            mask = np.zeros((h, w), dtype=np.uint8)
+            cv.drawContours(mask, contours, i, 1, cv.FILLED, offset=(-x, -y))
+            cv.drawContours(mask, contours, i, 0, 1, offset=(-x, -y))
+            self.labels[y:y+h, x:x+w][mask.view(bool)] = i
+
+    def index_at(self, point):
+        """Returns the index of the smallest contour around point, or -1"""
+        x, y = point
+        height, width = self.labels.shape
+        if 0 <= x < width and 0 <= y < height:
+            return int(self.labels[y, x])
+        return -1
+
+    def contour_at(self, point):
+        """Returns the smallest contour around point (x, y), or None"""
+        index = self.index_at(point)
+        return self.contours[index] if index >= 0 else None
+
+class ContourRecord:
+    """
+    The measurements of a contour, computed once when the record is made.
+    Get records with contour_record, so each contour has only one.
+    """
+    __slots__ = ('moments', 'area', 'perimeter', 'bounds', 'columns')
+
+    def __init__(self, contour):
+        """
+        Arguments:
+            contour (np.array): the contour to measure
+        """
+        self.moments = cv.moments(contour)
+        self.area = cv.contourArea(contour)
+        self.perimeter = cv.arcLength(contour, True)
+        x, y, w, h = cv.boundingRect(contour)
+        self.bounds = (x, y, x + w - 1, y + h - 1) # inclusive
+        # the measurements as a row of ContourTable
+        self.columns = (self.area, self.perimeter, self.moments['m00'],
+                        self.moments['m10'], self.moments['m01'])
+
+    @property
+    def centroid(self):
+        """The integer centroid (x, y)"""
+        M = self.moments
+        return (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))
+
+_contour_records = {} # id of a contour -> its ContourRecord, while it lives
+
+def contour_record(contour):
+    """
+    Returns the ContourRecord of contour (np.array), made the first time it
+    is asked for. Contours are never changed in place, so the record stays
+    valid until the contour is garbage collected, which drops it too.
+    """
+    key = id(contour)
+    record = _contour_records.get(key)
+    if record is None:
+        record = ContourRecord(contour)
+        _contour_records[key] = record
+        weakref.finalize(contour, _contour_records.pop, key, None)
+    return record
+
+def contour_area(contour):
+    """Returns the area of contour, from its record"""
+    return contour_record(contour).area
+
+class GridIndex:
+    """
+    A uniform grid over the bounding boxes of items, for finding the items
+    near a point or box without testing all of them.
+
+    Items are tracked by identity, so contours are indexed as they are
+    stored and may be inserted more than once. Queries return items in the
+    order they were added, which is their order in the list they came from
+    as long as that list is only appended to, removed from, or handed to
+    sync.
+    """
+    def __init__(self, bounds, items=(), cell_size=64):
+        """
+        Arguments:
+            bounds (function): returns the (x0, y0, x1, y1) box of an item,
+                               inclusive, or None if it has no extent yet
+            items (list): the items to start with
+            cell_size (int): the side of a grid cell in pixels
+        """
+        self.bounds = bounds
+        self.cell_size = cell_size
+        self.cells = {} # (column, row) -> {id: item}
+        self.entries = {} # id -> [item, box, count, order]
+        self.unbounded = {} # id -> item, returned by every query
+        self.next_order = 0
+        self.sync(items)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _cells(self, box):
+        """Yields the grid cells box (x0, y0, x1, y1) overlaps"""
+        x0, y0, x1, y1 = box
+        size = self.cell_size
+        for column in range(floor(x0) // size, floor(x1) // size + 1):
+            for row in range(floor(y0) // size, floor(y1) // size + 1):
+                yield column, row
+
+    def insert(self, item):
+        """Adds item to the index"""
+        key = id(item)
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry[2] += 1
+            return
+        box = self.bounds(item)
+        self.entries[key] = [item, box, 1, self.next_order]
+        self.next_order += 1
+        if box is None:
+            self.unbounded[key] = item
+        else:
+            for cell in self._cells(box):
+                self.cells.setdefault(cell, {})[key] = item
+
+    def remove(self, item, all_copies=False):
+        """Removes item, or every copy of it if all_copies, from the index"""
+        key = id(item)
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        entry[2] -= 1
+        if entry[2] > 0 and not all_copies:
+            return
+        del self.entries[key]
+        if entry[1] is None:
+            del self.unbounded[key]
+        else:
+            for cell in self._cells(entry[1]):
+                bucket = self.cells[cell]
+                del bucket[key]
+                if not bucket:
+                    del self.cells[cell]
+
+    def update(self, item):
+        """Recomputes the box of item after it was changed in place"""
+        entry = self.entries.get(id(item))
+        if entry is None:
+            self.insert(item)
+            return
+        count, order = entry[2], entry[3]
+        self.remove(item, all_copies=True)
+        self.insert(item)
+        self.entries[id(item)][2:] = [count, order]
+
+    def sync(self, items):
+        """
+        Makes the index hold exactly items (list), in their order. Only the
+        boxes of items that weren't indexed yet are computed.
+        """
+        counts = {}
+        for item in items:
+            key = id(item)
+            if key in counts:
+                counts[key][1] += 1
+            else:
+                counts[key] = [item, 1]
+        for key in [key for key in self.entries if key not in counts]:
+            self.remove(self.entries[key][0], all_copies=True)
+        for order, (key, (item, count)) in enumerate(counts.items()):
+            if key not in self.entries:
+                self.insert(item)
+            self.entries[key][2:] = [count, order]
+        self.next_order = len(counts)
+
+    def query(self, box):
+        """
+        Returns the items whose boxes overlap box (x0, y0, x1, y1), in the
+        order they were added
+        """
+        x0, y0, x1, y1 = box
+        found = dict(self.unbounded)
+        for cell in self._cells(box):
+            for key, item in self.cells.get(cell, {}).items():
+                if key in found:
+                    continue
+                ix0, iy0, ix1, iy1 = self.entries[key][1]
+                if ix0 <= x1 and x0 <= ix1 and iy0 <= y1 and y0 <= iy1:
+                    found[key] = item
+        return sorted(found.values(),
+                      key=lambda item: self.entries[id(item)][3])
+
+    def query_point(self, point):
+        """Returns the items whose boxes contain point (x, y)"""
+        return self.query((point[0], point[1], point[0], point[1]))
+
+def contour_bounds(contour):
+    """Returns the inclusive bounding box (x0, y0, x1, y1) of contour"""
+    return contour_record(contour).bounds
+
+def grow_array(array, size):
+    """
+    Returns array with room for at least size rows, doubling its capacity so
+    appending one row at a time is amortized O(1)
+    """
+    if len(array) >= size:
+        return array
+    grown = np.empty((max(size, 2 * len(array)),) + array.shape[1:],
+                     dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+def line_boxes(vertices, offsets):
+    """
+    Returns the bounding boxes (x0, y0, x1, y1) of the lines with vertices
+    offsets[i] to offsets[i + 1] (exclusive), as an array. A line without
+    points overlaps everything until it has one.
+    """
+    info = np.iinfo(np.int32)
+    boxes = np.empty((len(offsets) - 1, 4), dtype=np.int32)
+    boxes[:] = (info.min, info.min, info.max, info.max)
+    filled = offsets[1:] > offsets[:-1]
+    if filled.any():
+        starts = offsets[:-1][filled]
+        boxes[filled, :2] = np.minimum.reduceat(vertices, starts)
+        boxes[filled, 2:] = np.maximum.reduceat(vertices, starts)
+    return boxes
+
+class Counters:
+    """
+    The counters of a session, stored as one structured array of (x, y,
+    group code) with the group names in a side table.
+
+    Counters are appended in amortized O(1) and queried in bulk, e.g. for
+    the eraser and the totals. Iterating or indexing yields ((x, y), group)
+    like the lists of counters stored in session files.
+    """
+    DTYPE = np.dtype([('x', np.int32), ('y', np.int32), ('group', np.int16)])
+
+    def __init__(self, counters=()):
+        """
+        Arguments:
+            counters (Counters or list): the counters to start with, as
+                                         ((x, y), group)
+        """
+        if isinstance(counters, Counters):
+            self.groups = list(counters.groups)
+            self.codes = dict(counters.codes)
+            self.data = counters.records.copy()
+            self.size = counters.size
+            self.revision = 0
+            return
+        self.groups = [] # group names, indexed by code
+        self.codes = {} # group name -> code
+        self.data = np.empty(0, dtype=self.DTYPE)
+        self.size = 0
+        self.revision = 0 # changes whenever counters are removed
+        for point, group in counters:
+            self.append(point, group)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, index):
+        records = self.records[index]
+        if isinstance(index, slice):
+            return [((int(x), int(y)), self.groups[code])
+                    for x, y, code in records.tolist()]
+        return (int(records['x']), int(records['y'])), \
+               self.groups[records['group']]
+
+    def __eq__(self, other):
+        if not isinstance(other, Counters):
+            return NotImplemented
+        return self[:] == other[:]
+
+    @property
+    def records(self):
+        """The structured array of the counters, a view"""
+        return self.data[:self.size]
+
+    @property
+    def nbytes(self):
+        """The memory the counters take up"""
+        return self.records.nbytes
+
+    @property
+    def points(self):
+        """The (x, y) of each counter, as an array"""
+        records = self.records
+        return np.stack((records['x'], records['y']), axis=1)
+
+    def code(self, group):
+        """Returns the code of group (str), adding it if it's new"""
+        code = self.codes.get(group)
+        if code is None:
+            code = self.codes[group] = len(self.groups)
+            self.groups.append(group)
+        return code
+
+    def copy(self):
+        """Returns an independent copy of the counters"""
+        return Counters(self)
+
+    def append(self, point, group):
+        """Adds a counter at point (x, y) to group (str)"""
+        self.data = grow_array(self.data, self.size + 1)
+        self.data[self.size] = (point[0], point[1], self.code(group))
+        self.size += 1
+
+    def insert(self, positions, counters):
+        """
+        Inserts counters (Counters) so that they end up at positions (sorted
+        indices), e.g. to put back removed counters
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        if np.array_equal(positions, np.arange(self.size,
+                                               self.size + len(positions))):
+            for point, group in counters: # appended, the layer can extend
+                self.append(point, group)
+            return
+        records = counters.records.copy()
+        if len(records):
+            codes = np.array([self.code(group) for group in counters.groups],
+                             dtype=np.int16)
+            records['group'] = codes[records['group']]
+        self.data = np.insert(self.records,
+                              positions - np.arange(len(positions)), records)
+        self.size = len(self.data)
+        self.revision += 1
+
+    def remove(self, mask):
+        """
+        Removes the counters where mask (boolean array) is True
+
+        Returns:
+            removed (Counters): the counters removed
+        """
+        mask = np.asarray(mask, dtype=bool)
+        removed = Counters()
+        removed.groups = list(self.groups)
+        removed.codes = dict(self.codes)
+        removed.data = self.records[mask].copy()
+        removed.size = len(removed.data)
+        self.data = self.records[~mask].copy()
+        self.size = len(self.data)
+        self.revision += 1
+        return removed
+
+    def in_circle(self, center, radius):
+        """
+        Returns a boolean array, True for each counter inside of the circle
+        at center (x, y) with radius, inclusive
+        """
+        offsets = self.points.astype(np.float64) - center
+        return (offsets * offsets).sum(axis=1) <= radius * radius
+
+    def totals(self):
+        """
+        Returns a dictionary of group name -> number of counters, in the
+        order the groups first appear
+        """
+        codes = self.records['group']
+        counts = np.bincount(codes, minlength=len(self.groups))
+        present, first = np.unique(codes, return_index=True)
+        return {self.groups[code]: int(counts[code])
+                for code in present[np.argsort(first)]}
+
+    @classmethod
+    def from_arrays(cls, points, codes, groups):
+        """
+        Returns the counters at points ((N, 2) array) in the groups (list)
+        indexed by codes (array), e.g. as stored in binary session files
+        """
+        counters = cls()
+        counters.groups = list(groups)
+        counters.codes = {group: code for code, group in enumerate(groups)}
+        counters.data = np.empty(len(points), dtype=cls.DTYPE)
+        counters.data['x'] = points[:, 0]
+        counters.data['y'] = points[:, 1]
+        counters.data['group'] = codes
+        counters.size = len(points)
+        return counters
+
+    def to_list(self):
+        """Returns the counters as a list of ((x, y), group), for saving"""
+        return self[:]
+
+class Strokes:
+    """
+    The cut and draw lines of a session, stored as one buffer of vertices
+    with the offset of each line into it, and a column each for the
+    thickness, color and kind of the lines.
+
+    Points are added to the last line in amortized O(1) while drawing
+    freehand, and each line keeps its bounding box, so the lines near a
+    point are found with one vectorized test. Iterating or indexing yields
+    (thickness, color, points) with points as an array view.
+    """
+    def __init__(self, lines=()):
+        """
+        Arguments:
+            lines (Strokes or list): the lines to start with, as
+                                     [thickness, color, points], where points
+                                     is a list of (x, y) for a freehand line
+                                     or [((x, y), (x, y))] for a straight one
+        """
+        if isinstance(lines, Strokes):
+            self.count = lines.count
+            self.size = lines.size
+            self.vertices = lines.vertices[:lines.size].copy()
+            self.offsets = lines.offsets[:lines.count + 1].copy()
+            self.thickness = lines.thickness[:lines.count].copy()
+            self.colors = lines.colors[:lines.count].copy()
+            self.straight = lines.straight[:lines.count].copy()
+            self.boxes = lines.boxes[:lines.count].copy()
+            self.revision = 0
+            return
+        self.count = 0 # number of lines
+        self.size = 0 # number of vertices
+        self.vertices = np.empty((0, 2), dtype=np.int32)
+        self.offsets = np.zeros(1, dtype=np.int64) # start of each line, and
+                                                   # the end of the last one
+        self.thickness = np.empty(0, dtype=np.int32)
+        self.colors = np.empty((0, 3), dtype=np.int32)
+        self.straight = np.empty(0, dtype=bool) # a line between two points
+        self.boxes = np.empty((0, 4), dtype=np.int32) # (x0, y0, x1, y1)
+        self.revision = 0 # changes whenever lines are removed or split
+        for thickness, color, points in lines:
+            straight = (len(points) > 0 and
+                        isinstance(points[0][0], (tuple, list)))
+            self.append(thickness, color, points[0] if straight else points,
+                        straight)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self[index]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('line index out of range')
+        return (int(self.thickness[index]), tuple(self.colors[index].tolist()),
+                self.points(index))
+
+    def __eq__(self, other):
+        if not isinstance(other, Strokes):
+            return NotImplemented
+        return self.key() == other.key()
+
+    def points(self, index):
+        """Returns the vertices of line index, an array view"""
+        return self.vertices[self.offsets[index]:self.offsets[index + 1]]
+
+    def copy(self):
+        """Returns an independent copy of the lines"""
+        return Strokes(self)
+
+    @property
+    def nbytes(self):
+        """The memory the lines take up"""
+        return self.vertices[:self.size].nbytes + self.count * (
+            self.offsets.itemsize + self.thickness.itemsize
+            + 3 * self.colors.itemsize + self.straight.itemsize
+            + 4 * self.boxes.itemsize)
+
+    def key(self):
+        """Returns a hashable snapshot of the lines"""
+        count = self.count
+        return (self.vertices[:self.size].tobytes(),
+                self.offsets[:count + 1].tobytes(),
+                self.thickness[:count].tobytes(),
+                self.colors[:count].tobytes(), self.straight[:count].tobytes())
+
+    def append(self, thickness, color, points=(), straight=False):
+        """
+        Adds a line
+
+        Arguments:
+            thickness (int): the line thickness
+            color (tuple): the BGR color
+            points (list): the (x, y) of the line, more can be added to the
+                           last line with append_point
+            straight (bool): the line is the segment between its two points
+        """
+        index = self.count
+        self.offsets = grow_array(self.offsets, index + 2)
+        self.thickness = grow_array(self.thickness, index + 1)
+        self.colors = grow_array(self.colors, index + 1)
+        self.straight = grow_array(self.straight, index + 1)
+        self.boxes = grow_array(self.boxes, index + 1)
+        self.thickness[index] = thickness
+        self.colors[index] = color
+        self.straight[index] = straight
+        # an empty line overlaps everything until it has a point
+        info = np.iinfo(np.int32)
+        self.boxes[index] = (info.min, info.min, info.max, info.max)
+        self.offsets[index + 1] = self.size
+        self.count += 1
+        if len(points):
+            points = np.asarray(points, dtype=np.int32).reshape(-1, 2)
+            self.vertices = grow_array(self.vertices, self.size + len(points))
+            self.vertices[self.size:self.size + len(points)] = points
+            self.size += len(points)
+            self.offsets[index + 1] = self.size
+            self.boxes[index] = np.concatenate((points.min(axis=0),
+                                                points.max(axis=0)))
+
+    def append_point(self, point):
+        """Adds point (x, y) to the end of the last line"""
+        index = self.count - 1
+        self.vertices = grow_array(self.vertices, self.size + 1)
+        self.vertices[self.size] = point
+        box = self.boxes[index]
+        if self.offsets[index] == self.size: # the first point
+            box[:] = (point[0], point[1], point[0], point[1])
+        else:
+            box[:2] = np.minimum(box[:2], point)
+            box[2:] = np.maximum(box[2:], point)
+        self.size += 1
+        self.offsets[index + 1] = self.size
+
+    def overlapping(self, box):
+        """
+        Returns the indices of the lines whose bounding boxes overlap box
+        (x0, y0, x1, y1), and of the lines without points
+        """
+        x0, y0, x1, y1 = box
+        boxes = self.boxes[:self.count]
+        return np.flatnonzero((boxes[:, 0] <= x1) & (x0 <= boxes[:, 2]) &
+                              (boxes[:, 1] <= y1) & (y0 <= boxes[:, 3]))
+
+    def section(self, index, count, ranges=None):
+        """
+        Returns a copy of count lines from index as Strokes, or with ranges,
+        the inclusive (first, last) ranges of the vertices of line index as
+        separate lines
+        """
+        section = Strokes()
+        if ranges is None:
+            owners = slice(index, index + count)
+            starts = self.offsets[owners]
+            lengths = self.offsets[index + 1:index + count + 1] - starts
+            section.boxes = self.boxes[owners].copy()
+        else:
+            ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+            owners = np.full(len(ranges), index)
+            starts = self.offsets[index] + ranges[:, 0]
+            lengths = ranges[:, 1] - ranges[:, 0] + 1
+        section.count = len(lengths)
+        if section.count:
+            section.vertices = np.concatenate([
+                self.vertices[start:start + length]
+                for start, length in zip(starts.tolist(), lengths.tolist())])
+        section.size = len(section.vertices)
+        section.offsets = np.zeros(section.count + 1, dtype=np.int64)
+        np.cumsum(lengths, out=section.offsets[1:])
+        section.thickness = self.thickness[owners].copy()
+        section.colors = self.colors[owners].copy()
+        section.straight = self.straight[owners].copy()
+        if ranges is not None:
+            section.boxes = line_boxes(section.vertices, section.offsets)
+        return section
+
+    def splice(self, changes):
+        """
+        Replaces some runs of lines by other lines, in one pass
+
+        Arguments:
+            changes (list): (index, count, lines) to replace count lines
+                            from index by lines (Strokes), in order of index
+                            and not overlapping
+
+        Returns:
+            inverse (list): the (index, count, lines) that put back the lines
+                            replaced, with the indices after the change
+        """
+        inverse = []
+        shift = 0
+        for index, count, lines in changes:
+            inverse.append((index + shift, lines.count,
+                            self.section(index, count)))
+            shift += lines.count - count
+        if len(changes) == 1 and sum(changes[0][:2]) == self.count:
+            # the end of the buffer, drop the lines and append the new ones
+            index, count, lines = changes[0]
+            self.count = index
+            self.size = int(self.offsets[index])
+            for line, (thickness, color, points) in enumerate(lines):
+                self.append(thickness, color, points, lines.straight[line])
+            if count:
+                self.revision += 1
+            return inverse
+        offsets = self.offsets[:self.count + 1]
+        vertices, starts = [], [offsets[:1]]
+        size = 0 # the number of vertices so far
+        columns = {name: [] for name in ('thickness', 'colors', 'straight',
+                                         'boxes')}
+        kept = 0 # the first line not handled yet
+        for index, count, lines in changes + [(self.count, 0, Strokes())]:
+            # the lines up to index are kept as they are
+            vertices += [self.vertices[offsets[kept]:offsets[index]],
+                         lines.vertices[:lines.size]]
+            starts.append(offsets[kept + 1:index + 1] - offsets[kept] + size)
+            size += int(offsets[index] - offsets[kept])
+            starts.append(lines.offsets[1:lines.count + 1] + size)
+            size += lines.size
+            for name, parts in columns.items():
+                parts += [getattr(self, name)[kept:index],
+                          getattr(lines, name)[:lines.count]]
+            kept = index + count
+        self.vertices = np.concatenate(vertices)
+        self.offsets = np.concatenate(starts)
+        for name, parts in columns.items():
+            setattr(self, name, np.concatenate(parts))
+        self.count = len(self.thickness)
+        self.size = len(self.vertices)
+        self.revision += 1
+        return inverse
+
+    @classmethod
+    def from_arrays(cls, vertices, offsets, thickness, colors, straight):
+        """
+        Returns the lines with the vertices ((N, 2) array) from offsets[i]
+        to offsets[i + 1] and the columns of each line, e.g. as stored in
+        binary session files
+        """
+        lines = cls()
+        lines.count = len(offsets) - 1
+        lines.size = len(vertices)
+        lines.vertices = np.asarray(vertices, dtype=np.int32).reshape(-1, 2)
+        lines.offsets = np.asarray(offsets, dtype=np.int64)
+        lines.thickness = np.asarray(thickness, dtype=np.int32)
+        lines.colors = np.asarray(colors, dtype=np.int32).reshape(-1, 3)
+        lines.straight = np.asarray(straight, dtype=bool)
+        lines.boxes = line_boxes(lines.vertices, lines.offsets)
+        return lines
+
+    def to_list(self):
+        """
+        Returns the lines as a list of [thickness, color, points], for saving
+        """
+        lines = []
+        for thickness, color, points in self:
+            points = [tuple(point) for point in points.tolist()]
+            if self.straight[len(lines)]:
+                points = [tuple(points)]
+            lines.append([thickness, color, points])
+        return lines
+
+def apply_edit(selections, lines, counters, edit):
+    """
+    Makes a change to the selections, lines or counters of a session, e.g.
+    an action in the editor or one replayed from a journal
+
+    Arguments:
+        selections (dict): group name -> list of contours
+        lines (Strokes): the lines
+        counters (Counters): the counters
+        edit (tuple): one of
+            ('contours', group, index, count, contours): replaces count
+                contours of group from index by contours (list)
+            ('lines', changes): replaces runs of lines, see Strokes.splice
+            ('insert counters', positions, counters): inserts counters
+                (Counters) so they end up at positions (sorted indices)
+            ('remove counters', positions): removes the counters at
+                positions (indices)
+
+    Returns:
+        inverse (tuple): the edit that undoes this one
+    """
+    kind = edit[0]
+    if kind == 'contours':
+        _kind, group, index, count, contours = edit
+        group_contours = selections[group]
+        removed = group_contours[index:index + count]
+        group_contours[index:index + count] = contours
+        return ('contours', group, index, len(contours), removed)
+    if kind == 'lines':
+        return ('lines', lines.splice(edit[1]))
+    positions = np.asarray(edit[1], dtype=np.int64)
+    if kind == 'insert counters':
+        counters.insert(positions, edit[2])
+        return ('remove counters', positions)
+    mask = np.zeros(len(counters), dtype=bool)
+    mask[positions] = True
+    return ('insert counters', positions, counters.remove(mask))
+
+def contour_key(contour):
+    """Returns a hashable key, equal for contours with equal points"""
+    return contour.shape, np.asarray(contour, dtype=np.int64).tobytes()
+
+def centroid(contour):
+    """Returns the integer centroid (x, y) of contour"""
+    return contour_record(contour).centroid
+
+def pair(saved_contours):
+    """
+    Pairs up contours in Axon, Inner Myelin, and Outer Myelin stacks
+
+    Arguments:
+        saved_contours (dict): the selected contours for each group
+
+    Returns:
+        pairing (Pairing): the complete units and the leftover contours
+    """
+    pairing = Pairing()
+    seen = set() # contour_key of every paired inner and outer contour
+    indices = {group: GridIndex(contour_bounds, saved_contours[group])
+               for group in (INNER_MYELIN, OUTER_MYELIN)}
+
+    # Go through axons in selection order
+    for a in saved_contours[AXON]:
+        paired_up = [a]
+        a_xy = centroid(a)
+        a_point = tuple(int(v) for v in a[0][0])
+        # only sheaths whose boxes reach the centroid or first point can match
+        near = (min(a_xy[0], a_point[0]), min(a_xy[1], a_point[1]),
+                max(a_xy[0], a_point[0]), max(a_xy[1], a_point[1]))
+
+        is_inner = False
+
+        # look for overlapping inner myelin sheath
+        for b in indices[INNER_MYELIN].query(near):
+            if contour_key(b) in seen:
+                continue
+            if (cv.pointPolygonTest(b, a_xy, False) > 0 or
+                cv.pointPolygonTest(b, a_point, False) >= 0):
+                paired_up.append(b)
+                seen.add(contour_key(b))
+                is_inner = True
+                break
+
+        # and overlapping outer myelin sheath
+        for c in indices[OUTER_MYELIN].query(near):
+            if contour_key(c) in seen:
+                continue
+            if (cv.pointPolygonTest(c, a_xy, False) > 0 or
+                cv.pointPolygonTest(c, a_point, False) >= 0):
+                paired_up.append(c)
+                seen.add(contour_key(c))
+                break
+
+        # check for full stack
+        if len(paired_up) == NUM_FEATURES:
+            paired_up.sort(key=contour_area, reverse=True)
+            pairing.pairs.append(tuple(paired_up))
+        else:
+            pairing.pairless_grouped[AXON].append(paired_up[0])
+            if len(paired_up) == 2:
+                if is_inner:
+                    pairing.pairless_grouped[INNER_MYELIN].append(paired_up[1])
+                else:
+                    pairing.pairless_grouped[OUTER_MYELIN].append(paired_up[1])
+            pairing.pairless += paired_up
+
+    # Round up any lonely inner or outer
+    for group in (INNER_MYELIN, OUTER_MYELIN):
+        for b in saved_contours[group]:
+            if contour_key(b) in seen:
+                continue
+            pairing.pairless.append(b)
+            pairing.pairless_grouped[group].append(b)
+
+    return pairing
+
+def axon_points(axon):
+    """
+    Returns the points of axon that a sheath has to contain to pair with
+    it, see pair(): its centroid and its first point
+    """
+    return centroid(axon), tuple(int(v) for v in axon[0][0])
+
+def sheath_contains(sheath, points):
+    """Returns True if sheath can pair with the axon with points"""
+    a_xy, a_point = points
+    return (cv.pointPolygonTest(sheath, a_xy, False) > 0 or
+            cv.pointPolygonTest(sheath, a_point, False) >= 0)
+
+class IncrementalPairing:
+    """
+    Keeps the result of pair() up to date as selections come and go,
+    repeating the geometry only for the axon stacks a change affects.
+
+    Every axon takes, for inner and for outer myelin, the first sheath in
+    selection order that contains it and that no earlier axon took. So an
+    axon's choice only depends on the axons before it. For every axon this
+    keeps the sheaths that contain it (its candidates) and which one it
+    took; for every sheath, which axons it contains and which axon took it.
+    A change re-decides the axons whose candidates changed and passes any
+    sheath that is taken or given up along to the later axons that prefer
+    it, in selection order, until nothing changes.
+
+    Sheaths are told apart by identity. pair() treats equal contours as the
+    same sheath, so while two sheaths are equal the result comes from pair()
+    instead.
+    """
+    SHEATH_GROUPS = (INNER_MYELIN, OUTER_MYELIN)
+
+    def __init__(self):
+        self.axons = {} # id -> [axon, order, points]
+        self.sheaths = {} # id -> [sheath, order, group, contour_key]
+        self.key_counts = {} # contour_key -> number of sheaths with it
+        self.duplicates = 0 # number of keys shared by more than one sheath
+        self.sheath_index = {group: GridIndex(contour_bounds)
+                             for group in self.SHEATH_GROUPS}
+        self.axon_index = GridIndex(lambda axon: self._near(axon))
+        self.candidates = {} # (axon id, group) -> sheath ids, in order
+        self.wanted_by = {} # sheath id -> ids of axons it contains
+        self.taken = {} # (axon id, group) -> sheath id
+        self.owner = {} # sheath id -> axon id
+        self.valid = True # the taken sheaths match pair()
+
+    def _near(self, axon):
+        """Returns the box spanning the points of axon"""
+        (x0, y0), (x1, y1) = self.axons[id(axon)][2]
+        return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+    def _before(self, sheath_a, sheath_b):
+        """Returns True if sheath id sheath_a comes before sheath_b"""
+        return self.sheaths[sheath_a][1] < self.sheaths[sheath_b][1]
+
+    def _push_wanting(self, queue, sheath_id, after):
+        """
+        Queues the axons after axon id after (or all if None) that would
+        rather have sheath_id than what they have now
+        """
+        group = self.sheaths[sheath_id][2]
+        for axon_id in self.wanted_by.get(sheath_id, ()):
+            if after is not None and self.axons[axon_id][1] <= after:
+                continue
+            current = self.taken.get((axon_id, group))
+            if current is None or self._before(sheath_id, current):
+                heapq.heappush(queue, (self.axons[axon_id][1], axon_id, group))
+
+    def _remove_sheath(self, queue, sheath_id):
+        sheath, _order, group, key = self.sheaths[sheath_id]
+        axon_id = self.owner.pop(sheath_id, None)
+        if axon_id is not None:
+            del self.taken[(axon_id, group)]
+            heapq.heappush(queue, (self.axons[axon_id][1], axon_id, group))
+        for axon_id in self.wanted_by.pop(sheath_id, ()):
+            self.candidates[(axon_id, group)].remove(sheath_id)
+        self.sheath_index[group].remove(sheath, all_copies=True)
+        self.key_counts[key] -= 1
+        if self.key_counts[key] == 1:
+            self.duplicates -= 1
+        elif self.key_counts[key] == 0:
+            del self.key_counts[key]
+        del self.sheaths[sheath_id]
+
+    def _remove_axon(self, queue, axon_id):
+        axon, order, _points = self.axons[axon_id]
+        for group in self.SHEATH_GROUPS:
+            sheath_id = self.taken.pop((axon_id, group), None)
+            if sheath_id is not None:
+                del self.owner[sheath_id]
+                self._push_wanting(queue, sheath_id, order)
+            for candidate in self.candidates.pop((axon_id, group)):
+                self.wanted_by[candidate].discard(axon_id)
+        self.axon_index.remove(axon, all_copies=True)
+        del self.axons[axon_id]
+
+    def _add_sheath(self, queue, sheath, group):
+        sheath_id = id(sheath)
+        key = contour_key(sheath)
+        self.key_counts[key] = self.key_counts.get(key, 0) + 1
+        if self.key_counts[key] == 2:
+            self.duplicates += 1
+        self.sheaths[sheath_id][2:] = [group, key]
+        self.sheath_index[group].insert(sheath)
+        self.wanted_by[sheath_id] = set()
+        for axon in self.axon_index.query(contour_bounds(sheath)):
+            axon_id = id(axon)
+            if sheath_contains(sheath, self.axons[axon_id][2]):
+                candidates = self.candidates[(axon_id, group)]
+                candidates.append(sheath_id)
+                candidates.sort(key=lambda s: self.sheaths[s][1])
+                self.wanted_by[sheath_id].add(axon_id)
+        self._push_wanting(queue, sheath_id, None)
+
+    def _add_axon(self, queue, axon):
+        axon_id = id(axon)
+        points = self.axons[axon_id][2] = axon_points(axon)
+        self.axon_index.insert(axon)
+        near = self._near(axon)
+        for group in self.SHEATH_GROUPS:
+            candidates = []
+            for sheath in self.sheath_index[group].query(near):
+                if sheath_contains(sheath, points):
+                    candidates.append(id(sheath))
+                    self.wanted_by[id(sheath)].add(axon_id)
+            candidates.sort(key=lambda s: self.sheaths[s][1])
+            self.candidates[(axon_id, group)] = candidates
+            heapq.heappush(queue, (self.axons[axon_id][1], axon_id, group))
+
+    def _decide(self, queue):
+        """Re-decides the queued axons in selection order"""
+        while queue:
+            order, axon_id, group = heapq.heappop(queue)
+            if axon_id not in self.axons:
+                continue # removed since it was queued
+            slot = (axon_id, group)
+            choice = None
+            for sheath_id in self.candidates[slot]:
+                owner = self.owner.get(sheath_id)
+                if (owner is None or owner == axon_id or
+                    self.axons[owner][1] > order):
+                    choice = sheath_id
+                    break
+            current = self.taken.get(slot)
+            if choice == current:
+                continue
+            if current is not None:
+                del self.owner[current]
+                del self.taken[slot]
+                self._push_wanting(queue, current, order)
+            if choice is not None:
+                previous = self.owner.get(choice)
+                if previous is not None:
+                    del self.taken[(previous, group)]
+                    heapq.heappush(queue, (self.axons[previous][1], previous,
+                                           group))
+                self.owner[choice] = axon_id
+                self.taken[slot] = choice
+
+    def update(self, saved_contours):
+        """
+        Brings the pairing up to date with saved_contours (dict)
+
+        Returns:
+            pairing (Pairing): the same result as pair(saved_contours)
+        """
+        axons = saved_contours[AXON]
+        current = {AXON: {id(a): a for a in axons}}
+        for group in self.SHEATH_GROUPS:
+            current[group] = {id(s): s for s in saved_contours[group]}
+        queue = []
+
+        # 1. Drop what was removed
+        for sheath_id in [s for s, entry in self.sheaths.items()
+                          if s not in current[entry[2]]]:
+            self._remove_sheath(queue, sheath_id)
+        for axon_id in [a for a in self.axons if a not in current[AXON]]:
+            self._remove_axon(queue, axon_id)
+
+        # 2. Renumber in selection order. Selections are only added or
+        #    removed, so the rest normally keep their relative order, if
+        #    not every axon is decided again
+        added_axons = []
+        reordered = False
+        last = -1
+        for order, axon in enumerate(axons):
+            entry = self.axons.get(id(axon))
+            if entry is None:
+                self.axons[id(axon)] = [axon, order, None]
+                added_axons.append(axon)
+            else:
+                reordered = reordered or entry[1] < last
+                last = entry[1]
+                entry[1] = order
+        added_sheaths = []
+        for group in self.SHEATH_GROUPS:
+            last = -1
+            for order, sheath in enumerate(saved_contours[group]):
+                entry = self.sheaths.get(id(sheath))
+                if entry is None:
+                    self.sheaths[id(sheath)] = [sheath, order, group, None]
+                    added_sheaths.append((sheath, group))
+                else:
+                    reordered = reordered or entry[1] < last
+                    last = entry[1]
+                    entry[1] = order
+        if reordered:
+            self.valid = False
+
+        queue = [(self.axons[axon_id][1], axon_id, group)
+                 for _order, axon_id, group in queue if axon_id in self.axons]
+        heapq.heapify(queue)
+
+        # 3. Find the candidates of what was added
+        for sheath, group in added_sheaths:
+            self._add_sheath(queue, sheath, group)
+        for axon in added_axons:
+            self._add_axon(queue, axon)
+
+        # 4. Re-decide the affected axons, pair() handles equal sheaths and
+        #    repeated selections
+        repeated = (len(current[AXON]) != len(axons) or
+                    len(self.sheaths) != sum(len(saved_contours[group])
+                                             for group in self.SHEATH_GROUPS))
+        if self.duplicates or repeated:
+            self.valid = False
+            return pair(saved_contours)
+        if not self.valid:
+            self.owner, self.taken = {}, {}
+            queue = []
+            for (axon_id, group), candidates in self.candidates.items():
+                candidates.sort(key=lambda s: self.sheaths[s][1])
+                queue.append((self.axons[axon_id][1], axon_id, group))
+            heapq.heapify(queue)
+            self.valid = True
+        self._decide(queue)
+        return self.pairing(saved_contours)
+
+    def pairing(self, saved_contours):
+        """Collects the Pairing of saved_contours from the taken sheaths"""
+        pairing = Pairing()
+        for a in saved_contours[AXON]:
+            paired_up = [a]
+            is_inner = False
+            for group in self.SHEATH_GROUPS:
+                sheath_id = self.taken.get((id(a), group))
+                if sheath_id is not None:
+                    paired_up.append(self.sheaths[sheath_id][0])
+                    is_inner = is_inner or group == INNER_MYELIN
+            if len(paired_up) == NUM_FEATURES:
+                paired_up.sort(key=contour_area, reverse=True)
+                pairing.pairs.append(tuple(paired_up))
+            else:
+                pairing.pairless_grouped[AXON].append(paired_up[0])
+                if len(paired_up) == 2:
+                    if is_inner:
+                        pairing.pairless_grouped[INNER_MYELIN].append(
+                            paired_up[1])
+                    else:
+                        pairing.pairless_grouped[OUTER_MYELIN].append(
+                            paired_up[1])
+                pairing.pairless += paired_up
+        for group in self.SHEATH_GROUPS:
+            for b in saved_contours[group]:
+                if id(b) in self.owner:
+                    continue
+                pairing.pairless.append(b)
+                pairing.pairless_grouped[group].append(b)
+        return pairing
+
+class ContourTable:
+    """
+    The selections packed into one table: the points of every contour in
+    one vertex buffer with the offset of each contour into it, a column
+    each for the group and the measurements of the contours, and the
+    pairing as rows of the table.
+
+    Contours are stored group by group in selection order. The complete
+    units are the rows of their (outer, inner, axon) contours and the unit
+    column gives the unit of every contour, -1 if it isn't in one. The
+    export measures every selection through the columns instead of the
+    contours one by one.
+
+    The table is a packed copy for that bulk work. Editing, pairing and
+    drawing work on the lists of contours, and write_session packs them
+    into a session file itself.
+    """
+    def __init__(self, saved_contours, pairing=None):
+        """
+        Arguments:
+            saved_contours (dict): the selected contours for each group
+            pairing (Pairing): the pairing of saved_contours, paired up
+                               here if not given
+        """
+        if pairing is None:
+            pairing = pair(saved_contours)
+        contours = []
+        counts = []
+        for group in SELECTION_GROUPS:
+            contours += saved_contours.get(group, [])
+            counts.append(len(saved_contours.get(group, [])))
+        self.group = np.repeat(np.arange(len(SELECTION_GROUPS),
+                                         dtype=np.int8), counts)
+        # id of a contour -> its first row
+        rows = dict(zip(map(id, reversed(contours)),
+                        range(len(contours) - 1, -1, -1)))
+
+        lengths = np.fromiter(map(len, contours), dtype=np.int64,
+                              count=len(contours))
+        self.offsets = np.concatenate(([0], np.cumsum(lengths)))
+        if contours:
+            self.vertices = np.concatenate(
+                [contour.reshape(-1, 1, 2) for contour in contours]
+            ).astype(np.int32, copy=False)
+        else:
+            self.vertices = np.empty((0, 1, 2), dtype=np.int32)
+
+        # The measurements come from the contour records, which are kept
+        # for as long as the contours live
+        columns = np.array([contour_record(contour).columns
+                            for contour in contours],
+                           dtype=np.float64).reshape(-1, 5)
+        self.area = columns[:, 0]
+        self.perimeter = columns[:, 1]
+        moments = columns[:, 2:]
+        self.centroids = self.vertices[self.offsets[:-1], 0]
+        solid = moments[:, 0] != 0 # degenerate contours use their first point
+        self.centroids[solid] = np.trunc(
+            moments[solid, 1:] / moments[solid, :1]).astype(np.int32)
+
+        # The pairing, as rows
+        self.units = np.array([[rows[id(contour)] for contour in unit]
+                               for unit in pairing.pairs],
+                              dtype=np.int64).reshape(-1, NUM_FEATURES)
+        self.unit = np.full(len(contours), -1, dtype=np.int64)
+        self.unit[self.units] = np.arange(len(self.units))[:, None]
+        self.pairless = {
+            group: np.array([rows[id(contour)] for contour in grouped],
+                            dtype=np.int64)
+            for group, grouped in pairing.pairless_grouped.items()}
+
+    @classmethod
+    def from_pairing(cls, pairing, misc_contours=()):
+        """
+        Returns the table of pairing (Pairing) and misc_contours (list),
+        with the contours of each unit in the group of their place in it
+        """
+        saved_contours = {group: [] for group in SELECTION_GROUPS}
+        for outer, inner, axon in pairing.pairs:
+            saved_contours[OUTER_MYELIN].append(outer)
+            saved_contours[INNER_MYELIN].append(inner)
+            saved_contours[AXON].append(axon)
+        for group, grouped in pairing.pairless_grouped.items():
+            saved_contours[group] += grouped
+        saved_contours[MISC] = list(misc_contours)
+        return cls(saved_contours, pairing)
+
+    def __len__(self):
+        return len(self.group)
+
+    def contour(self, row):
+        """Returns the contour in row, a view of the vertex buffer"""
+        return self.vertices[self.offsets[row]:self.offsets[row + 1]]
+
+    def contours(self, rows=None):
+        """Returns the contours in rows (indices or mask), or all of them"""
+        if rows is None:
+            rows = np.arange(len(self))
+        elif np.asarray(rows).dtype == bool:
+            rows = np.flatnonzero(rows)
+        return [self.contour(row) for row in np.asarray(rows).ravel()]
+
+    def rows(self, group):
+        """Returns the rows of the contours in group (str)"""
+        return np.flatnonzero(self.group == SELECTION_GROUPS.index(group))
+
+    def metrics(self, calibration, scaling=1.00):
+        """
+        Measures every contour, see metrics()
+
+        Returns:
+            measurements (dict): 'area', 'perimeter' and 'diameter' arrays
+                                 in um, one value per row
+        """
+        if scaling == 1.00:
+            area = self.area * calibration ** 2
+            perimeter = self.perimeter * calibration
+        else:
+            scaled = (self.vertices * scaling).astype(np.int32)
+            contours = [scaled[start:end] for start, end
+                        in zip(self.offsets[:-1], self.offsets[1:])]
+            area = np.array([cv.contourArea(c) for c in contours],
+                            dtype=np.float64) * calibration ** 2
+            perimeter = np.array([cv.arcLength(c, True) for c in contours],
+                                 dtype=np.float64) * calibration
+        return {
+            'area': area,
+            'perimeter': perimeter,
+            'diameter': np.sqrt(area / pi) * 2
+        }
+
+def scale_contour(contour, scaling):
+    """
+    Scales contour to given scaling
+
+    Arguments:
+        contour (np.array): contour to scale
+        scaling (float): scaling percent as decimal
+    """
+    scaled = contour * scaling
+    return scaled.astype(np.int32)
+
+def metrics(contour, calibration, scaling=1.00):
+    """
+    Measures a contour
+
+    Arguments:
+        contour (np.array): the contour to measure
+        calibration (float): um/px of the image the contour was found in
+        scaling (float): correction scaling to apply to the contour first
+
+    Returns:
+        measurements (dict): 'area', 'perimeter' and 'diameter' in um
+    """
+    if scaling == 1.00: # scale_contour would return the same points
+        record = contour_record(contour)
+        area = record.area * calibration ** 2
+        perimeter = record.perimeter * calibration
+    else:
+        scaled = scale_contour(contour, scaling)
+        area = cv.contourArea(scaled) * calibration ** 2
+        perimeter = cv.arcLength(scaled, True) * calibration
+    return {
+        'area': area,
+        'perimeter': perimeter,
+        'diameter': sqrt(area/pi)*2
+    }
+
+def counter_color(group):
+    """Returns the display color for a counter group (str)"""
+    if group == 'Unmyelinated Axons':
+        return Colors.PURPLE.value
+    elif group == 'Myelinated Axons':
+        return Colors.LIME.value
+    return Colors.PINK.value
+
+def get_totals(pairing, counters, count_selections=False, only_complete=False,
+               include_counters=True):
+    """
+    Helper function for export, counts up the selections and counters
+
+    Arguments:
+        pairing (Pairing): the paired up selections
+        counters (Counters or list): the counters as ((x, y), group)
+        count_selections (bool): count feature selections or not
+        only_complete (bool): only count complete selections
+        include_counters (bool): count group counters as well
+
+    Returns a string for csv
+    """
+    first_line, second_line = '', ''
+
+    if count_selections:
+        num_complete = len(pairing.pairs)
+        if num_complete > 0:
+            first_line += 'Complete,'
+            second_line += '{},'.format(num_complete)
+        num_incomplete = len(pairing.pairless)
+        if not only_complete and num_incomplete > 0:
+            first_line += 'Incomplete,'
+            second_line += '{},'.format(num_incomplete)
+
+    if include_counters:
+        if not isinstance(counters, Counters):
+            counters = Counters(counters)
+        counter_totals = counters.totals()
+        for group in counter_totals:
+            first_line += group + ','
+            second_line += '{},'.format(counter_totals[group])
+        total = (counter_totals.get('Myelinated Axons', 0)
+                 + counter_totals.get('Unmyelinated Axons', 0))
+        if total == 0:
+            total = 1
+        dec_myelin = counter_totals.get('Myelinated Axons', 0) / total
+        percent_myelinated = round(dec_myelin * 100, 2)
+        first_line += 'Percent Myelinated'
+        second_line += '{}%'.format(percent_myelinated)
+
+    return first_line + '\n' + second_line
+
+# The feature columns of the export, in order, as (selection, header)
+EXPORT_COLUMNS = [
+    ('Axon Area', 'Axon Area'),
+    ('Inner Myelin Area', 'Inner Area'),
+    ('Outer Myelin Area', 'Outer Area'),
+    ('Axon Perimeter', 'Axon Perimeter'),
+    ('Inner Myelin Perimeter', 'Inner Perimeter'),
+    ('Outer Myelin Perimeter', 'Outer Perimeter'),
+    ('Axon Diameter', 'Axon Diameter'),
+    ('Inner Myelin Diameter', 'Inner Diameter'),
+    ('Outer Myelin Diameter', 'Outer Diameter')
+]
+
+def export_row(measurements, export_selections):
+    """
+    Formats the selected feature columns of one csv row
+
+    Arguments:
+        measurements (dict): 'Axon', 'Inner Myelin' and/or 'Outer Myelin'
+                             metrics, missing features are left empty
+        export_selections (dict): the output from the export menu
+    """
+    row = ''
+    for selection, _header in EXPORT_COLUMNS:
+        if export_selections[selection]:
+            feature, measure = selection.rsplit(' ', 1)
+            if feature in measurements:
+                row += str(measurements[feature][measure.lower()])
+            row += ','
+    return row
+
+def export(directory, filename, image, pairing, misc_contours, counters,
+           export_selections, settings, table=None):
+    """
+    Exports the measurements as a csv and a reference overlay image
+
+    Arguments:
+        directory (str): the directory to save to
+        filename (str): the filename of the source image
+        image (np.array): the image the contours were found in
+        pairing (Pairing): the paired up selections
+        misc_contours (list): the miscellaneous selections
+        counters (Counters or list): the counters as ((x, y), group)
+        export_selections (dict): the output from the export menu
+        settings (dict): 'calibration', 'quality', 'correction_scaling',
+                         'alpha' and 'font_size'
+        table (ContourTable): the table of pairing and misc_contours, if
+                              it's already built
+    """
+    file_path = directory + '/'
+
+    file_name = filename.split('/')[-1]
+    new_filename = (file_path + '.'.join(file_name.split('.')[:-1])
+                    + '-overlay.' + file_name.split('.')[-1])
+
+    overlay = image.copy()
+
+    text_to_add = []
+
+    adjusted_calibration = settings['calibration'] / settings['quality']
+    scaling = settings['correction_scaling']
+    font_size = settings['font_size']
+
+    # every selection is measured at once
+    if table is None:
+        table = ContourTable.from_pairing(pairing, misc_contours)
+    measured = {measure: values.tolist() for measure, values
+                in table.metrics(adjusted_calibration, scaling).items()}
+
+    def row_metrics(row):
+        return {measure: values[row] for measure, values in measured.items()}
+
+    def add_label(index, row):
+        cX, cY = table.centroids[row].tolist()
+        text_to_add.append((str(index), (cX - int(font_size * 8),
+                                         cY + int(font_size * 4))))
+
+    def draw_feature(contours, color):
+        cv.drawContours(overlay, contours, -1, color, cv.FILLED)
+        cv.drawContours(overlay, contours, -1, Colors.BLACK.value, 1)
+
+    text_filename = (file_path + '.'.join(file_name.split('.')[:-1])
+                     + '-area_calculations.csv')
+    with open(text_filename, 'w') as f:
+        to_write = 'Number,'
+        for selection, header in EXPORT_COLUMNS:
+            if export_selections[selection]:
+                to_write += header + ','
+        if export_selections['g-ratio']:
+            to_write += 'g-ratio,'
+        to_write += '\n'
+        f.write(to_write)
+
+        cur_index = 0
+        for i, unit in enumerate(table.units.tolist()):
+            outer, inner, axon = unit
+            measurements = {
+                'Axon': row_metrics(axon),
+                'Inner Myelin': row_metrics(inner),
+                'Outer Myelin': row_metrics(outer)
+            }
+            sub_to_write = export_row(measurements, export_selections)
+            if export_selections['g-ratio']:
+                gratio = np.sqrt(measurements['Inner Myelin']['area']
+                                 / measurements['Outer Myelin']['area'])
+                sub_to_write += (str(gratio) + ',')
+
+            if sub_to_write:
+                cur_index = i+1
+                to_write = str(cur_index) + ',' + sub_to_write + '\n'
+                f.write(to_write)
+                draw_feature(table.contours(unit), Colors.CYAN_HIGHLIGHT.value)
+                add_label(cur_index, outer)
+
+        for feature, group in (('Axon', AXON),
+                               ('Inner Myelin', INNER_MYELIN),
+                               ('Outer Myelin', OUTER_MYELIN)):
+            for row in table.pairless[group].tolist():
+                measurements = {feature: row_metrics(row)}
+                sub_to_write = export_row(measurements, export_selections)
+
+                if len(sub_to_write) != sub_to_write.count(','):
+                    cur_index += 1
+                    to_write = str(cur_index) + ',' + sub_to_write + '\n'
+                    f.write(to_write)
+                    draw_feature([table.contour(row)],
+                                 Colors.ORANGE_HIGHLIGHT.value)
+                    add_label(cur_index, row)
+
+        if (export_selections['Misc. Perimeter']
+                or export_selections['Misc. Area']
+                or export_selections['Misc. Diameter']):
+            f.write('\nMiscellaneous\n')
+            to_write = 'Number,'
+            for measure in ('Area', 'Perimeter', 'Diameter'):
+                if export_selections['Misc. ' + measure]:
+                    to_write += 'Misc. ' + measure + ','
+            to_write += '\n'
+            f.write(to_write)
+
+            for row in table.rows(MISC).tolist():
+                m = row_metrics(row)
+                sub_to_write = ''
+                for measure in ('Area', 'Perimeter', 'Diameter'):
+                    if export_selections['Misc. ' + measure]:
+                        sub_to_write += (str(m[measure.lower()]) + ',')
+
+                if len(sub_to_write) != sub_to_write.count(','):
+                    cur_index += 1
+                    to_write = str(cur_index) + ',' + sub_to_write + '\n'
+                    f.write(to_write)
+                    draw_feature([table.contour(row)],
+                                 Colors.CYAN_HIGHLIGHT.value)
+                    add_label(cur_index, row)
+
+        totals = get_totals(pairing, counters)
+        f.write('\n')
+        f.write(totals)
+
+    alpha = settings['alpha']
+    export_image = cv.addWeighted(overlay, alpha, image, 1-alpha, 0)
+    for t in text_to_add:
+        cv.putText(export_image, t[0], t[1], cv.FONT_HERSHEY_SIMPLEX,
+                   font_size, Colors.WHITE.value, int(2*font_size))
+
+    if export_selections['Counters']:
+        for point, group in counters:
+            color = counter_color(group)
+            export_image = cv.circle(export_image, point, 3, color, -1)
+            export_image = cv.circle(export_image, point, 3,
+                                     Colors.BLACK.value, 2)
+            cv.putText(export_image, group[0], (point[0] + 4, point[1] - 4),
+                       cv.FONT_HERSHEY_SIMPLEX, font_size, color,
+                       int(2*font_size))
+
+    is_success, im_buf_arr = cv.imencode(os.path.splitext(new_filename)[-1],
+                                         export_image)
+    im_buf_arr.tofile(new_filename)
+
+def write_session(filename, session):
+    """
+    Writes a session to filename (str) as an uncompressed npz archive of
+    the packed selections, lines and counters, with the rest of the session
+    in a JSON header. The file is written in full before it replaces
+    filename, so it's never left half written.
+
+    Arguments:
+        session (dict): the settings, with 'contours' (dict of lists of
+                        contours), 'lines' (Strokes) and 'counters'
+                        (Counters), like the dictionaries of old session
+                        files
+    """
+    header = {key: value for key, value in session.items()
+              if key not in ('contours', 'lines', 'counters')}
+    if isinstance(header.get('filename'), bytes):
+        header['filename'] = header['filename'].decode('utf-8')
+    header['format'] = SESSION_FORMAT
+
+    named = normalize_selections(dict(session.get('contours', {})))
+    groups = {group: named.pop(group) for group in SELECTION_GROUPS}
+    groups.update(named)
+    header['contour_groups'] = [[group, len(contours)]
+                                for group, contours in groups.items()]
+    contours = [contour.reshape(-1, 2)
+                for group in groups.values() for contour in group]
+    lengths = np.array([len(contour) for contour in contours], dtype=np.int64)
+    contour_offsets = np.zeros(len(contours) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=contour_offsets[1:])
+    contour_vertices = (np.concatenate(contours).astype(np.int32, copy=False)
+                        if contours else np.empty((0, 2), dtype=np.int32))
+
+    lines = session.get('lines', ())
+    if not isinstance(lines, Strokes):
+        lines = Strokes(lines)
+    counters = session.get('counters', ())
+    if not isinstance(counters, Counters):
+        counters = Counters(counters)
+    header['counter_groups'] = counters.groups
+    records = counters.records
+
+    # numpy scalars, e.g. from sliders, are written as plain numbers
+    encoded = json.dumps(header, default=lambda value: value.item())
+    arrays = {
+        'header': np.frombuffer(encoded.encode('utf-8'), dtype=np.uint8),
+        'contour_vertices': contour_vertices,
+        'contour_offsets': contour_offsets,
+        'line_vertices': lines.vertices[:lines.size],
+        'line_offsets': lines.offsets[:lines.count + 1],
+        'line_thickness': lines.thickness[:lines.count],
+        'line_colors': lines.colors[:lines.count],
+        'line_straight': lines.straight[:lines.count],
+        'counter_points': np.stack((records['x'], records['y']), axis=1),
+        'counter_groups': records['group']
+    }
+    partial = filename + '.partial'
+    try:
+        with open(partial, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(partial, filename)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+def read_session(filename):
+    """
+    Reads a session file, binary or written by versions before the binary
+    format as a literal dictionary. For the latter, the binary session it
+    was migrated to (see migrated_filename) is read instead if it's as new.
+    The edits in a journal next to a binary session that were made after
+    it was written are replayed over it, see EditJournal.
+
+    Returns:
+        session (dict): the settings, with 'contours' (dict of lists of
+                        contours), 'lines' (Strokes) and 'counters' (Counters)
+
+    Raises:
+        ValueError: the file isn't a session of a format this version reads
+    """
+    with open(filename, 'rb') as f:
+        binary = f.read(2) == b'PK' # npz archives are zip files
+    migrated = migrated_filename(filename)
+    if not binary and not (os.path.exists(migrated) and
+                           os.path.getmtime(migrated) >=
+                           os.path.getmtime(filename)):
+        session = read_legacy_session(filename)
+        session['lines'] = Strokes(session.get('lines', []))
+        session['counters'] = Counters(session.get('counters', []))
+        return session
+    if not binary:
+        filename = migrated
+
+    with np.load(filename, allow_pickle=False) as archive:
+        session = json.loads(archive['header'].tobytes().decode('utf-8'))
+        if session.get('format', 0) > SESSION_FORMAT:
+            raise ValueError('session file format {} is newer than {}'.format(
+                session['format'], SESSION_FORMAT))
+        vertices = archive['contour_vertices'].reshape(-1, 1, 2)
+        offsets = archive['contour_offsets'].tolist()
+        session['lines'] = Strokes.from_arrays(
+            archive['line_vertices'], archive['line_offsets'],
+            archive['line_thickness'], archive['line_colors'],
+            archive['line_straight'])
+        session['counters'] = Counters.from_arrays(
+            archive['counter_points'], archive['counter_groups'],
+            session.pop('counter_groups'))
+
+    # the contours are views of one buffer, in their groups in order
+    contours = [vertices[start:end]
+                for start, end in zip(offsets[:-1], offsets[1:])]
+    session['contours'] = {}
+    first = 0
+    for group, count in session.pop('contour_groups'):
+        session['contours'][group] = contours[first:first + count]
+        first += count
+    replay_journal(session, journal_filename(filename))
+    return session
+
+# array(...) calls and numpy scalars in the text of old session files
+LEGACY_ARRAY = re.compile(r'(?:np\.)?array\((\[[^()]*?\])'
+                          r'((?:,\s*\w+=(?:\([^()]*\)|[\w.]+))*)\)')
+LEGACY_SCALAR = re.compile(r'np\.(?:u?int\d*|float\d*|bool_|str_|bytes_)'
+                           r'\(([^()]*)\)')
+LEGACY_POINTS = re.compile(r'\[\(-?\d+, -?\d+\)(?:, \(-?\d+, -?\d+\))*\]')
+LEGACY_PLACEHOLDER = '\x00array' # marks where the arrays were, see below
+
+def parse_legacy_array(body, arguments):
+    """
+    Parses the text of an array printed by numpy without evaluating it
+
+    Arguments:
+        body (str): the nested lists, e.g. '[[[1, 2]],\n\n [[3, 4]]]'
+        arguments (str): the keyword arguments after them, e.g.
+                         ', dtype=int32'
+
+    Returns:
+        array (np.array): the array
+    """
+    keywords = dict(re.findall(r'(\w+)=(\([^()]*\)|[\w.]+)', arguments))
+    if '...' in body:
+        raise ValueError('array was written summarized')
+    numbers = body.translate({ord('['): ' ', ord(']'): ' ', ord(','): ' '})
+    dtype = keywords.get('dtype', 'float64' if re.search('[.e]', numbers)
+                         else 'int64')
+    dtype = np.dtype(dtype.split('.')[-1])
+    values = np.array(numbers.split(), dtype=np.float64 if dtype.kind == 'f'
+                      else np.int64).astype(dtype)
+    if 'shape' in keywords:
+        shape = tuple(int(size) for size in
+                      keywords['shape'].strip('()').split(',') if size.strip())
+        return values.reshape(shape)
+    # the number of lists at each depth follows from the runs of closing
+    # brackets, a run of k closes the innermost list and k - 1 around it
+    depth = len(body) - len(body.lstrip('['))
+    runs = np.bincount([len(run) for run in re.findall(r'\]+', body)],
+                       minlength=depth + 1)
+    closed = np.cumsum(runs[::-1])[::-1] # runs of at least k brackets
+    lists = closed[depth:0:-1] # lists at depth 1 to depth
+    shape = [int(inner // outer) for outer, inner in zip(lists, lists[1:])]
+    shape.append(len(values) // int(lists[-1]) if lists[-1] else 0)
+    return values.reshape(shape)
+
+def parse_legacy_session(text):
+    """
+    Parses the text of a session file written as a literal dictionary by the
+    versions before the binary format, without evaluating any code
+
+    Returns:
+        session (dict): as it was written, with lists for the lines and
+                        counters, except that the points of freehand lines
+                        are (N, 2) arrays
+
+    Raises:
+        ValueError: text isn't a session file
+    """
+    arrays = []
+    def take_array(match):
+        arrays.append(parse_legacy_array(match.group(1), match.group(2)))
+        return repr((LEGACY_PLACEHOLDER, len(arrays) - 1))
+    def take_points(match):
+        arrays.append(np.array(re.findall(r'-?\d+', match.group(0)),
+                               dtype=np.int64).reshape(-1, 2))
+        return repr((LEGACY_PLACEHOLDER, len(arrays) - 1))
+    text = LEGACY_ARRAY.sub(take_array, text)
+    text = LEGACY_POINTS.sub(take_points, text)
+    text = LEGACY_SCALAR.sub(r'\1', text)
+    try:
+        session = ast.literal_eval(text.strip())
+    except (SyntaxError, MemoryError, RecursionError) as e:
+        raise ValueError('not a session file: {}'.format(e))
+    if not isinstance(session, dict):
+        raise ValueError('not a session file')
+
+    def restore(value):
+        """Puts the arrays back in place of their placeholders"""
+        if isinstance(value, tuple) and value[:1] == (LEGACY_PLACEHOLDER,):
+            return arrays[value[1]]
+        if isinstance(value, dict):
+            return {key: restore(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)) and any(
+                isinstance(item, (list, tuple, dict)) for item in value):
+            return type(value)(restore(item) for item in value)
+        return value
+    return restore(session) if arrays else session
+
+def read_legacy_session(filename):
+    """
+    Reads a session file written as a literal dictionary by the versions
+    before the binary format, see parse_legacy_session
+    """
+    with open(filename, 'r') as f:
+        return parse_legacy_session(f.read())
+
+def migrated_filename(legacy_filename):
+    """
+    Returns the filename a session file of the versions before the binary
+    format is migrated to, next to it with the extension .npz
+    """
+    return os.path.splitext(legacy_filename)[0] + '.npz'
+
+def convert_session(legacy_filename, filename=None):
+    """
+    Rewrites a session file of the versions before the binary format as a
+    binary session file, see write_session
+
+    Arguments:
+        legacy_filename (str): the session file to convert
+        filename (str): where to write it, migrated_filename by default
+
+    Returns:
+        session (dict): the session converted, with the selection groups
+                        renamed as in normalize_selections
+
+    Raises:
+        ValueError: the file isn't a session of a compatible version
+    """
+    session = read_legacy_session(legacy_filename)
+    if session.get('version') not in COMPATIBLE_VERSIONS:
+        raise ValueError('incompatible version {}'.format(
+            session.get('version')))
+    session['contours'] = normalize_selections(session.get('contours', {}))
+    write_session(filename or migrated_filename(legacy_filename), session)
+    return session
+
+def journal_filename(session_filename):
+    """
+    Returns the journal of the edits made after a session file was written,
+    next to it with the extension .journal, see EditJournal
+    """
+    return os.path.splitext(session_filename)[0] + '.journal'
+
+def encode_edit(edit):
+    """
+    Splits edit (tuple, see apply_edit) into its fields (list), which can
+    be written as JSON, and its arrays (list), see decode_edit
+    """
+    kind = edit[0]
+    if kind == 'contours':
+        _kind, group, index, count, contours = edit
+        return [kind, group, index, count], list(contours)
+    if kind == 'lines':
+        fields, arrays = [kind], []
+        for index, count, lines in edit[1]:
+            fields.append([index, count])
+            arrays += [lines.vertices[:lines.size],
+                       lines.offsets[:lines.count + 1],
+                       lines.thickness[:lines.count],
+                       lines.colors[:lines.count],
+                       lines.straight[:lines.count]]
+        return fields, arrays
+    positions = np.asarray(edit[1], dtype=np.int64)
+    if kind == 'insert counters':
+        counters = edit[2]
+        return ([kind, counters.groups],
+                [positions, counters.points, counters.records['group']])
+    return [kind], [positions]
+
+def decode_edit(fields, arrays):
+    """Puts an edit (tuple) back together from the output of encode_edit"""
+    kind = fields[0]
+    if kind == 'contours':
+        _kind, group, index, count = fields
+        return (kind, group, index, count, arrays)
+    if kind == 'lines':
+        return (kind, [(index, count, Strokes.from_arrays(*arrays[5 * i:
+                                                                  5 * i + 5]))
+                       for i, (index, count) in enumerate(fields[1:])])
+    if kind == 'insert counters':
+        positions, points, codes = arrays
+        return (kind, positions, Counters.from_arrays(points, codes,
+                                                      fields[1]))
+    if kind == 'remove counters':
+        return (kind, arrays[0])
+    raise ValueError('unknown edit {!r}'.format(kind))
+
+class EditJournal:
+    """
+    An append-only file of the edits (see apply_edit) made to a session
+    since its last checkpoint, a session file written with the name of the
+    journal's session and the number of the last edit it holds in its
+    'journal' entry (see replay_journal). Each edit is written as it's made,
+    so the cost follows what changed rather than the size of the session,
+    and a crash loses at most the edit being written: read_session replays
+    the rest over the checkpoint.
+
+    The file starts with a line of JSON naming the session, then each edit
+    is a record of its length and crc32, the JSON of its fields and the
+    bytes of its arrays. A record cut short fails its check and ends the
+    journal.
+    """
+    MAGIC = b'MyelTracer journal\n'
+    PREFIX = struct.Struct('<II') # length and crc32 of a record
+    FIELDS = struct.Struct('<I') # length of the JSON in a record
+
+    def __init__(self, filename, session=None):
+        """
+        Starts a journal, replacing filename if it exists
+
+        Arguments:
+            filename (str): the journal file, see journal_filename
+            session (str): names the session, so that the journal is only
+                           replayed over its own checkpoints, a new name
+                           (see new_session) by default
+        """
+        self.filename = filename
+        self.session = session or self.new_session()
+        self.header = self.MAGIC + json.dumps({
+            'format': JOURNAL_FORMAT, 'session': self.session
+        }).encode('utf-8') + b'\n'
+        self.starts = [] # (seq, offset in the file) of each record
+        self.nbytes = 0 # the size of the records
+        self.file = open(filename, 'wb')
+        self.file.write(self.header)
+        self.file.flush()
+
+    @staticmethod
+    def new_session():
+        """Returns a new name for a session, e.g. for its first checkpoint"""
+        return uuid.uuid4().hex
+
+    def append(self, seq, edit):
+        """Writes edit (tuple), numbered seq (int) in increasing order"""
+        fields, arrays = encode_edit(edit)
+        arrays = [np.ascontiguousarray(array) for array in arrays]
+        self.write({'seq': seq, 'edit': fields,
+                    'arrays': [[array.dtype.str, array.shape]
+                               for array in arrays]}, arrays)
+
+    def write(self, record, arrays=()):
+        """Writes a record of fields (dict) and arrays (list)"""
+        # numpy scalars, e.g. indices, are written as plain numbers
+        encoded = json.dumps(record, default=lambda value: value.item())
+        encoded = encoded.encode('utf-8')
+        payload = b''.join([self.FIELDS.pack(len(encoded)), encoded] +
+                           [array.tobytes() for array in arrays])
+        self.starts.append((record.get('seq'),
+                            len(self.header) + self.nbytes))
+        self.file.write(self.PREFIX.pack(len(payload), zlib.crc32(payload))
+                        + payload)
+        self.file.flush()
+        self.nbytes += self.PREFIX.size + len(payload)
+
+    def checkpoint(self, seq):
+        """
+        Drops the records up to seq (int), once a checkpoint holding them is
+        written. Only the records after it are rewritten.
+        """
+        kept = [(number, offset) for number, offset in self.starts
+                if number > seq]
+        if self.file.closed or len(kept) == len(self.starts):
+            return
+        first = kept[0][1] if kept else len(self.header) + self.nbytes
+        self.file.close()
+        with open(self.filename, 'rb') as f:
+            f.seek(first)
+            tail = f.read()
+        partial = self.filename + '.partial'
+        with open(partial, 'wb') as f:
+            f.write(self.header + tail)
+        os.replace(partial, self.filename)
+        self.starts = [(number, offset - first + len(self.header))
+                       for number, offset in kept]
+        self.nbytes = len(tail)
+        self.file = open(self.filename, 'ab')
+
+    def close(self):
+        """
+        Marks the journal as closed, as opposed to cut short by a crash, and
+        closes the file
+        """
+        if not self.file.closed:
+            self.write({'closed': True})
+            self.file.close()
+
+def read_journal(filename):
+    """
+    Reads a journal, see EditJournal
+
+    Returns:
+        session (str): the session the journal belongs to, None if the file
+                       isn't a journal this version reads
+        records (list): (seq, edit) in the order the edits were made
+        closed (bool): the journal was closed, rather than cut short
+    """
+    with open(filename, 'rb') as f:
+        data = bytearray(f.read())
+    magic = EditJournal.MAGIC
+    end = data.find(b'\n', len(magic))
+    if not data.startswith(magic) or end < 0:
+        return None, [], False
+    try:
+        header = json.loads(data[len(magic):end].decode('utf-8'))
+    except ValueError:
+        return None, [], False
+    if header.get('format', 0) > JOURNAL_FORMAT:
+        return None, [], False
+
+    records = []
+    closed = False
+    view = memoryview(data)
+    offset = end + 1
+    while offset + EditJournal.PREFIX.size <= len(data):
+        length, crc = EditJournal.PREFIX.unpack_from(data, offset)
+        offset += EditJournal.PREFIX.size
+        payload = view[offset:offset + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break # cut short by a crash
+        offset += length
+        (size,) = EditJournal.FIELDS.unpack_from(payload)
+        position = EditJournal.FIELDS.size + size
+        record = json.loads(payload[EditJournal.FIELDS.size:position]
+                            .tobytes().decode('utf-8'))
+        if record.get('closed'):
+            closed = True
+            break
+        arrays = []
+        for dtype, shape in record['arrays']:
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            arrays.append(np.frombuffer(payload, dtype, count, position)
+                          .reshape(shape).copy())
+            position += count * dtype.itemsize
+        records.append((record['seq'], decode_edit(record['edit'], arrays)))
+    return header.get('session'), records, closed
+
+def replay_journal(session, filename):
+    """
+    Applies the edits of the journal filename (str) made after session
+    (dict, see read_session) was written as its checkpoint
+
+    Returns:
+        replayed (int): the number of edits replayed
+    """
+    checkpoint = session.pop('journal', None)
+    if checkpoint is None or not os.path.exists(filename):
+        return 0
+    journal_session, records, _closed = read_journal(filename)
+    if journal_session != checkpoint['session']:
+        return 0 # a journal of another session, or of a newer version
+    replayed = 0
+    for seq, edit in records:
+        if seq > checkpoint['seq']:
+            apply_edit(session['contours'], session['lines'],
+                       session['counters'], edit)
+            replayed += 1
+    return replayed
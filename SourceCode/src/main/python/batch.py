@@ -0,0 +1,233 @@
+"""
+Headless batch processing for MyelTracer.
+
+Runs the same pipeline as the GUI (load, resize, contour detection, pairing
+and export) over a folder or glob of images on a process pool. Only the
+analysis core is used, so PyQt5 is never imported.
+
+Example:
+    python batch.py "micrographs/*.tif" --threshold 122 --blur 9 --quality 0.7
+
+For every image, a session file saved next to it by MyelTracer
+(<image name>-data.npz, or <image name>-data.txt from older versions) is
+used for the selections, lines and counters if it exists. Otherwise every
+candidate contour within the size limits is exported as a miscellaneous
+feature. Images whose session file can't be read are reported as failed.
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2 as cv
+
+import analysis
+from analysis import COMPATIBLE_VERSIONS
+
+IMAGE_EXTENSIONS = ('.tif', '.tiff', '.png', '.jpg', '.jpeg', '.bmp')
+
+def find_images(inputs):
+    """
+    Expands folders and glob patterns into a sorted list of image files
+
+    Arguments:
+        inputs (list): folders, glob patterns or image filenames
+
+    Returns:
+        images (list): the image files found
+    """
+    images = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = [os.path.join(item, f) for f in os.listdir(item)]
+        else:
+            candidates = glob.glob(item)
+        for candidate in candidates:
+            if (os.path.isfile(candidate) and
+                os.path.splitext(candidate)[-1].lower() in IMAGE_EXTENSIONS):
+                images.add(os.path.abspath(candidate))
+    return sorted(images)
+
+def session_filename(image_filename):
+    """
+    Returns the default session filename MyelTracer uses for an image, or
+    the one older versions used if only that exists
+    """
+    base = os.path.splitext(image_filename)[0]
+    if not os.path.exists(base + '-data.npz') and os.path.exists(
+            base + '-data.txt'):
+        return base + '-data.txt'
+    return base + '-data.npz'
+
+def read_session(filename):
+    """
+    Reads a session file written by MyelTracer
+
+    Returns:
+        import_data (dict): the session, or None if it is missing
+
+    Raises:
+        ValueError: the session file can't be read, or is of an
+                    incompatible version
+    """
+    if not os.path.exists(filename):
+        return None
+    try:
+        import_data = analysis.read_session(filename)
+    except (OSError, ValueError, KeyError) as e:
+        raise ValueError('unreadable session file {} ({}: {})'.format(
+            filename, type(e).__name__, e))
+    if (not isinstance(import_data, dict) or
+        import_data.get('version') not in COMPATIBLE_VERSIONS):
+        raise ValueError('session file {} is of an incompatible '
+                         'version'.format(filename))
+    return import_data
+
+def export_selections(all_features):
+    """
+    Builds the export selection dictionary used by analysis.export
+
+    Arguments:
+        all_features (bool): export every feature, otherwise only the
+                             defaults of the export dialog (diameters)
+    """
+    selections = {}
+    for feature in ('Axon', 'Inner Myelin', 'Outer Myelin', 'Misc.'):
+        selections[feature + ' Perimeter'] = all_features
+        selections[feature + ' Area'] = all_features
+        selections[feature + ' Diameter'] = True
+    selections['g-ratio'] = True
+    selections['Counters'] = True
+    return selections
+
+def process_image(filename, config, output_directory, all_features,
+                  use_sessions):
+    """
+    Runs the full pipeline on a single image. Executed in a worker process.
+
+    Arguments:
+        filename (str): the image to process
+        config (dict): 'threshold', 'blur', 'min_size', 'max_size',
+                       'quality', 'calibration', 'alpha' and 'font_size'
+        output_directory (str): where to write the csv and overlay, or None
+                                to write next to the image
+        all_features (bool): export every feature instead of the defaults
+        use_sessions (bool): use saved sessions for selections if found
+
+    Returns:
+        (filename, wall time in seconds, number of features, error or None)
+    """
+    start = time.perf_counter()
+    cv.setNumThreads(1) # one image per core, don't oversubscribe
+    try:
+        import_data = None
+        if use_sessions:
+            import_data = read_session(session_filename(filename))
+        settings = dict(config, correction_scaling=1.00)
+        if import_data:
+            for key in ('quality', 'calibration', 'alpha', 'font_size'):
+                if key in import_data:
+                    settings[key] = import_data[key]
+
+        image = analysis.adjust_image(analysis.load_image(filename),
+                                      settings['quality'])
+        if import_data:
+            saved_contours = analysis.normalize_selections(
+                import_data.get('contours', {}))
+            counters = import_data.get('counters', [])
+        else:
+            saved_contours = analysis.empty_selections()
+            saved_contours[analysis.MISC] = analysis.segment(image, config)
+            counters = []
+        pairing = analysis.pair(saved_contours)
+
+        directory = output_directory or os.path.dirname(filename)
+        analysis.export(directory, filename, image, pairing,
+                        saved_contours[analysis.MISC], counters,
+                        export_selections(all_features), settings)
+        num_features = (len(pairing.pairs) + len(pairing.pairless)
+                        + len(saved_contours[analysis.MISC]))
+        error = None
+    except Exception as e:
+        num_features = 0
+        error = '{}: {}'.format(type(e).__name__, e)
+    return filename, time.perf_counter() - start, num_features, error
+
+def parse_args(argv):
+    """Parses the command line arguments"""
+    parser = argparse.ArgumentParser(
+        description='Run the MyelTracer pipeline over a batch of images')
+    parser.add_argument('inputs', nargs='+',
+                        help='image files, folders or glob patterns')
+    parser.add_argument('-o', '--output', default=None,
+                        help='directory for the exported files (defaults to '
+                             'the folder of each image)')
+    parser.add_argument('--threshold', type=int, default=122)
+    parser.add_argument('--blur', type=int, default=9)
+    parser.add_argument('--min-size', type=int, default=31**2,
+                        help='minimum contour area in pixels')
+    parser.add_argument('--max-size', type=int, default=223**2,
+                        help='maximum contour area in pixels')
+    parser.add_argument('--quality', type=float, default=0.7,
+                        help='image import scale, between 0.5 and 1')
+    parser.add_argument('--calibration', type=float, default=0.003951,
+                        help='calibration in um/px')
+    parser.add_argument('--all-features', action='store_true',
+                        help='export perimeter and area as well as diameter')
+    parser.add_argument('--ignore-sessions', action='store_true',
+                        help="don't use saved sessions next to the images")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes')
+    return parser.parse_args(argv)
+
+def run(argv=None):
+    """Command line entry point, returns the process exit code"""
+    args = parse_args(argv)
+    images = find_images(args.inputs)
+    if not images:
+        print('No images found')
+        return 1
+    if args.output and not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    config = {
+        'threshold': args.threshold,
+        'blur': args.blur,
+        'min_size': args.min_size,
+        'max_size': args.max_size,
+        'alpha': 0.4,
+        'calibration': args.calibration,
+        'quality': args.quality,
+        'font_size': 2
+    }
+
+    print('Processing {} images on {} workers'.format(len(images),
+                                                      args.workers))
+    failures = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(process_image, filename, config,
+                                   args.output, args.all_features,
+                                   not args.ignore_sessions)
+                   for filename in images]
+        for future in as_completed(futures):
+            filename, elapsed, num_features, error = future.result()
+            if error:
+                failures.append((filename, error))
+                print('FAILED {} ({:.2f} s): {}'.format(filename, elapsed,
+                                                        error))
+            else:
+                print('{} ({:.2f} s, {} features)'.format(filename, elapsed,
+                                                         num_features))
+    total = time.perf_counter() - start
+
+    processed = len(images) - len(failures)
+    print('Processed {} of {} images in {:.2f} s ({:.1f} images/minute)'
+          .format(processed, len(images), total,
+                  processed / total * 60 if total > 0 else 0))
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(run())
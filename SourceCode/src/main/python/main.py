@@ -1,33 +1,24 @@
 import numpy as np
-from numpy import array, int32
 import cv2 as cv
 import sys
 import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
 from os import path
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 from PyQt5.QtCore import *
+from PyQt5 import sip
 from enum import Enum
-from math import sqrt, pi
+from math import sqrt
 from fbs_runtime.application_context.PyQt5 import ApplicationContext
+import analysis
+from analysis import Colors, COMPATIBLE_VERSIONS
 
 # Current version of the software
 __version__ = '1.4.0'
-COMPATIBLE_VERSIONS = [
-    '0.1',
-    '0.2',
-    '0.3',
-    '0.4',
-    '0.5',
-    '0.6',
-    '0.7',
-    '1.0',
-    '1.1',
-    '1.2',
-    '1.3',
-    '1.3.1',
-    '1.4.0'
-]
 
 class ToolMode(Enum):
     """This enum indicates the current selected mode of operation"""
@@ -44,23 +35,6 @@ class ToolMode(Enum):
     COUNT_UNMYEL = 'R' # counts unmyelinated axons
     COUNT_MYEL = 'T' # counts myelinated axons
 
-class Colors(Enum):
-    """These are colors for use within the software"""
-    WHITE = (255, 255, 255)
-    BLACK = (0, 0, 0)
-    RED = (0, 0, 255)
-    GREEN = (0, 255, 0)
-    BLUE = (255, 0, 0)
-    YELLOW = (0, 255, 255)
-    PINK = (228, 20, 255)
-    PURPLE = (255, 20, 232)
-    LIME = (5, 247, 150)
-    RED_HIGHLIGHT = (135, 135, 255)
-    GREEN_HIGHLIGHT = (138, 255, 175)
-    CYAN_HIGHLIGHT = (241, 245, 132)
-    ORANGE_HIGHLIGHT = (0, 153, 255)
-    YELLOW_HIGHLIGHT = (128, 251, 255)
-
 class Quality(Enum):
     """Quality options for image import"""
     ORIGINAL = 1
@@ -74,6 +48,9 @@ image_file_extensions = 'All Files (*);;TIF Files (*.tif);;PNG Files (*.png);;'
 
 class MainWindow(QMainWindow):
     """This is the main UI container"""
+    # size of the edit journal past which autosave writes a checkpoint
+    JOURNAL_CHECKPOINT_BYTES = 4 * 2**20
+
     def __init__(self):
         super().__init__()
         self.initUI()
@@ -217,6 +194,13 @@ class MainWindow(QMainWindow):
         self.dec_thresh_menu_item = self.add_menu_item(
             'Decrement Threshold', Qt.Key_Left, 'Decrease boundary threshold',
             self.image_view.threshold_slider.decrement, self.threshold_sub_menu)
+        # --Cache Threshold Levels
+        self.threshold_sweep_menu_item = self.add_menu_item(
+            'Cache Threshold Levels', None,
+            'Keep the contours of visited thresholds for instant slider changes',
+            self.image_view.set_threshold_sweep, self.threshold_sub_menu,
+            checkable=True)
+        self.threshold_sweep_menu_item.setChecked(True)
         # -Smoothing
         self.smoothing_sub_menu = QMenu('Smoothing', self)
         self.tool_menu.addMenu(self.smoothing_sub_menu)
@@ -302,6 +286,7 @@ class MainWindow(QMainWindow):
         self.directory = os.path.join(os.path.expanduser("~")) # for autosaves
 
         # Setup the autosave timer
+        self.session_writer = SessionWriter(self.autosaved)
         self.timer = QTimer(self)
         self.timer.setInterval(5 * 60 * 1000) # convert 5 mins to milliseconds
         self.timer.timeout.connect(self.autosave)
@@ -359,6 +344,7 @@ class MainWindow(QMainWindow):
                 print(e)
                 return
             self.enable_menu(self.filename)
+            self.start_journal()
 
     def enable_menu(self, filename):
         """Rename window and enable menus for editing"""
@@ -543,8 +529,8 @@ class MainWindow(QMainWindow):
         options |= QFileDialog.DontUseNativeDialog
         save_filename, _extensions = QFileDialog.getSaveFileName(
             self, 'Save Data as...',
-            self.directory + '/'+ self.image_view.get_filename() + '-data.txt',
-            'Data file (*.txt)', options=options)
+            self.directory + '/'+ self.image_view.get_filename() + '-data.npz',
+            'Data file (*.npz)', options=options)
         if save_filename:
             try:
                 self.image_view.save(save_filename)
@@ -575,30 +561,111 @@ class MainWindow(QMainWindow):
         else:
             self.save_as()
 
-    @pyqtSlot()
-    def autosave(self):
-        """Automatically saves file as a backup in root directory"""
+    def backup_filename(self):
+        """Returns the backup file of the current image, or None"""
+        if not self.image_view.get_filename():
+            return None
         autosave_path = self.directory + '/myeltracer-backups'
         if not os.path.isdir(autosave_path):
             os.makedirs(autosave_path)
-        if self.image_view.get_filename():
-            autosave_filename = (autosave_path 
-                                 + '/' + self.image_view.get_filename() 
-                                 + '-data-backup.txt')
-            try:
-                self.image_view.save(autosave_filename)
-                print('saved successfully as',autosave_filename)
-            except PermissionError as e:
-                print('failed to autosave to {}'.format(autosave_filename))
-                pass
+        return (autosave_path + '/' + self.image_view.get_filename()
+                + '-data-backup.npz')
+
+    def start_journal(self, opened=None):
+        """
+        Starts journaling the edits of the current session next to its
+        backup, once the backup is written as the first checkpoint. The old
+        journal is only replaced then, so edits just recovered from it are
+        never lost. A journal left by a crash is kept with its checkpoint as
+        <image name>-data-backup-previous.npz, unless the backup itself is
+        the session opened.
+
+        Arguments:
+            opened (str): the session file opened, if any
+        """
+        backup = self.backup_filename()
+        if not backup:
+            return
+        journal = analysis.journal_filename(backup)
+        recovered = (opened and path.exists(backup) and
+                     path.samefile(opened, backup))
+        # the editor's own journal is closed rather than taken for a crash,
+        # e.g. when a session is opened without its image
+        self.image_view.editor.close_journal()
+        # an autosave still being written would land over the checkpoint
+        self.session_writer.wait()
+        try:
+            if path.exists(journal) and not recovered:
+                _session, records, closed = analysis.read_journal(journal)
+                if records and not closed:
+                    previous = path.splitext(backup)[0] + '-previous.npz'
+                    if path.exists(backup):
+                        os.replace(backup, previous)
+                    os.replace(journal, analysis.journal_filename(previous))
+                    print('edits left by a crash kept in', previous)
+            journal_session = analysis.EditJournal.new_session()
+            _seq, session = self.image_view.checkpoint_session(
+                journal_session)
+            analysis.write_session(backup, session)
+            self.image_view.editor.start_journal(journal, journal_session)
+        except OSError as e:
+            print('failed to start the journal {}: {}'.format(journal, e))
 
+    @pyqtSlot()
+    def autosave(self):
+        """
+        Backs up the session in the root directory. With a journal (see
+        start_journal), edits are backed up as they're made, and the session
+        is only written as a checkpoint once the journal has grown past
+        JOURNAL_CHECKPOINT_BYTES. Without one, it's
+        written if it changed since it was last saved. The session is
+        copied here and written on a background thread.
+        """
+        autosave_filename = self.backup_filename()
+        if not autosave_filename:
+            return
+        journal = self.image_view.editor.journal
+        if journal:
+            if journal.nbytes > self.JOURNAL_CHECKPOINT_BYTES:
+                seq, session = self.image_view.checkpoint_session()
+                self.session_writer.write(
+                    autosave_filename, session,
+                    lambda: journal.checkpoint(seq))
+            return
+        unsaved = self.image_view.unsaved_session()
+        if unsaved:
+            editor, key, session = unsaved
+            self.session_writer.write(
+                autosave_filename, session,
+                lambda: setattr(editor, 'saved_key', key))
+
+    def autosaved(self, filename, done, error):
+        """
+        Called on the GUI thread when an autosave is written
+
+        Arguments:
+            filename (str): the backup file
+            done (function): marks what was saved as backed up
+            error (Exception): what went wrong, or None
+        """
+        if error is None:
+            done()
+            print('saved successfully as',filename)
+        else:
+            print('failed to autosave to {}: {}'.format(filename, error))
+
+    def closeEvent(self, event):
+        """Closes the journal, so it isn't taken for one left by a crash"""
+        if self.image_view.editor:
+            self.image_view.editor.close_journal()
+        super(MainWindow, self).closeEvent(event)
 
     def open(self):
         options = QFileDialog.Options()
         options |= QFileDialog.DontUseNativeDialog
         self.filename, _extensions = QFileDialog.getOpenFileName(
-            win, 'Open data file', self.directory, filter='Data file (*.txt)',
-            options=options)
+            win, 'Open data file', self.directory,
+            filter='Data file (*.npz *.txt)', options=options)
         if not self.filename:
             return
         
@@ -617,8 +684,14 @@ class MainWindow(QMainWindow):
             else:
                 if feedback != 'success':
                     self.enable_menu(feedback)
+                self.start_journal(self.filename)
                 message = "File successfully opened."
-                self.save_filename = self.filename
+                # sessions of older versions are kept as they are, saving
+                # asks where to write the binary session
+                if path.splitext(self.filename)[-1].lower() == '.npz':
+                    self.save_filename = self.filename
+                else:
+                    self.save_filename = None
                 return
         else:
             message = "<font color='red'><b>Failed to open file.</b></font> \
@@ -665,6 +738,101 @@ class MainWindow(QMainWindow):
         """Pass keypresses to the canvas"""
         self.image_view.handle_key(event.key())
 
+class TiledImageItem(QGraphicsItem):
+    """
+    Displays an opencv image as a grid of tile pixmaps. When the image
+    changes, only the pixmaps of the tiles that changed are replaced, and the
+    view only paints the tiles that are visible. The image isn't copied, the
+    pixmaps are made straight from it. An image drawn at a fraction of the
+    photo's resolution is shown scaled up to the photo's size.
+    """
+    TILE_SIZE = 256
+
+    def __init__(self, parent=None):
+        super(TiledImageItem, self).__init__(parent)
+        self.setFlag(QGraphicsItem.ItemHasNoContents)
+        self._shape = None # shape of the image displayed
+        self._scale = 1 # photo pixels per image pixel
+        self._tiles = {} # (x, y) of a tile: its QGraphicsPixmapItem
+
+    def isEmpty(self):
+        """Check if an image is displayed"""
+        return self._shape is None
+
+    def boundingRect(self):
+        if self._shape is None:
+            return QRectF()
+        height, width = self._shape[:2]
+        return QRectF(0, 0, width * self._scale, height * self._scale)
+
+    def paint(self, painter, option, widget=None):
+        pass
+
+    def imageScale(self):
+        """Returns the number of photo pixels per pixel of the image shown"""
+        return self._scale
+
+    @staticmethod
+    def tiles(shape, region=None):
+        """
+        Returns the boxes (x0, y0, x1, y1) of the tiles that overlap region
+
+        Arguments:
+            shape (tuple): the shape of the image
+            region (tuple): a box (x0, y0, x1, y1), or None for every tile
+        """
+        height, width = shape[:2]
+        size = TiledImageItem.TILE_SIZE
+        if region is None:
+            region = (0, 0, width, height)
+        x0, y0, x1, y1 = region
+        return [(x, y, min(x + size, width), min(y + size, height))
+                for y in range(max(y0, 0) // size * size, min(y1, height),
+                               size)
+                for x in range(max(x0, 0) // size * size, min(x1, width),
+                               size)]
+
+    def setImage(self, image=None, tiles=None, scale=1):
+        """
+        Displays image
+
+        Arguments:
+            image (np.array): the opencv image to display, or None to clear
+            tiles (list): the boxes (x0, y0, x1, y1) of the tiles that changed
+                          since the last image, see tiles, or None for all
+            scale (int): the photo pixels per pixel of image
+        """
+        if image is None or self._shape != image.shape or \
+           self._scale != scale:
+            self.prepareGeometryChange()
+            for tile in self._tiles.values():
+                tile.setParentItem(None)
+                if tile.scene():
+                    tile.scene().removeItem(tile)
+            self._tiles = {}
+            self._shape = None
+            if image is None:
+                return
+            self._shape = image.shape
+            self._scale = scale
+            tiles = None
+        if tiles is None:
+            tiles = self.tiles(image.shape)
+
+        for x0, y0, x1, y1 in tiles:
+            # QImage over the tile in place, the pixmap is its only copy
+            pixmap = QPixmap.fromImage(QImage(
+                sip.voidptr(image[y0:y1, x0:x1].ctypes.data), x1 - x0,
+                y1 - y0, image.strides[0], QImage.Format_BGR888))
+            item = self._tiles.get((x0, y0))
+            if item is None:
+                item = QGraphicsPixmapItem(pixmap, self)
+                item.setPos(x0 * scale, y0 * scale)
+                item.setScale(scale)
+                self._tiles[(x0, y0)] = item
+            else:
+                item.setPixmap(pixmap)
+
 class PhotoViewer(QGraphicsView):
     """
     This is a modified version of what's found here:
@@ -676,6 +844,7 @@ class PhotoViewer(QGraphicsView):
     photoHovered = pyqtSignal(QPoint)
     keyPressed = pyqtSignal(int)
     keyReleased = pyqtSignal(int)
+    viewChanged = pyqtSignal(QRectF, float) # visible rect of photo, zoom
 
     def __init__(self, parent):
         """
@@ -686,8 +855,13 @@ class PhotoViewer(QGraphicsView):
         self._zoom = 0
         self._empty = True
         self._scene = QGraphicsScene(self)
-        self._photo = QGraphicsPixmapItem()
+        self._photo = TiledImageItem()
         self._scene.addItem(self._photo)
+        # Cursor previews are shown in a small item over the photo, so that
+        # moving them doesn't replace the whole photo
+        self._preview = QGraphicsPixmapItem(self._photo)
+        self._preview.setZValue(1) # over the tiles
+        self._preview.setVisible(False)
         self.setScene(self._scene)
         self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
         self.setResizeAnchor(QGraphicsView.AnchorUnderMouse)
@@ -705,38 +879,69 @@ class PhotoViewer(QGraphicsView):
 
     def fitInView(self):
         """Resizes photo to fit the view"""
-        rect = QRectF(self._photo.pixmap().rect())
+        rect = self._photo.boundingRect()
         if not rect.isNull():
             self.setSceneRect(rect)
             if self.hasPhoto():
                 unity = self.transform().mapRect(QRectF(0, 0, 1, 1))
                 self.scale(1 / unity.width(), 1 / unity.height())
-                viewrect = self.viewport().rect()
                 scenerect = self.transform().mapRect(rect)
-                factor = min(viewrect.width() / scenerect.width(),
-                             viewrect.height() / scenerect.height())
+                factor = self.fitScale(scenerect.width(), scenerect.height())
                 self.scale(factor, factor)
             self._zoom = 0
+        self.emitViewChanged()
+
+    def fitScale(self, width, height):
+        """Returns the scale fitInView shows a photo of width x height at"""
+        viewrect = self.viewport().rect()
+        return min(viewrect.width() / width, viewrect.height() / height)
 
-    def setPhoto(self, pixmap=None, new_image=True):
+    def emitViewChanged(self):
+        """Emits viewChanged with the part of the photo in view"""
+        if not self.hasPhoto():
+            return
+        visible = self.mapToScene(self.viewport().rect()).boundingRect()
+        self.viewChanged.emit(visible & self._photo.boundingRect(),
+                              self.transform().m11())
+
+    def setPhoto(self, image=None, new_image=True, tiles=None, scale=1):
         """
         Loads the photo into the view
 
         Arguments:
-            pixmap (QPixmap): the photo to display
+            image (np.array): the opencv image to display
             new_image (bool): is this the first time this image is shown?
+            tiles (list): the boxes (x0, y0, x1, y1) of the tiles of the
+                          image that changed, or None for all of them
+            scale (int): the photo pixels per pixel of image, for an image
+                         drawn at a fraction of the photo's resolution
         """
         if new_image:
             self._zoom = 0
-        if pixmap and not pixmap.isNull():
-            self._empty = False
-            self._photo.setPixmap(pixmap)
-        else:
-            self._empty = True
-            self._photo.setPixmap(QPixmap())
+        self._preview.setVisible(False)
+        self._photo.setImage(image, tiles, scale)
+        self._empty = self._photo.isEmpty()
         if new_image:
             self.fitInView()
 
+    def setPreview(self, pixmap=None, x=0, y=0):
+        """
+        Shows a region of the photo in place of the photo
+
+        Arguments:
+            pixmap (QPixmap): the region to display, or None to hide it
+            x (int): the column of the region in the image shown
+            y (int): the row of the region in the image shown
+        """
+        if pixmap and not pixmap.isNull():
+            scale = self._photo.imageScale()
+            self._preview.setPixmap(pixmap)
+            self._preview.setPos(x * scale, y * scale)
+            self._preview.setScale(scale)
+            self._preview.setVisible(True)
+        else:
+            self._preview.setVisible(False)
+
     def zoomIn(self):
         """Zoom in on the image"""
         self._factor = 1.25
@@ -753,6 +958,7 @@ class PhotoViewer(QGraphicsView):
         """Apply the current zoom value, or reset the view"""
         if self._zoom > 0:
             self.scale(self._factor, self._factor)
+            self.emitViewChanged()
         elif self._zoom == 0:
             self.fitInView()
         else:
@@ -766,6 +972,16 @@ class PhotoViewer(QGraphicsView):
             else:
                 self.zoomOut()
 
+    def scrollContentsBy(self, dx, dy):
+        """Reports panning of the view"""
+        super(PhotoViewer, self).scrollContentsBy(dx, dy)
+        self.emitViewChanged()
+
+    def resizeEvent(self, event):
+        """Reports resizing of the view"""
+        super(PhotoViewer, self).resizeEvent(event)
+        self.emitViewChanged()
+
     def setScrollZoomEnabled(self, enabled):
         """Turns on/off the ablility to zoom by scrolling"""
         self._scroll_zoom_enabled = enabled
@@ -1080,10 +1296,24 @@ class DisplayImageWidget(QWidget):
 
         self.viewer = PhotoViewer(self)
         self.editor = None
+        self.updates_held = 0 # depth of updates_suspended blocks
+
+        # Mouse moves are passed to the editor at most once per frame, see
+        # photoHovered
+        self.pending_move = None # (position, modifiers) of the latest move
+        self.button_down = False
+        screen = QGuiApplication.primaryScreen()
+        refresh_rate = screen.refreshRate() if screen else 0
+        self.frame_interval = 1000 / (refresh_rate if refresh_rate > 0 else 60)
+        self.last_frame = 0 # time.perf_counter() of the last frame
+        self.frame_timer = QTimer(self)
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.timeout.connect(self.next_frame)
         
         # Defaults
         self.threshold = 122
         self.blur_value = 9
+        self.threshold_sweep = True
         self.cut_size = 1
         self.draw_size = 2
 
@@ -1304,6 +1534,7 @@ class DisplayImageWidget(QWidget):
         self.viewer.photoClicked.connect(self.photoClicked)
         self.viewer.photoHovered.connect(self.photoHovered)
         self.viewer.photoReleased.connect(self.photoReleased)
+        self.viewer.viewChanged.connect(self.viewChanged)
 
         self.toolbarFrame = QFrame()
         self.toolbarFrame.setLayout(self.toolbar_layout)
@@ -1340,26 +1571,82 @@ class DisplayImageWidget(QWidget):
         """Pass photoClicked event to the editor"""
         if self.viewer.dragMode()  == QGraphicsView.NoDrag:
             if self.editor:
+                self.flush_move()
+                self.button_down = True
                 self.editor.mouse_event(cv.EVENT_LBUTTONDOWN, pos.x(), pos.y(), 
                                         None, None,
                                         QApplication.keyboardModifiers())
 
+    def viewChanged(self, rect, zoom):
+        """Pass the part of the image in view to the editor"""
+        if self.editor:
+            rect = rect.toAlignedRect()
+            self.editor.set_viewport((rect.left(), rect.top(),
+                                      rect.right() + 1, rect.bottom() + 1),
+                                     zoom)
+
     def photoHovered(self, pos):
-        """Pass photoHovered event to the editor"""
+        """
+        Pass photoHovered event to the editor
+
+        Moves are coalesced, only the latest one before each frame is passed
+        on. While the button is down every move is passed on, as strokes,
+        lassos and the eraser use every point, but the editor only renders
+        once per frame.
+        """
         if self.viewer.dragMode() == QGraphicsView.NoDrag:
             if self.editor:
-                self.editor.mouse_event(cv.EVENT_MOUSEMOVE, pos.x(), pos.y(),
-                                        None, None, 
-                                        QApplication.keyboardModifiers())
+                self.pending_move = (pos, QApplication.keyboardModifiers())
+                if self.button_down:
+                    self.flush_move()
+                self.request_frame()
 
     def photoReleased(self, pos):
         """Pass photoReleased event to the editor"""
         if self.viewer.dragMode() == QGraphicsView.NoDrag:
             if self.editor:
+                self.flush_move()
+                self.button_down = False
                 self.editor.mouse_event(cv.EVENT_LBUTTONUP, pos.x(), pos.y(), 
                                         None, None, 
                                         QApplication.keyboardModifiers())
 
+    def flush_move(self):
+        """
+        Passes the pending mouse move to the editor, without rendering it
+        until the next frame
+        """
+        if self.pending_move is None or not self.editor:
+            return
+        pos, modifiers = self.pending_move
+        self.pending_move = None
+        self.editor.hold_frames = True
+        try:
+            self.editor.mouse_event(cv.EVENT_MOUSEMOVE, pos.x(), pos.y(),
+                                    None, None, modifiers)
+        finally:
+            self.editor.hold_frames = False
+
+    def request_frame(self):
+        """Schedules the next frame, at most one per display refresh"""
+        if self.frame_timer.isActive():
+            return
+        elapsed = (time.perf_counter() - self.last_frame) * 1000
+        self.frame_timer.start(int(max(self.frame_interval - elapsed, 0)))
+
+    def next_frame(self):
+        """Passes on the latest mouse move and renders what's held back"""
+        self.last_frame = time.perf_counter()
+        if not self.editor:
+            return
+        if self.pending_move is not None:
+            pos, modifiers = self.pending_move
+            self.pending_move = None
+            self.editor.mouse_event(cv.EVENT_MOUSEMOVE, pos.x(), pos.y(),
+                                    None, None, modifiers)
+        if self.editor.frame_held:
+            self.editor.show()
+
     def new(self, filename, quality):
         """
         Load in an image from a filename
@@ -1380,14 +1667,47 @@ class DisplayImageWidget(QWidget):
             'font_size': self.font_size_slider.value(),
             'line_thickness': self.line_thickness_slider.value(),
             'eraser_size': self.eraser_size_slider.value(),
-            'cur_group': 'Unmyelinated Axons'
+            'cur_group': 'Unmyelinated Axons',
+            'threshold_sweep': self.threshold_sweep
         }
         self.quality = quality
-        self.editor = Axon_Editor(filename, quality, config, self.show_image, 
-                                  self.parent)
-        self.editor.show()
-        self.refit()
-        self.tool_buttons.reset()
+        if self.editor:
+            self.editor.close()
+            self.editor = None # the first frame of the new one changes the view
+        self.pending_move = None
+        self.button_down = False
+        with self.updates_suspended():
+            self.editor = Axon_Editor(filename, quality, config,
+                                      self.show_image, self.parent,
+                                      background=True,
+                                      region_callback=self.show_region,
+                                      suspended=True)
+            self.tool_buttons.reset()
+
+    @contextmanager
+    def updates_suspended(self):
+        """
+        Holds back the frames of the editor, and of any editor created in the
+        block, until the outermost block ends, so that a batch of settings
+        costs a single pass of the pipeline (see Axon_Editor.show) rather
+        than one for each setting
+        """
+        self.updates_held += 1
+        if self.editor:
+            self.editor.hold_frames = True
+        try:
+            yield
+        finally:
+            self.updates_held -= 1
+            if not self.updates_held and self.editor:
+                if self.editor.first_draw:
+                    # the view the first frame is fitted to, so it's drawn
+                    # at the level of detail it's shown at
+                    height, width = self.editor.image_copy.shape[:2]
+                    self.editor.set_viewport((0, 0, width, height),
+                                             self.viewer.fitScale(width,
+                                                                  height))
+                self.editor.resume_updates()
 
     def export(self, directory, export_selections):
         """
@@ -1405,15 +1725,46 @@ class DisplayImageWidget(QWidget):
         if self.editor:
             return self.editor.get_filename()
 
+    def base_info(self):
+        """Returns the settings of this widget that are saved in sessions"""
+        return {
+            'threshold': self.threshold,
+            'cut_size': self.cut_size,
+            'draw_size': self.draw_size
+        }
+
     def save(self, filename):
         """Saves the current session to 'filename' (str)"""
         if self.editor:
-            base_info = {
-                'threshold': self.threshold,
-                'cut_size': self.cut_size,
-                'draw_size': self.draw_size
-            }
-            self.editor.save(filename, base_info)
+            self.editor.save(filename, self.base_info())
+
+    def unsaved_session(self):
+        """
+        Returns (editor, key, session) with a copy of the session (see
+        Axon_Editor.snapshot) if it changed since it was last saved, or None
+        """
+        if not self.editor:
+            return None
+        base_info = self.base_info()
+        key = self.editor.state_key(base_info)
+        if key == self.editor.saved_key:
+            return None
+        return self.editor, key, self.editor.snapshot(base_info)
+
+    def checkpoint_session(self, journal_session=None):
+        """
+        Returns (seq, session) with a copy of the session (see
+        Axon_Editor.snapshot) as a checkpoint of the editor's journal, or
+        of the journal of journal_session (str) about to be started, holding
+        the edits up to seq
+        """
+        seq = self.editor.changes
+        session = self.editor.snapshot(self.base_info())
+        session['journal'] = {
+            'session': journal_session or self.editor.journal.session,
+            'seq': seq
+        }
+        return seq, session
 
     def open(self, filename):
         """
@@ -1431,53 +1782,56 @@ class DisplayImageWidget(QWidget):
         """
         file = None
         try:
-            with open(filename, 'r') as f:
-                import_data = eval(f.read())
+            import_data = analysis.read_session(filename)
         except:
             return None
         if (not 'version' in import_data or 
             not import_data['version'] in COMPATIBLE_VERSIONS):
             return 'incompatible version'
-        if isinstance(import_data, dict):
-            if 'threshold' in import_data:
-                self.threshold_slider.setValue(import_data['threshold'])
-            if 'blur' in import_data:
-                self.set_blur(import_data['blur'])
-            if 'min_size' in import_data:
-                self.min_slider.setValue((import_data['min_size'])**0.5)
-            if 'max_size' in import_data:
-                self.max_slider.setValue((import_data['max_size'])**0.5)
-            if 'alpha' in import_data:
-                self.alpha_slider.setValue(import_data['alpha']*10)
-            if 'calibration' in import_data:
-                self.calibration_input.setText(str(import_data['calibration']))
-            if 'outline_thickness' in import_data:
-                self.outline_thickness_slider.setValue(
-                    import_data['outline_thickness'])
-            if 'font_size' in import_data:
-                self.font_size_slider.setValue(import_data['font_size'])
-            if 'line_thickness' in import_data:
-                self.line_thickness_slider.setValue(
-                    import_data['line_thickness'])
-            if 'eraser_size' in import_data:
-                self.eraser_size_slider.setValue(import_data['eraser_size'])
-            if 'cut_size' in import_data:
-                self.cut_size = import_data['cut_size']
-            if 'draw_size' in import_data:
-                self.draw_size = import_data['draw_size']
-            if 'filename' in import_data and 'quality' in import_data:
-                file = import_data['filename']
-                if isinstance(file, bytes):
-                    file = file.decode('utf-8')
-                quality = import_data['quality']
-                if path.exists(file):
-                    self.new(file, quality)
-                else:
-                    file = None
-        if self.editor:
-            self.editor.open(import_data)
-        else:
-            return 'no image'
+        # the settings are applied at once, then segmented and drawn once
+        with self.updates_suspended():
+            if isinstance(import_data, dict):
+                if 'threshold' in import_data:
+                    self.threshold_slider.setValue(import_data['threshold'])
+                if 'blur' in import_data:
+                    self.set_blur(import_data['blur'])
+                if 'min_size' in import_data:
+                    self.min_slider.setValue((import_data['min_size'])**0.5)
+                if 'max_size' in import_data:
+                    self.max_slider.setValue((import_data['max_size'])**0.5)
+                if 'alpha' in import_data:
+                    self.alpha_slider.setValue(import_data['alpha']*10)
+                if 'calibration' in import_data:
+                    self.calibration_input.setText(
+                        str(import_data['calibration']))
+                if 'outline_thickness' in import_data:
+                    self.outline_thickness_slider.setValue(
+                        import_data['outline_thickness'])
+                if 'font_size' in import_data:
+                    self.font_size_slider.setValue(import_data['font_size'])
+                if 'line_thickness' in import_data:
+                    self.line_thickness_slider.setValue(
+                        import_data['line_thickness'])
+                if 'eraser_size' in import_data:
+                    self.eraser_size_slider.setValue(
+                        import_data['eraser_size'])
+                if 'cut_size' in import_data:
+                    self.cut_size = import_data['cut_size']
+                if 'draw_size' in import_data:
+                    self.draw_size = import_data['draw_size']
+                if 'filename' in import_data and 'quality' in import_data:
+                    file = import_data['filename']
+                    if isinstance(file, bytes):
+                        file = file.decode('utf-8')
+                    quality = import_data['quality']
+                    if path.exists(file):
+                        self.new(file, quality)
+                    else:
+                        file = None
+            if self.editor:
+                self.editor.open(import_data)
+            else:
+                return 'no image'
         if file:
             return file
         return 'success'
@@ -1495,22 +1849,37 @@ class DisplayImageWidget(QWidget):
         self.viewer.zoomOut()
 
     @pyqtSlot()
-    def show_image(self, image, new_image):
+    def show_image(self, image, new_image, tiles=None, scale=1):
         """
         Display the given image
 
         Arguments:
             image (np.array): the opencv image to display
             new_image (bool): is this image entirely new?
+            tiles (list): the boxes (x0, y0, x1, y1) of the tiles of the
+                          image that changed, the rest is left as it is, or
+                          None for all of them
+            scale (int): the pixels of the photo per pixel of image
         """
-        # this is a fix for the slanted lines artifact
-        height, width, _ = np.shape(image)
-        total_bytes = image.data.nbytes
-        bytes_per_line = int(total_bytes/height)
+        self.viewer.setPhoto(image, new_image, tiles, scale)
 
-        self.image = QImage(image.data, width, height, bytes_per_line, 
-                            QImage.Format_RGB888).rgbSwapped()
-        self.viewer.setPhoto(QPixmap.fromImage(self.image), new_image)
+    def show_region(self, image, x, y):
+        """
+        Displays a region of the image over the one shown by show_image
+
+        Arguments:
+            image (np.array): the opencv image of the region, or None to
+                              remove the region
+            x (int): the column of the region in the image
+            y (int): the row of the region in the image
+        """
+        if image is None:
+            self.viewer.setPreview(None)
+            return
+        height, width, _ = np.shape(image)
+        region = QImage(image.data, width, height, image.strides[0],
+                        QImage.Format_BGR888)
+        self.viewer.setPreview(QPixmap.fromImage(region), x, y)
 
     def toggle_outlines(self, value):
         """Set outlines visible/hidden"""
@@ -1549,6 +1918,7 @@ class DisplayImageWidget(QWidget):
 
     def handle_key(self, key):
         """Convert a keypress to a tool button press"""
+        self.flush_move()
         self.press_mode_button(key)
 
     def set_threshold(self, value):
@@ -1563,6 +1933,12 @@ class DisplayImageWidget(QWidget):
         if self.editor:
             self.editor.set_blur(value)
 
+    def set_threshold_sweep(self, value):
+        """Keep the contours of every visited threshold level if value"""
+        self.threshold_sweep = value
+        if self.editor:
+            self.editor.set_threshold_sweep(value)
+
     def set_min(self, value):
         """Set min size to value"""
         if self.editor:
@@ -1684,11 +2060,312 @@ class DisplayImageWidget(QWidget):
         self.line_thickness_frame.hide()
         self.eraser_size_frame.hide()
 
-class Axon_Editor:
-    """This is the OpenCV image processing implementation"""
-    NUM_FEATURES = 3 # number of features to extract
+class Layer:
+    """
+    One overlay of the editor, drawn on its own transparent canvas so it is
+    only redrawn when what it shows changes. The frame is composited from
+    the layers, see Axon_Editor.compose_frame.
+    """
+    def __init__(self):
+        self.key = None # what the layer shows
+        self.sources = () # the objects drawn, alive so ids in key stay unique
+        self.image = None # BGR drawing
+        self.mask = None # 255 where something was drawn
+        self.version = 0 # changes every time the drawing does
 
-    def __init__(self, filename, quality, config, callback, parent):
+    @staticmethod
+    def color(color):
+        """Returns the opaque canvas color for color (BGR)"""
+        return tuple(color) + (255,)
+
+    def update(self, shape, key, sources, draw):
+        """
+        Redraws the layer from scratch if key changed
+
+        Arguments:
+            shape (tuple): the shape of the image the layer is drawn over
+            key (tuple): ids of sources and the parameters they're drawn with
+            sources (tuple): the objects drawn
+            draw (function): draws the layer onto a blank BGRA canvas
+        """
+        if key != self.key:
+            canvas = np.zeros(shape[:2] + (4,), dtype=np.uint8)
+            draw(canvas)
+            self._store(canvas)
+            self.key = key
+            self.sources = sources
+        return self
+
+    def extend(self, key, draw):
+        """Draws on top of the layer, for sources that were appended to"""
+        canvas = np.dstack((self.image, self.mask))
+        draw(canvas)
+        self._store(canvas)
+        self.key = key
+        return self
+
+    def _store(self, canvas):
+        """Splits canvas (BGRA) into the drawing and its mask"""
+        self.image = cv.cvtColor(canvas, cv.COLOR_BGRA2BGR)
+        self.mask = np.ascontiguousarray(canvas[..., 3])
+        self.version += 1
+
+    def paste(self, image, region=(slice(None), slice(None))):
+        """Draws the layer over image (BGR) in place, within region"""
+        cv.copyTo(self.image[region], self.mask[region], image)
+
+class ContourWorker(QObject):
+    """
+    Finds contours on a background thread so the GUI stays responsive.
+
+    Only the most recent request matters: a new request supersedes any
+    pending one and cancels the one in progress, so dragging a slider only
+    segments the latest value. Results are delivered on the GUI thread.
+
+    With a threshold sweep, the levels around the current threshold are
+    segmented while idle, so the next slider steps are already cached.
+    """
+    contoursFound = pyqtSignal(int, object)
+    PREFETCH_RANGE = 8 # thresholds on each side of the current one
+
+    def __init__(self, image, cache, callback):
+        """
+        Arguments:
+            image (np.array): the image to find contours in
+            cache (analysis.PreprocessCache): the preprocessing of image
+            callback (function): receives the contours of the latest request
+        """
+        super(ContourWorker, self).__init__()
+        self.image = image
+        self.cache = cache
+        self.callback = callback
+        self.latest_request = 0
+        self.finished_request = 0
+        self.pending = None # (request id, params) waiting to be processed
+        self.prefetch = [] # (sweep, level) to segment while idle
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.contoursFound.connect(self.deliver)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def request(self, params):
+        """Queues a segmentation with params (dict), replacing older ones"""
+        with self.condition:
+            self.latest_request += 1
+            self.pending = (self.latest_request, params)
+            self.prefetch = []
+            self.condition.notify()
+
+    def is_busy(self):
+        """Returns True if the latest request hasn't been delivered yet"""
+        return self.finished_request != self.latest_request
+
+    def stop(self):
+        """Stops the background thread, dropping any pending request"""
+        with self.condition:
+            self.stopped = True
+            self.pending = None
+            self.prefetch = []
+            self.condition.notify()
+
+    def run(self):
+        """Background thread: segments the latest request, drops the rest"""
+        while True:
+            with self.condition:
+                while (self.pending is None and not self.prefetch
+                       and not self.stopped):
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                if self.pending is None:
+                    sweep, level = self.prefetch.pop(0)
+                    request_id, params = None, None
+                else:
+                    request_id, params = self.pending
+                    self.pending = None
+            if params is None:
+                interrupted = lambda: (self.pending is not None
+                                       or self.stopped)
+                sweep.get_level(level, interrupted)
+                continue
+            superseded = lambda: request_id != self.latest_request
+            contours = analysis.segment(self.image, params, self.cache,
+                                        superseded)
+            if contours is not None and not superseded():
+                self.contoursFound.emit(request_id, contours)
+                if params.get('sweep'):
+                    self.queue_prefetch(request_id, params)
+
+    def queue_prefetch(self, request_id, params):
+        """Queues the uncached levels around the threshold of params"""
+        sweep = self.cache.sweep(params['blur'], params['lines'])
+        threshold = params['threshold']
+        levels = []
+        for offset in range(1, self.PREFETCH_RANGE + 1):
+            for neighbour in (threshold + offset, threshold - offset):
+                if 0 <= neighbour <= 255:
+                    level = analysis.threshold_level(neighbour)
+                    if level not in levels and not sweep.has_level(level):
+                        levels.append(level)
+        with self.condition:
+            if request_id == self.latest_request:
+                self.prefetch = [(sweep, level) for level in levels]
+
+    @pyqtSlot(int, object)
+    def deliver(self, request_id, contours):
+        """Passes finished contours to the callback on the GUI thread"""
+        if request_id == self.latest_request and not self.stopped:
+            self.finished_request = request_id
+            self.callback(contours)
+
+class SessionWriter(QObject):
+    """
+    Writes sessions on a background thread, so autosaving doesn't hold up
+    the GUI. Only the latest session queued matters: one that's waiting
+    when another is queued is dropped. Results are delivered on the GUI
+    thread.
+    """
+    sessionWritten = pyqtSignal(str, object, object)
+
+    def __init__(self, callback):
+        """
+        Arguments:
+            callback (function): receives the filename, the tag passed to
+                                 write, and the exception raised or None,
+                                 once a session is written
+        """
+        super(SessionWriter, self).__init__()
+        self.callback = callback
+        self.pending = None # (filename, session, tag) waiting to be written
+        self.writing = False # a session is being written
+        self.condition = threading.Condition()
+        self.sessionWritten.connect(self.deliver)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, filename, session, tag=None):
+        """
+        Queues session (dict, see analysis.write_session) to be written to
+        filename (str), replacing a session that's still waiting
+        """
+        with self.condition:
+            self.pending = (filename, session, tag)
+            self.condition.notify_all()
+
+    def wait(self):
+        """Blocks until the sessions queued are written"""
+        with self.condition:
+            while self.pending is not None or self.writing:
+                self.condition.wait()
+
+    def run(self):
+        """Background thread: writes the latest session queued"""
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                filename, session, tag = self.pending
+                self.pending = None
+                self.writing = True
+            try:
+                analysis.write_session(filename, session)
+                error = None
+            except Exception as e:
+                error = e
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+            self.sessionWritten.emit(filename, tag, error)
+
+    @pyqtSlot(str, object, object)
+    def deliver(self, filename, tag, error):
+        """Passes the result of a write to the callback on the GUI thread"""
+        self.callback(filename, tag, error)
+
+class EditHistory:
+    """
+    The undo and redo stacks of the editor. Each entry is the list of edits
+    (see Axon_Editor.apply_edit) that takes the session back, or forward,
+    by one action. Entries only hold what the action changed, so the
+    history is bounded by the memory the edits hold rather than by a
+    number of actions: the oldest entries are dropped past max_bytes.
+    """
+    EDIT_BYTES = 64 # rough size of an edit without its contents
+
+    def __init__(self, max_bytes=32 * 2**20):
+        """
+        Arguments:
+            max_bytes (int): the memory the undo and redo entries may hold
+        """
+        self.max_bytes = max_bytes
+        self.undo = deque() # [bytes, edits], oldest first
+        self.redo = deque()
+        self.nbytes = 0
+
+    @staticmethod
+    def edit_bytes(edit):
+        """Returns the memory held by edit (tuple)"""
+        size = EditHistory.EDIT_BYTES
+        if edit[0] == 'contours':
+            size += sum(contour.nbytes for contour in edit[4])
+        elif edit[0] == 'lines':
+            size += sum(lines.nbytes for _index, _count, lines in edit[1])
+        else: # positions, and the counters inserted
+            size += sum(value.nbytes for value in edit[1:])
+        return size
+
+    def push(self, stack, edits):
+        """Adds an entry of edits (list) to the top of stack (deque)"""
+        size = sum(self.edit_bytes(edit) for edit in edits)
+        stack.append([size, edits])
+        self.nbytes += size
+        self.trim()
+
+    def extend(self, edits):
+        """Adds edits (list) to the top undo entry, e.g. while dragging"""
+        size = sum(self.edit_bytes(edit) for edit in edits)
+        self.undo[-1][0] += size
+        self.undo[-1][1] += edits
+        self.nbytes += size
+        self.trim()
+
+    def pop(self, stack):
+        """Removes the top entry of stack (deque) and returns its edits"""
+        size, edits = stack.pop()
+        self.nbytes -= size
+        return edits
+
+    def clear(self, stack=None):
+        """Empties stack (deque), or both stacks"""
+        for cleared in ([stack] if stack is not None else
+                        [self.undo, self.redo]):
+            while cleared:
+                self.pop(cleared)
+
+    def trim(self):
+        """Drops the oldest entries, keeping the newest, past max_bytes"""
+        for stack in (self.undo, self.redo):
+            while self.nbytes > self.max_bytes and len(stack) > 1:
+                size, _edits = stack.popleft()
+                self.nbytes -= size
+
+class Axon_Editor:
+    """
+    This is the interactive editor around the image processing in analysis.py
+    """
+    NUM_FEATURES = analysis.NUM_FEATURES # number of features to extract
+    MIN_LABEL_HEIGHT = 6 # screen pixels, smaller labels aren't drawn
+    # Stages of the show pipeline, and the stages that depend on each of them
+    STAGE_DEPENDENCIES = {
+        'contours': ('render',), # candidate contours: image, blur, threshold,
+                                 # size limits and lines
+        'pairs': ('render',), # pairing of the saved contours: selections
+        'render': () # compositing of the frame: display options, counters
+    }
+
+    def __init__(self, filename, quality, config, callback, parent,
+                 background=False, region_callback=None, suspended=False):
         """
         Arguments:
             filename (str): the file to load the image from
@@ -1696,11 +2373,22 @@ class Axon_Editor:
             config (dict): a variety of parameters to set up the viewport
             callback (function): the function to pass the image to for display
             parent (obj): the parent object of the editor
+            background (bool): find contours on a background thread after
+                               the first frame
+            region_callback (function): the function to pass a region of the
+                                        image and its position to for
+                                        display over the last image, used
+                                        for the tool previews
+            suspended (bool): hold back the first frame until
+                              resume_updates, e.g. to apply the settings of
+                              a session first
         """
         self.quality = quality
         self.filename = filename
         self.callback = callback
+        self.region_callback = region_callback
         self.parent = parent
+        self.worker = None
 
         # Set up the image
         self.load_image(filename)
@@ -1713,36 +2401,37 @@ class Axon_Editor:
         self.first_point = None
         self.second_point = None
         self.hidden_first_point = None
-        self.lines = []
+        self.lines = analysis.Strokes()
         self.drawing = False
         self.last_img = None
+        self.last_img_shown = False # is last_img the image on display?
         self.line_thickness = config['line_thickness']
         # -Dot Tool Variables (counter, eraser)
-        self.counters = []
+        self.counters = analysis.Counters()
         self.cur_point = None
         self.eraser_size = config['eraser_size']
         self.cur_group = config['cur_group']
         # -Contour Tool Variables
         self.cur_contours = []
-        self.saved_contours = {
-            self.mode_to_string(ToolMode.SEL_AXON): [],
-            self.mode_to_string(ToolMode.SEL_MYELIN_IN): [],
-            self.mode_to_string(ToolMode.SEL_MYELIN_OUT): [],
-            self.mode_to_string(ToolMode.SEL_MISC): []
-        }
+        self.candidate_labels = None # analysis.LabelMap of cur_contours
+        self.saved_contours = analysis.empty_selections()
         self.drawn_contour = []
+        # -Spatial indices of the selections
+        self.selection_index = {
+            group: analysis.GridIndex(analysis.contour_bounds)
+            for group in self.saved_contours}
+        self.pairing = analysis.Pairing()
+        self.pairer = analysis.IncrementalPairing()
         self.contour_pairs = []
         self.contour_pairless = []
-        self.contour_pairless_grouped = {
-            self.mode_to_string(ToolMode.SEL_AXON): [],
-            self.mode_to_string(ToolMode.SEL_MYELIN_IN): [],
-            self.mode_to_string(ToolMode.SEL_MYELIN_OUT): []
-        }
+        self.contour_pairless_grouped = self.pairing.pairless_grouped
+        self.contour_table = None # packed selections, see selection_table
         self.highlight_contours = []
         self.threshold = config['threshold']
         self.blur = config['blur']
         self.min_size = config['min_size']
         self.max_size = config['max_size']
+        self.threshold_sweep = config.get('threshold_sweep', False)
         self.correction_scaling = 1.00 # Change this to scale contours
         # -Misc Display Options
         self.display_options = {
@@ -1758,66 +2447,98 @@ class Axon_Editor:
         self.calibration = config['calibration']
 
         # Flags For Drawing in show function
-        self.force_redraw = False
         self.first_draw = True
-        self.redraw_contours = True
+        self.hold_frames = suspended # when set, show only notes a frame is due
+        self.frame_held = False # a frame is due
+        self.dirty = set(self.STAGE_DEPENDENCIES) # stages to recompute
+        self.erased_lines = False
+        # -Render layers, see compose_frame
+        self.layers = {name: Layer() for name in (
+            'candidates', 'outlines', 'fills', 'counters', 'labels', 'lines')}
+        self.base_key = None
+        self.base_image = None
+        # (key, overlay image, blended image, tiles not blended yet)
+        self.blend = (None, None, None, None)
+        # (key of the annotations, tiles not composited with them yet)
+        self.composed = (None, None)
+        self.frame = None # the frame (BGR), composited and displayed in place
+        self.frame_tiles = set() # tiles of the frame changed since displayed
+        self.hovered = None # box of the hovered highlights in the frame
+        # -Part of the image in view (x0, y0, x1, y1), None for all of it,
+        #  and the scale it's viewed at
+        self.viewport = None
+        self.zoom = 1.0
 
         # Undo and Redo History
-        self.undo_history = []
-        self.redo_history = []
-        self.undo_history_len = 30
+        self.history = EditHistory()
+        self.erase_started = False # the current erase drag is in history
+        self.changes = 0 # number of edits, see apply_edit
+        self.saved_key = None # state_key when the session was last saved
+        self.journal = None # analysis.EditJournal of the edits, if any
         self.check_undo_status()
 
         self.show()
-        self.first_draw = False
+
+        if background:
+            self.worker = ContourWorker(self.image_copy, self.preprocess,
+                                        self.contours_found)
+
+    def close(self):
+        """
+        Stops any background work and closes the journal, call before
+        discarding the editor
+        """
+        if self.worker:
+            self.worker.stop()
+        self.close_journal()
 
     def load_image(self, filename):
         """Load image from filename (str)"""
-        self.image = cv.imdecode(np.fromfile(filename, dtype=np.uint8), cv.IMREAD_COLOR)
+        self.image = analysis.load_image(filename)
         self.filename = filename
 
     def adjust_image(self):
         """Resizes image to the percent indicated by self.quality"""
-        height, width, channels = self.image.shape 
-
-        new_dims = (int(width*self.quality), int(height*self.quality))
-        self.image_copy = cv.resize(self.image, None, 
-                                    fx=self.quality, fy=self.quality, 
-                                    interpolation=cv.INTER_AREA)
+        self.image_copy = analysis.adjust_image(self.image, self.quality)
+        self.preprocess = analysis.PreprocessCache(self.image_copy)
 
     def set_threshold(self, value):
         """Sets the threshold to value (int) and redraws contours"""
         if value != self.threshold:
             self.threshold = value
-            self.redraw_contours = True
-            self.last_img = None
+            self.invalidate('contours')
             self.show()
 
     def set_blur(self, value):
         """Sets the blur to value (int) and redraws contours"""
         if value != self.blur:
             self.blur = value
-            self.redraw_contours = True
+            self.invalidate('contours')
             self.show()
 
+    def set_threshold_sweep(self, value):
+        """Sets whether the contours of visited thresholds are kept (bool)"""
+        self.threshold_sweep = value
+
     def set_min(self, value):
         """Sets the min acceptable area to value (int) and redraws contours"""
         if value != self.min_size:
             self.min_size = value
-            self.redraw_contours = True
+            self.invalidate('contours')
             self.show()
 
     def set_max(self, value):
         """Sets the max acceptable area to value (int) and redraws contours"""
         if value != self.max_size:
             self.max_size = value
-            self.redraw_contours = True
+            self.invalidate('contours')
             self.show()
 
     def set_alpha(self, value):
         """Sets the overlay alpha to value (float)"""
         if value != self.alpha:
             self.alpha = value
+            self.invalidate('render')
             self.show()
 
     def set_line_thickness(self, value):
@@ -1830,12 +2551,14 @@ class Axon_Editor:
         """Sets the outline thickness to value (int)"""
         if value != self.outline_thickness:
             self.outline_thickness = value
+            self.invalidate('render')
             self.show()
 
     def set_font_size(self, value):
         """Sets the font size to value (float)"""
         if value != self.font_size:
             self.font_size = value
+            self.invalidate('render')
             self.show()
 
     def set_eraser_size(self, value):
@@ -1862,89 +2585,149 @@ class Axon_Editor:
     def toggle_outlines(self, value):
         """Toggles outline visibility depending on value (bool)"""
         self.display_options['outlines'] = value
-        self.force_redraw = True
-        self.last_img = None
+        self.invalidate('render')
         self.show()
 
     def toggle_highlights(self, value):
         """Toggles highlight visibility depending on value (bool)"""
         self.display_options['highlights'] = value
-        self.force_redraw = True
-        self.last_img = None
+        self.invalidate('render')
         self.show()
 
     def toggle_counters(self, value):
         """Toggles counter visibility depending on value (bool)"""
         self.display_options['counters'] = value
-        self.force_redraw = True
-        self.last_img = None
+        self.invalidate('render')
         self.show()
 
     def toggle_lines(self, value):
         """Toggles line visibility depending on value (bool)"""
         self.display_options['lines'] = value
-        self.force_redraw = True
-        self.last_img = None
+        self.invalidate('render')
         self.show()
 
     def toggle_threshold_overlay(self, value):
         """Toggles threshold overlay visibility depending on value (bool)"""
         self.display_options['threshold'] = value
-        self.force_redraw = True
-        self.last_img = None
+        self.invalidate('render')
         self.show()
 
+    def invalidate(self, stage):
+        """Marks stage (str) and every stage depending on it as out of date"""
+        self.dirty.add(stage)
+        for dependent in self.STAGE_DEPENDENCIES[stage]:
+            self.invalidate(dependent)
+
     def reset_tool(self):
         """Resets the current tool"""
         self.set_mode(self.mode)
 
-    def add_to_undo(self, state):
-        """Adds state to undo history"""
-        if len(self.undo_history) == self.undo_history_len:
-            self.undo_history = self.undo_history[1:self.undo_history_len]
-        self.undo_history.append(state)
+    def apply_edit(self, edit):
+        """
+        Makes a change to the selections, lines or counters, and writes it
+        to the journal
+
+        Arguments:
+            edit (tuple): see analysis.apply_edit
+
+        Returns:
+            inverse (tuple): the edit that undoes this one
+        """
+        self.journal_edit(edit)
+        if edit[0] != 'contours':
+            self.invalidate('render')
+            return analysis.apply_edit(self.saved_contours, self.lines,
+                                       self.counters, edit)
+        _kind, group, index, count, contours = edit
+        selections = self.saved_contours[group]
+        selection_index = self.selection_index[group]
+        appended = index + count == len(selections)
+        inverse = analysis.apply_edit(self.saved_contours, self.lines,
+                                      self.counters, edit)
+        for contour in inverse[4]:
+            selection_index.remove(contour)
+        if appended:
+            for contour in contours:
+                selection_index.insert(contour)
+        elif contours:
+            selection_index.sync(selections)
+        self.invalidate('pairs')
+        return inverse
+
+    def journal_edit(self, edit):
+        """
+        Counts edit (tuple, see analysis.apply_edit) as a change and writes
+        it to the journal, if there is one
+        """
+        self.changes += 1
+        if self.journal:
+            try:
+                self.journal.append(self.changes, edit)
+            except OSError as e:
+                print('failed to write the journal, stopped journaling:', e)
+                self.journal = None
+
+    def start_journal(self, filename, session=None):
+        """
+        Journals the edits from now on to filename (str), named session
+        (str), see analysis.EditJournal
+        """
+        self.close_journal()
+        self.journal = analysis.EditJournal(filename, session)
+
+    def close_journal(self):
+        """Closes the journal, if there is one"""
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+    def edit(self, edits, merge=False):
+        """
+        Applies edits (list of tuples, see apply_edit) as an action that can
+        be undone, or as part of the last action if merge (bool)
+        """
+        if not edits:
+            return
+        inverses = [self.apply_edit(edit) for edit in edits]
+        if merge and self.history.undo:
+            self.history.extend(inverses)
+        else:
+            self.history.push(self.history.undo, inverses)
         self.check_undo_status()
 
-    def add_to_redo(self, state):
-        """Adds state to redo history"""
-        if len(self.redo_history) == self.undo_history_len:
-            self.redo_history = self.redo_history[1:self.undo_history_len]
-        self.redo_history.append(state)
+    def step_history(self, source, target):
+        """
+        Applies the newest entry of source (deque) and adds what undoes it to
+        target (deque), for undo and redo
+        """
+        if not source:
+            return
+        edits = self.history.pop(source)
+        inverses = [self.apply_edit(edit) for edit in reversed(edits)]
+        if any(edit[0] == 'lines' for edit in edits):
+            self.invalidate('contours')
+        self.history.push(target, inverses)
+        self.show()
+        self.reset_tool()
         self.check_undo_status()
 
     def undo(self):
         """Undo the most recent action"""
-        if self.undo_history:
-            cur_state = self.get_state()
-            self.add_to_redo(cur_state)
-            state = self.undo_history.pop(-1)
-            self.load_state(state)
-            self.redraw_contours = True
-            self.show()
-            self.reset_tool()
-            self.check_undo_status()
+        self.step_history(self.history.undo, self.history.redo)
 
     def clear_redo(self):
         """Clears the redo history"""
-        self.redo_history = []
+        self.history.clear(self.history.redo)
         self.check_undo_status()
 
     def redo(self):
         """Redo the most recently undone action"""
-        if self.redo_history:
-            cur_state = self.get_state()
-            self.add_to_undo(cur_state)
-            state = self.redo_history.pop(-1)
-            self.load_state(state)
-            self.redraw_contours = True
-            self.show()
-            self.reset_tool()
-            self.check_undo_status()
+        self.step_history(self.history.redo, self.history.undo)
 
     def check_undo_status(self):
         """Update the usability of the undo/redo menu buttons"""
-        self.parent.set_undo_enabled(len(self.undo_history) > 0)
-        self.parent.set_redo_enabled(len(self.redo_history) > 0)
+        self.parent.set_undo_enabled(len(self.history.undo) > 0)
+        self.parent.set_redo_enabled(len(self.history.redo) > 0)
         
     @staticmethod
     def line_intersect(A,B,C,D):
@@ -1984,72 +2767,37 @@ class Axon_Editor:
         return distance <= circle_radius
 
     @staticmethod
-    def polyline_circle_intersects(polyline, circle_point, circle_radius):
+    def points_in_circle(points, circle_point, circle_radius):
         """
-        Returns the indices of any point on a polyline involved in an 
-        intersection with a circle
+        Returns a boolean array, True for each of points (array of (x, y))
+        inside of the circle, inclusive
         """
-        indices = []
-        for i in range(len(polyline)):
-            if Axon_Editor.point_in_circle(polyline[i], circle_point, 
-                                           circle_radius):
-                indices.append(i)
-        return indices
-
-    @staticmethod
-    def polyline_circle_nonintersects(polyline, circle_point, circle_radius):
-        """
-        Returns the indices of any point on a polyline not involved in an
-        intersection with a circle
-        """
-        result = []
-        indices = Axon_Editor.polyline_circle_intersects(polyline, circle_point, 
-                                                         circle_radius)
-        for i in range(len(polyline)):
-            if not i in indices:
-                result.append(i)
-        return Axon_Editor.get_ranges(result)
+        offsets = (np.asarray(points, dtype=np.float64).reshape(-1, 2)
+                   - circle_point)
+        return (offsets * offsets).sum(axis=1) <= circle_radius * circle_radius
 
     @staticmethod
     def get_ranges(unfiltered):
         """
-        Converts a list into ranges
-        e.g. [1,2,3,4,5,8,9,23] => [(1,5),(8,9),23]
+        Converts sorted indices into the ranges of their consecutive runs,
+        leaving out runs of a single index
+        e.g. [1,2,3,4,5,8,9,23] => [(1,5),(8,9)]
         """
-        if len(unfiltered) <= 1:
+        indices = np.asarray(unfiltered)
+        if len(indices) <= 1:
             return []
-        result = []
-        low = None
-        high = None
-        last = unfiltered[0]
-        for i in range(len(unfiltered)):
-            if i == 0:
-                low = unfiltered[i]
-                continue
-            elif i == len(unfiltered)-1:
-                high = unfiltered[i]
-                if low is not None:
-                    result.append((low, high))
-                continue
-            elif (unfiltered[i] != unfiltered[i-1] + 1 and 
-                  unfiltered[i+1] == unfiltered[i] + 1):
-                low = unfiltered[i]
-                high = None
-            elif (unfiltered[i] == unfiltered[i-1] + 1 and 
-                  unfiltered[i+1] != unfiltered[i] + 1):
-                high = unfiltered[i]
-                if low is not None:
-                    result.append((low, high))
-                low = None
-        return result
+        breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+        starts = np.concatenate(([0], breaks))
+        ends = np.concatenate((breaks, [len(indices)])) - 1
+        return [(int(indices[start]), int(indices[end]))
+                for start, end in zip(starts, ends) if end > start]
 
     def set_mode(self, new_mode):
         """Set the current mode to new_mode (ToolMode)"""
         self.mode = new_mode
-        self.force_redraw = True
         self.first_point = None
         self.second_point = None
-        self.last_img = None
+        self.invalidate('render')
         self.cur_point = None
         self.drawing = False
         self.show()
@@ -2062,146 +2810,93 @@ class Axon_Editor:
 
     def find_pairs(self):
         """Pairs up contours in Axon, Inner Myelin, and Outer Myelin stacks"""
-        seen = []
-        self.contour_pairs = []
-        self.contour_pairless = []
-        self.contour_pairless_grouped = {
-            self.mode_to_string(ToolMode.SEL_AXON): [],
-            self.mode_to_string(ToolMode.SEL_MYELIN_IN): [],
-            self.mode_to_string(ToolMode.SEL_MYELIN_OUT): []
-        }
-
-        # Go through axons in selection order
-        axons = self.saved_contours[self.mode_to_string(ToolMode.SEL_AXON)]
-        for a in axons:
-            paired_up = [a]
-            M = cv.moments(a)
-            a_xy = (int(M["m10"] / M["m00"]),int(M["m01"] / M["m00"]))
-            a_point = tuple(a[0][0])
-
-            is_inner = False
-            
-            # look for overlapping inner myelin sheath
-            inner = self.saved_contours[
-                self.mode_to_string(ToolMode.SEL_MYELIN_IN)]
-            for b in inner:
-                if any(np.array_equal(b, s) for s in seen):
-                    continue
-                if (cv.pointPolygonTest(b, a_xy, False) > 0 or 
-                    cv.pointPolygonTest(b, a_point, False) >= 0):
-                    paired_up.append(b)
-                    seen.append(b)
-                    is_inner = True
-                    break
-
-
-            # and overlapping outer myelin sheath
-            outer = self.saved_contours[
-                self.mode_to_string(ToolMode.SEL_MYELIN_OUT)]
-            for c in outer:
-                if any(np.array_equal(c, s) for s in seen):
-                    continue
-                if (cv.pointPolygonTest(c, a_xy, False) > 0 or 
-                    cv.pointPolygonTest(c, a_point, False) >= 0):
-                    paired_up.append(c)
-                    seen.append(c)
-                    break
-
-            # check for full stack
-            if len(paired_up) == self.NUM_FEATURES:
-                paired_up.sort(key=cv.contourArea, reverse=True)
-                self.contour_pairs += paired_up
-            else:
-                group = self.contour_pairless_grouped[
-                    self.mode_to_string(ToolMode.SEL_AXON)]
-                group.append(paired_up[0])
-                if len(paired_up) == 2:
-                    if is_inner:
-                        group = self.contour_pairless_grouped[
-                            self.mode_to_string(ToolMode.SEL_MYELIN_IN)]
-                        group.append(paired_up[1])
-                    else:
-                        group = self.contour_pairless_grouped[
-                            self.mode_to_string(ToolMode.SEL_MYELIN_OUT)]
-                        group.append(paired_up[1])
-
-                self.contour_pairless += paired_up
-
-        # Round up any lonely inner or outer
-        inner = self.saved_contours[self.mode_to_string(ToolMode.SEL_MYELIN_IN)]
-        for b in inner:
-            if any(np.array_equal(b, s) for s in seen):
-                continue
-            self.contour_pairless.append(b)
-            group = self.contour_pairless_grouped[
-                self.mode_to_string(ToolMode.SEL_MYELIN_IN)]
-            group.append(b)
-
-        outer = self.saved_contours[
-            self.mode_to_string(ToolMode.SEL_MYELIN_OUT)]
-        for c in outer:
-            if any(np.array_equal(c, s) for s in seen):
-                continue
-            self.contour_pairless.append(c)
-            group = self.contour_pairless_grouped[
-                self.mode_to_string(ToolMode.SEL_MYELIN_OUT)]
-            group.append(c)
+        self.pairing = self.pairer.update(self.saved_contours)
+        self.contour_pairs = self.pairing.flat_pairs()
+        self.contour_pairless = self.pairing.pairless
+        self.contour_pairless_grouped = self.pairing.pairless_grouped
+        self.contour_table = None
 
+    def selection_table(self):
+        """
+        Returns the analysis.ContourTable of the selections and their
+        pairing, for the export. It's built the first time it's needed
+        after they change, so selecting stays cheap.
+        """
+        if 'pairs' in self.dirty:
+            self.find_pairs()
+            self.dirty.discard('pairs')
+        if self.contour_table is None:
+            self.contour_table = analysis.ContourTable(self.saved_contours,
+                                                       self.pairing)
+        return self.contour_table
 
     def mode_to_string(self, mode):
         """Convert mode (ToolMode) to string, for storing in file"""
         if mode == ToolMode.SEL_AXON:
-            return 'axon'
+            return analysis.AXON
         if mode == ToolMode.SEL_MYELIN_IN:
-            return 'inner myelin'
+            return analysis.INNER_MYELIN
         if mode == ToolMode.SEL_MYELIN_OUT:
-            return 'outer myelin'
+            return analysis.OUTER_MYELIN
         if mode == ToolMode.SEL_MISC:
-            return 'misc'
+            return analysis.MISC
 
     def erase(self, erase_point):
         """Erases any points within the eraser, with location erase_point"""
-        removed_something = False
-        new_points = []
-        for point, group in self.counters:
-            if not Axon_Editor.point_in_circle(point, erase_point, 
+        edits = []
+        # only lines with a point in this box can be erased
+        nearby = (erase_point[0] - self.eraser_size,
+                  erase_point[1] - self.eraser_size,
+                  erase_point[0] + self.eraser_size,
+                  erase_point[1] + self.eraser_size)
+
+        erased_counters = self.counters.in_circle(erase_point,
+                                                  self.eraser_size)
+        if erased_counters.any():
+            edits.append(('remove counters', np.flatnonzero(erased_counters)))
+
+        remaining = {} # index of an erased line -> ranges left of it
+        polylines = [] # indices of the lines with many points
+        for index in self.lines.overlapping(nearby):
+            points = self.lines.points(index)
+            if self.lines.straight[index]:
+                point_a, point_b = points.tolist()
+                if Axon_Editor.line_circle_intersect(point_a, point_b,
+                                                     erase_point,
+                                                     self.eraser_size):
+                    remaining[index] = []
+            elif len(points) == 1:
+                if Axon_Editor.point_in_circle(points[0], erase_point,
                                                self.eraser_size):
-                new_points.append((point, group))
+                    remaining[index] = []
+            elif not len(points):
+                remaining[index] = []
             else:
-                removed_something = True
-        self.counters = new_points
-
-        new_lines = []
-        for line_group in self.lines:
-            thickness, color, points = line_group
-            if len(points) == 1:
-                if isinstance(points[0][0], tuple): # a straight line, 2 points
-                    if not Axon_Editor.line_circle_intersect(points[0][0],
-                                                             points[0][1],
-                                                             erase_point,
-                                                             self.eraser_size):
-                        new_lines.append(line_group)
-                    else:
-                        removed_something = True
-                else: # a single point
-                    if not Axon_Editor.point_in_circle(points[0], 
-                                                       erase_point,
-                                                       self.eraser_size):
-                        new_lines.append(line_group)
-                    else:
-                        removed_something = True
-            else:
-                to_keep = Axon_Editor.polyline_circle_nonintersects(
-                    points, erase_point, self.eraser_size)
-                for index_range in to_keep:
-                    new_line_group = [thickness, color, 
-                                      points[index_range[0]:index_range[1]+1]]
-                    new_lines.append(new_line_group)
-                removed_something = True
-        self.lines = new_lines
-
-        if removed_something:
-            self.last_img = None
+                polylines.append(index)
+
+        # The vertices of all of the polylines are tested at once, and only
+        # the polylines with vertices in the eraser are split
+        if polylines:
+            arrays = [self.lines.points(index) for index in polylines]
+            inside = Axon_Editor.points_in_circle(
+                np.concatenate(arrays), erase_point, self.eraser_size)
+            starts = np.cumsum([0] + [len(array) for array in arrays[:-1]])
+            hits = np.add.reduceat(inside, starts)
+            for index, array, start, hit in zip(polylines, arrays, starts,
+                                                hits):
+                if hit:
+                    remaining[index] = Axon_Editor.get_ranges(np.flatnonzero(
+                        ~inside[start:start + len(array)]))
+        if remaining:
+            edits.append(('lines', [
+                (index, 1, self.lines.section(index, 0, remaining[index]))
+                for index in sorted(remaining)]))
+            self.erased_lines = True
+
+        if edits:
+            # a drag of the eraser is undone all at once
+            self.edit(edits, merge=self.erase_started)
+            self.erase_started = True
             self.show()
 
     def mouse_event(self, event, x, y, flags, param, modifiers = None):
@@ -2224,7 +2919,6 @@ class Axon_Editor:
 
         # Left click
         if event == cv.EVENT_LBUTTONDOWN:
-            cur_state = self.get_state()
             self.clear_redo()
             # Select: Save the starting point for now
             if self.mode in (ToolMode.SEL_AXON, ToolMode.SEL_MYELIN_IN, 
@@ -2234,19 +2928,20 @@ class Axon_Editor:
 
             # Deselect: Clear any contours that surround the click point
             if self.mode == ToolMode.DESELECT:
+                edits = []
                 for m in self.saved_contours:
-                    new_contours = []
-                    removed_contours = False
-                    for i in range(len(self.saved_contours[m])):
-                        c = self.saved_contours[m][i]
-                        if cv.pointPolygonTest(c,(x,y), False) <= 0:
-                            new_contours.append(c)
-                        else:
-                            True
-                    if removed_contours:
-                        self.add_to_undo(cur_state)
-                    self.saved_contours[m] = new_contours
-                self.redraw_contours = True
+                    removed_ids = {
+                        id(c) for c in self.selection_index[m].query_point(
+                            (x, y))
+                        if cv.pointPolygonTest(c, (x, y), False) > 0}
+                    if removed_ids:
+                        # from the back, so the earlier indices still hold
+                        contours = self.saved_contours[m]
+                        edits += [('contours', m, i, 1, [])
+                                  for i in reversed(range(len(contours)))
+                                  if id(contours[i]) in removed_ids]
+                self.edit(edits)
+                self.invalidate('pairs')
                 self.show()
                 return
 
@@ -2261,12 +2956,15 @@ class Axon_Editor:
                                 line_color = Colors.WHITE.value
                             else:
                                 line_color = Colors.BLACK.value
-                            self.lines.append([self.line_thickness, line_color,
-                                 [(self.first_point, self.second_point)]])
-                            self.add_to_undo(cur_state)
+                            line = analysis.Strokes()
+                            line.append(self.line_thickness, line_color,
+                                        (self.first_point, self.second_point),
+                                        straight=True)
+                            self.edit([('lines',
+                                        [(len(self.lines), 0, line)])])
                             self.first_point = None
                             self.hidden_first_point = self.second_point
-                            self.last_img = None
+                            self.invalidate('contours')
                 else: # Freehand Line
                     self.drawing = True
                     self.first_point = None
@@ -2274,19 +2972,23 @@ class Axon_Editor:
                         line_color = Colors.WHITE.value
                     else:
                         line_color = Colors.BLACK.value
-                    self.lines.append([self.line_thickness, line_color, []])
-                    self.add_to_undo(cur_state)
+                    # the line is empty for now, undoing removes all of it
+                    line = analysis.Strokes()
+                    line.append(self.line_thickness, line_color)
+                    self.edit([('lines', [(len(self.lines), 0, line)])])
 
             # Counting: Add a counter to the click point
             if self.mode == ToolMode.COUNT:
-                self.last_img = None
-                self.counters.append(((x, y), self.cur_group))
-                self.add_to_undo(cur_state)
+                counter = analysis.Counters()
+                counter.append((x, y), self.cur_group)
+                self.edit([('insert counters', [len(self.counters)],
+                            counter)])
 
             # Erase: Erase any points the current click point
             if self.mode == ToolMode.ERASE:
-                self.add_to_undo(cur_state)
                 self.drawing = True
+                self.erased_lines = False
+                self.erase_started = False
 
             # Info: Check what is overlapping this selection
             if self.mode == ToolMode.INFO:
@@ -2294,9 +2996,8 @@ class Axon_Editor:
                 for mode in (ToolMode.SEL_AXON, ToolMode.SEL_MYELIN_IN, 
                              ToolMode.SEL_MYELIN_OUT):
                     selected[mode] = 0
-                    contours = self.saved_contours[self.mode_to_string(mode)]
-                    for i in range(len(contours)):
-                        c = contours[i]
+                    index = self.selection_index[self.mode_to_string(mode)]
+                    for c in index.query_point((x, y)):
                         r = cv.pointPolygonTest(c, (x,y), False)
                         if r > 0:
                             selected[mode] += 1
@@ -2342,11 +3043,15 @@ class Axon_Editor:
                 if event == cv.EVENT_LBUTTONUP:
                     self.drawing = False
                     self.hidden_first_point = (x, y)
-                    self.last_img = None
                     self.first_point = None
-                    self.redraw_contours = True
+                    self.invalidate('contours')
+                    # the points aren't edits while drawing, the journal
+                    # gets the finished line in place of the empty one
+                    index = len(self.lines) - 1
+                    self.journal_edit(('lines', [
+                        (index, 1, self.lines.section(index, 1))]))
                 else:
-                    self.lines[-1][-1].append((x,y))
+                    self.lines.append_point((x, y))
             else: # Mouse moved, but not doing freehand
                 if modifiers == Qt.ShiftModifier:
                     self.first_point = self.hidden_first_point
@@ -2360,36 +3065,34 @@ class Axon_Editor:
                          ToolMode.SEL_MYELIN_OUT, ToolMode.SEL_MISC):
             if event == cv.EVENT_LBUTTONUP: 
                 self.first_point = None
-                cur_state = self.get_state()
                 if self.drawing:
                     new_contour = np.array(self.drawn_contour, dtype=np.int32)
-                    if cv.contourArea(new_contour) > 0: # filter out lines
+                    if analysis.contour_area(new_contour) > 0: # filter lines
                         mode_string = self.mode_to_string(self.mode)
-                        self.saved_contours[mode_string].append(new_contour)
-                        self.add_to_undo(cur_state)
+                        self.edit([('contours', mode_string,
+                                    len(self.saved_contours[mode_string]), 0,
+                                    [new_contour])])
                     self.drawn_contour = []
                     self.display_options = self.prev_display_options
                     self.drawing = False
-                    self.last_img = None
-                    self.redraw_contours = True
+                    self.invalidate('pairs')
                     self.show()
                     return
-                contours = self.saved_contours[self.mode_to_string(self.mode)]
-                for i in range(len(contours)):
-                    r = cv.pointPolygonTest(contours[i],(x,y), False)
+                mode_string = self.mode_to_string(self.mode)
+                contours = self.saved_contours[mode_string]
+                index = self.selection_index[mode_string]
+                for c in index.query_point((x, y)):
+                    r = cv.pointPolygonTest(c,(x,y), False)
                     if r > 0: # remove already selected contour
-                        old_contour = contours.pop(i)
-                        self.add_to_undo(cur_state)
-                        self.redraw_contours = True
+                        self.edit([('contours', mode_string,
+                                    next(i for i, s in enumerate(contours)
+                                         if s is c), 1, [])])
                         self.show()
                         return
-                enveloping_contours = [c for c in self.cur_contours 
-                                      if cv.pointPolygonTest(c,(x,y),False) > 0]
-                if enveloping_contours:
-                    conts = self.saved_contours[self.mode_to_string(self.mode)]
-                    conts.append(min(enveloping_contours, key=cv.contourArea))
-                    self.add_to_undo(cur_state)
-                    self.redraw_contours = True
+                enveloping_contour = self.candidate_at((x, y))
+                if enveloping_contour is not None:
+                    self.edit([('contours', mode_string, len(contours), 0,
+                                [enveloping_contour])])
                     self.show()
                     return
             if self.first_point and not self.drawing:
@@ -2405,7 +3108,7 @@ class Axon_Editor:
                         'lines': True,
                         'threshold': False,
                     }
-                    self.last_img = None
+                    self.invalidate('render')
             if self.drawing:
                 self.drawn_contour.append([(x, y)])
                 self.first_point = (x, y)
@@ -2413,22 +3116,20 @@ class Axon_Editor:
                 return
 
             # Apply highlights
-            contours = self.saved_contours[self.mode_to_string(self.mode)]
-            saved_highlights = [s for s in contours
+            index = self.selection_index[self.mode_to_string(self.mode)]
+            saved_highlights = [s for s in index.query_point((x, y))
                                 if cv.pointPolygonTest(s, (x,y), False) > 0]
             if saved_highlights:
                 self.highlight_contours = [(
-                    min(saved_highlights, key=cv.contourArea),
+                    min(saved_highlights, key=analysis.contour_area),
                     Colors.RED_HIGHLIGHT.value)]
                 self.show()
                 return
 
-            current_highlights = [c for c in self.cur_contours 
-                                  if cv.pointPolygonTest(c, (x,y), False) > 0]
-            if current_highlights:
-                self.highlight_contours = [(
-                    min(current_highlights, key=cv.contourArea),
-                    Colors.GREEN_HIGHLIGHT.value)]
+            current_highlight = self.candidate_at((x, y))
+            if current_highlight is not None:
+                self.highlight_contours = [(current_highlight,
+                                            Colors.GREEN_HIGHLIGHT.value)]
                 self.show()
                 return
 
@@ -2436,7 +3137,7 @@ class Axon_Editor:
         if self.mode == ToolMode.DESELECT:
             self.highlight_contours = []
             for m in self.saved_contours:
-                for s in self.saved_contours[m]:
+                for s in self.selection_index[m].query_point((x, y)):
                     if cv.pointPolygonTest(s, (x, y), False) > 0:
                         self.highlight_contours.append((s, Colors.RED_HIGHLIGHT.value))
             if self.highlight_contours:
@@ -2452,8 +3153,9 @@ class Axon_Editor:
             self.cur_point = (x, y)
             if event == cv.EVENT_LBUTTONUP:
                 self.drawing = False
-                self.redraw_contours = True
-                self.last_img = None
+                if self.erased_lines:
+                    self.invalidate('contours')
+                    self.erased_lines = False
             if self.drawing:
                 self.erase((x,y))
 
@@ -2463,668 +3165,686 @@ class Axon_Editor:
         
         self.show()
 
+    def get_params(self):
+        """Returns the parameters used to find contours, see analysis.segment"""
+        return {
+            'threshold': self.threshold,
+            'blur': self.blur,
+            'min_size': self.min_size,
+            'max_size': self.max_size,
+            'lines': self.lines,
+            'sweep': self.threshold_sweep
+        }
+
     def find_contours(self):
         """Extracts contours from the current screen"""
-        # 1. Convert to grayscale
-        imgray = cv.cvtColor(self.image_copy, cv.COLOR_BGR2GRAY)
+        self.cur_contours = analysis.segment(self.image_copy, self.get_params(),
+                                            self.preprocess)
+        self.candidate_labels = None
 
-        # 2. Apply blur kernel
-        if self.blur == 0:
-            blurred_image = imgray
-        else:
-            blurred_image = cv.bilateralFilter(imgray,1+self.blur, 75, 75)
-
-        # 3. Apply thresholding filter
-        _, thresholded = cv.threshold(blurred_image, self.threshold, 255, 
-                                      cv.THRESH_TRUNC)
-        _, thresholded = cv.threshold(thresholded, self.threshold*15/16, 255, 
-                                      cv.THRESH_BINARY)
-
-        # 4. Draw cut and draw lines on the image
-        for points in self.lines:
-            cv.polylines(thresholded,[np.array(points[-1])], False, points[1], 
-                         points[0])
-
-        # 5. Extract contours from the image
-        contour_data = cv.findContours(thresholded, cv.RETR_TREE,
-                                       cv.CHAIN_APPROX_SIMPLE)
-        if len(contour_data) == 2:
-            contours = contour_data[0]
-        else:
-            contours = contour_data[1]
+    def candidate_at(self, point):
+        """
+        Returns the smallest contour in cur_contours around point (x, y), or
+        None. The label map is built the first time it's needed after the
+        contours change.
+        """
+        if self.candidate_labels is None:
+            self.candidate_labels = analysis.LabelMap(self.cur_contours,
+                                                      self.image_copy.shape)
+        return self.candidate_labels.contour_at(point)
 
-        # 6. Filter out contours based on min and max size
-        self.cur_contours = [c for c in contours 
-            if (len(c) >= 5 and 
-                self.min_size <= cv.contourArea(c) <= self.max_size)]
+    def request_contours(self):
+        """
+        Extracts contours on the background thread. The current contours stay
+        on screen until contours_found receives the new ones.
+        """
+        params = self.get_params()
+        # the lines keep changing while drawing, send the worker a snapshot
+        params['lines'] = self.lines.copy()
+        self.worker.request(params)
+
+    def contours_found(self, contours):
+        """Receives the contours of the latest request from the worker"""
+        self.cur_contours = contours
+        self.candidate_labels = None
+        self.invalidate('render')
+        self.show()
+
+    def resume_updates(self):
+        """
+        Stops holding back frames, and shows the frame held back if there is
+        one, so changes made in the meantime cost one pass of the stages
+        they put out of date
+        """
+        self.hold_frames = False
+        if self.frame_held:
+            self.show()
 
     def show(self, value=0):
         """Generates image to display, with all overlay features"""
-        if self.force_redraw: # Draw everything again
-            self.force_redraw = False
+        if self.hold_frames:
+            self.frame_held = True
+            return
+        self.frame_held = False
+
+        # The last frame can be reused unless something in it changed
+        frame_valid = 'render' not in self.dirty and self.last_img is not None
+
         # Line tools, draw and cut
-        elif (not self.force_redraw and 
-              self.first_point is not None and 
-              self.last_img is not None):
-            display_image = self.last_img.copy()
-            if self.display_options['lines'] and self.second_point:
-                display_image = cv.line(display_image, self.first_point,
-                                        self.second_point, Colors.GREEN.value,
-                                        self.line_thickness)
-            if self.drawn_contour:
-                cv.polylines(display_image, [np.array(self.drawn_contour)],
-                             False, Colors.GREEN.value, 1)
-
-            self.callback(display_image, self.first_draw)
+        if self.first_point is not None and frame_valid:
+            self.show_preview(*self.line_preview())
             return
         # Point tools, counter and eraser
-        elif (not self.force_redraw and 
-              self.cur_point is not None and 
-              self.last_img is not None):
-            display_image = self.last_img.copy()
-            if self.cur_point is not None:
-                if self.mode == ToolMode.COUNT:
-                    if self.cur_group == 'Unmyelinated Axons':
-                        color = Colors.PURPLE.value
-                    elif self.cur_group == 'Myelinated Axons':
-                        color = Colors.LIME.value
-                    else:
-                        color = Colors.PINK.value
-                    display_image = cv.circle(display_image, self.cur_point, 3, 
-                                              color, -1)
-                    display_image = cv.circle(display_image, self.cur_point, 3, 
-                                              Colors.BLACK.value, 2)
-                elif self.mode == ToolMode.ERASE:
-                    display_image = cv.circle(display_image, self.cur_point, 
-                                              self.eraser_size, 
-                                              Colors.BLACK.value, 2)
-            self.callback(display_image, self.first_draw)
-            if not self.redraw_contours:
-                return
+        elif self.cur_point is not None and frame_valid:
+            self.show_preview(*self.point_preview())
+            return
 
-        # Recalculate contours if necessary
-        if self.redraw_contours:
-            self.find_contours()
+        # Recalculate only the stages that are out of date
+        if 'contours' in self.dirty:
+            # the first frame waits for its contours, the others don't
+            if self.worker and not self.first_draw:
+                self.request_contours()
+            else:
+                self.find_contours()
+            self.dirty.discard('contours')
+        if 'pairs' in self.dirty:
             self.find_pairs()
-            self.redraw_contours = False
+            self.dirty.discard('pairs')
 
-        # Show threshold as overlay
-        if self.display_options['threshold']:
-            imgray = cv.cvtColor(self.image_copy, cv.COLOR_BGR2GRAY)
+        display_image = self.compose_frame()
+        tiles = self.changed_tiles()
 
-            if self.blur == 0:
-                blurred_image = imgray
-            else:
-                blurred_image = cv.bilateralFilter(imgray,1+self.blur, 75, 75)
-
-            _, thresholded = cv.threshold(blurred_image, self.threshold, 255, 
-                                          cv.THRESH_TRUNC)
-            _, thresholded = cv.threshold(thresholded, self.threshold*15/16, 
-                                          255, cv.THRESH_BINARY)
+        self.dirty.discard('render')
 
-            base_image = cv.cvtColor(thresholded, cv.COLOR_GRAY2BGR)
-            overlay_image = cv.cvtColor(thresholded, cv.COLOR_GRAY2BGR)
+        # If we started drawing a line, keep this image to avoid redraw, the
+        # frame isn't composited again until the next full show. Otherwise
+        # the next preview needs a full frame.
+        self.last_img_shown = (self.first_point is not None or
+                               self.cur_point is not None)
+        if self.last_img_shown:
+            self.last_img = display_image
         else:
-            base_image = self.image_copy.copy()
-            overlay_image = self.image_copy.copy()
-
-        # Draw contour outlines
-        if self.display_options['outlines']:
-            cv.drawContours(overlay_image, self.cur_contours, -1, 
-                            Colors.YELLOW.value, self.outline_thickness)
-            for c in self.saved_contours.values():
-                cv.drawContours(overlay_image, c, -1, Colors.BLACK.value, 
-                                self.outline_thickness)
-
-        # Draw highlights
-        if self.display_options['highlights']:
-            cv.drawContours(overlay_image, self.contour_pairs, -1, 
-                            Colors.CYAN_HIGHLIGHT.value, cv.FILLED)
-            cv.drawContours(overlay_image, self.contour_pairless, -1, 
-                            Colors.ORANGE_HIGHLIGHT.value, cv.FILLED)
-            cv.drawContours(overlay_image, self.saved_contours[
-                                        self.mode_to_string(ToolMode.SEL_MISC)],
-                            -1, Colors.CYAN_HIGHLIGHT.value, cv.FILLED)
-            if len(self.highlight_contours) > 0:
-                for c_group in self.highlight_contours:
-                    cv.drawContours(overlay_image, (c_group[0],), -1, 
-                                    c_group[1], cv.FILLED)
-
-        # Merge the overlay image to the base with alpha
-        display_image = cv.addWeighted(overlay_image, self.alpha, base_image, 
-                                       1-self.alpha, 0)
-
-        # Add counter and number overlay
-        if self.display_options['counters']:
-            # Draw group indicators:
-            for point, group in self.counters:
-                if group == 'Unmyelinated Axons':
-                    color = Colors.PURPLE.value
-                elif group == 'Myelinated Axons':
-                    color = Colors.LIME.value
-                else:
-                    color = Colors.PINK.value
-                display_image = cv.circle(display_image, point, 3, color, -1)
-                display_image = cv.circle(display_image, point, 3, 
-                                          Colors.BLACK.value, 2)
-                cv.putText(display_image, group[0], 
-                           (point[0] - int(self.font_size * 8), point[1] + int(self.font_size * 4)),
-                           cv.FONT_HERSHEY_SIMPLEX, self.font_size, color,
-                           int(2*self.font_size))
-
-            # Draw numbers for pairs
-            for i in range(0,len(self.contour_pairs),self.NUM_FEATURES):
-                c = self.contour_pairs[i]
-                M = cv.moments(c)
-                cX = int(M["m10"] / M["m00"])
-                cY = int(M["m01"] / M["m00"])
-                cv.putText(display_image, str(i//self.NUM_FEATURES+1), (cX - int(self.font_size * 8), cY + int(self.font_size * 4)),
-                           cv.FONT_HERSHEY_SIMPLEX, self.font_size, Colors.WHITE.value,
-                           int(2*self.font_size))
-
-        # Add cut and draw lines
-        if self.display_options['lines']:
-            for points in self.lines:
-                cv.polylines(display_image,[np.array(points[-1])],False,
-                             points[1], points[0])
-
-
-        # If we started drawing a line, capture this image to avoid redraw
-        if ((self.first_point is not None or self.cur_point is not None) and 
-            self.last_img is None):
-            self.last_img = display_image.copy()
+            self.last_img = None
 
         # Pass the image back to the container
-        self.callback(display_image, self.first_draw)
+        first_draw = self.first_draw
+        self.first_draw = False
+        self.callback(display_image, first_draw, tiles=tiles,
+                      scale=2 ** self.detail_level())
 
-    def get_totals(self, count_selections=False, only_complete=False, 
-                   include_counters=True):
+    def changed_tiles(self):
+        """
+        Returns the boxes (x0, y0, x1, y1) of the tiles of the frame that
+        changed since it was last displayed, see TiledImageItem.tiles
+        """
+        tiles = sorted(self.frame_tiles)
+        self.frame_tiles = set()
+        return tiles
+
+    def line_preview(self):
+        """
+        Returns the preview of the draw and cut tools, see show_preview
+        """
+        level = self.detail_level()
+        line = None
+        if self.display_options['lines'] and self.second_point:
+            line = np.array((self.first_point, self.second_point)) >> level
+        drawn = None
+        if self.drawn_contour:
+            drawn = np.array(self.drawn_contour) >> level
+        thickness = self.scaled_size(self.line_thickness, level)
+
+        def draw(image, offset):
+            if line is not None:
+                start, end = line - offset
+                cv.line(image, tuple(start), tuple(end), Colors.GREEN.value,
+                        thickness)
+            if drawn is not None:
+                cv.polylines(image, [drawn - offset], False,
+                             Colors.GREEN.value, 1)
+
+        bounds = []
+        if line is not None:
+            bounds.append(self.preview_bounds(line, thickness))
+        if drawn is not None:
+            bounds.append(self.preview_bounds(drawn.reshape(-1, 2), 1))
+        return bounds, draw
+
+    def point_preview(self):
+        """
+        Returns the preview of the counter and eraser tools, see
+        show_preview
+        """
+        level = self.detail_level()
+        point = np.array(self.cur_point) >> level
+        border = self.scaled_size(2, level)
+        if self.mode == ToolMode.COUNT:
+            color = analysis.counter_color(self.cur_group)
+            radius = self.scaled_size(3, level)
+            def draw(image, offset):
+                center = tuple(point - offset)
+                cv.circle(image, center, radius, color, -1)
+                cv.circle(image, center, radius, Colors.BLACK.value, border)
+            return [self.preview_bounds([point], radius + border)], draw
+        elif self.mode == ToolMode.ERASE:
+            radius = self.scaled_size(self.eraser_size, level)
+            def draw(image, offset):
+                cv.circle(image, tuple(point - offset), radius,
+                          Colors.BLACK.value, border)
+            return [self.preview_bounds([point], radius + border)], draw
+        return [], None
+
+    @staticmethod
+    def preview_bounds(points, padding):
+        """
+        Returns the bounding box (x0, y0, x1, y1) of points, grown by
+        padding on every side
+        """
+        points = np.asarray(points)
+        x0, y0 = points.min(axis=0) - padding
+        x1, y1 = points.max(axis=0) + padding + 1
+        return x0, y0, x1, y1
+
+    def show_preview(self, bounds, draw):
         """
-        Helper function for export, counts up the selections and counters
+        Displays a tool preview over the last frame. With a region_callback,
+        only the region the preview is drawn in is passed on, the rest of
+        the frame is already on display.
 
         Arguments:
-            count_selections (bool): count feature selections or not
-            only_complete (bool): only count complete selections
-            include_counters (bool): count group counters as well
-
-        Returns a string for csv
-        """
-        first_line, second_line = '', ''
-
-        if count_selections:
-            num_complete = len(self.contour_pairs) // 3
-            if num_complete > 0:
-                first_line += 'Complete,'
-                second_line += '{},'.format(num_complete)
-            num_incomplete = len(self.contour_pairless)
-            if not only_complete and num_incomplete > 0:
-                first_line += 'Incomplete,'
-                second_line += '{},'.format(num_incomplete)
-
-        if include_counters:
-            counter_totals = {}
-            for _, group in self.counters:
-                cur_total = counter_totals.get(group, 0)
-                counter_totals[group] = cur_total + 1
-            for group in counter_totals:
-                first_line += group + ','
-                second_line += '{},'.format(counter_totals[group])
-            total = (counter_totals.get('Myelinated Axons', 0) 
-                     + counter_totals.get('Unmyelinated Axons', 0))
-            if total == 0:
-                total = 1
-            dec_myelin = counter_totals.get('Myelinated Axons', 0) / total
-            percent_myelinated = round(dec_myelin * 100, 2)
-            first_line += 'Percent Myelinated'
-            second_line += '{}%'.format(percent_myelinated)
-
-        return first_line + '\n' + second_line
+            bounds (list): the boxes (x0, y0, x1, y1) the preview is drawn in
+            draw (function): draws the preview into an image, given the
+                             image and the (x, y) position of the image in
+                             the frame
+        """
+        # The boxes always contain the whole preview, unless they're cut by
+        # the edges of the frame, so it's drawn the same as on the frame
+        height, width = self.last_img.shape[:2]
+        if bounds:
+            x0 = max(min(box[0] for box in bounds), 0)
+            y0 = max(min(box[1] for box in bounds), 0)
+            x1 = min(max(box[2] for box in bounds), width)
+            y1 = min(max(box[3] for box in bounds), height)
+        if not bounds or x0 >= x1 or y0 >= y1:
+            box = None
+        else:
+            box = (x0, y0, x1, y1)
 
+        if self.region_callback is None:
+            display_image = self.last_img.copy()
+            if draw:
+                draw(display_image, (0, 0))
+            # The tiles of the last preview are restored, and the ones of
+            # this preview are once the frame is displayed again
+            preview_tiles = set() if box is None else \
+                set(TiledImageItem.tiles(self.last_img.shape, box))
+            tiles = sorted(self.frame_tiles | preview_tiles)
+            self.frame_tiles = preview_tiles
+            self.callback(display_image, self.first_draw, tiles=tiles,
+                          scale=2 ** self.detail_level())
+            return
 
-    def export(self, directory, export_selections):
-        """Export data specified in export_selections to directory as csv"""
-        file_path = directory + '/'
+        if not self.last_img_shown:
+            self.callback(self.last_img, self.first_draw,
+                          tiles=self.changed_tiles(),
+                          scale=2 ** self.detail_level())
+            self.last_img_shown = True
 
-        file_name = self.filename.split('/')[-1]
-        new_filename = (file_path + '.'.join(file_name.split('.')[:-1]) 
-                        + '-overlay.' + file_name.split('.')[-1])
-
-        overlay = self.image_copy.copy()
-
-        text_to_add = []
-
-        adjusted_calibration = self.calibration / self.quality
-
-        text_filename = (file_path + '.'.join(file_name.split('.')[:-1])
-                         + '-area_calculations.csv')
-        with open(text_filename, 'w') as f:
-            to_write = 'Number,'
-            if export_selections['Axon Area']:
-                to_write += 'Axon Area,'
-            if export_selections['Inner Myelin Area']:
-                to_write += 'Inner Area,'
-            if export_selections['Outer Myelin Area']:
-                to_write += 'Outer Area,'
-            if export_selections['Axon Perimeter']:
-                to_write += 'Axon Perimeter,'
-            if export_selections['Inner Myelin Perimeter']:
-                to_write += 'Inner Perimeter,'
-            if export_selections['Outer Myelin Perimeter']:
-                to_write += 'Outer Perimeter,'
-            if export_selections['Axon Diameter']:
-                to_write += 'Axon Diameter,'
-            if export_selections['Inner Myelin Diameter']:
-                to_write += 'Inner Diameter,'
-            if export_selections['Outer Myelin Diameter']:
-                to_write += 'Outer Diameter,'
-            if export_selections['g-ratio']:
-                to_write += 'g-ratio,'
-            to_write += '\n'
-            f.write(to_write)
-
-            cur_index = 0
-            for i in range(0,len(self.contour_pairs),self.NUM_FEATURES):
-                sub_to_write = ''
-                axon_a = (cv.contourArea(self.scale_contour(
-                                            self.contour_pairs[i+2], 
-                                            self.correction_scaling))
-                          * adjusted_calibration ** 2)
-                if export_selections['Axon Area']:
-                    sub_to_write += (str(axon_a) + ',') 
-                inner_a = (cv.contourArea(self.scale_contour(
-                                            self.contour_pairs[i+1], 
-                                            self.correction_scaling)) 
-                           * adjusted_calibration ** 2)
-                if export_selections['Inner Myelin Area']:
-                    sub_to_write += (str(inner_a) + ',') 
-                outer_a = (cv.contourArea(self.scale_contour(
-                                            self.contour_pairs[i], 
-                                            self.correction_scaling)) 
-                           * adjusted_calibration ** 2)
-                if export_selections['Outer Myelin Area']:
-                    sub_to_write += (str(outer_a) + ',') 
-
-                axon_p = (cv.arcLength(self.scale_contour(
-                                        self.contour_pairs[i+2], 
-                                        self.correction_scaling), True) 
-                          * adjusted_calibration)
-                if export_selections['Axon Perimeter']:
-                    sub_to_write += (str(axon_p) + ',')
-                inner_p = (cv.arcLength(self.scale_contour(
-                                        self.contour_pairs[i+1], 
-                                        self.correction_scaling), True) 
-                          * adjusted_calibration)
-                if export_selections['Inner Myelin Perimeter']:
-                    sub_to_write += (str(inner_p) + ',')
-                outer_p = (cv.arcLength(self.scale_contour(
-                                        self.contour_pairs[i], 
-                                        self.correction_scaling), True) 
-                          * adjusted_calibration)
-                if export_selections['Outer Myelin Perimeter']:
-                    sub_to_write += (str(outer_p) + ',')
-
-                axon_d = sqrt(axon_a/pi)*2
-                if export_selections['Axon Diameter']:
-                    sub_to_write += (str(axon_d) + ',')
-                inner_d = sqrt(inner_a/pi)*2
-                if export_selections['Inner Myelin Diameter']:
-                    sub_to_write += (str(inner_d) + ',')
-                outer_d = sqrt(outer_a/pi)*2
-                if export_selections['Outer Myelin Diameter']:
-                    sub_to_write += (str(outer_d) + ',')
-
-                gratio = np.sqrt(inner_a / outer_a)
-                if export_selections['g-ratio']:
-                    sub_to_write += (str(gratio) + ',')
-                if sub_to_write:
-                    cur_index = i//self.NUM_FEATURES+1
-                    to_write = str(cur_index) + ',' + sub_to_write + '\n'
-                    f.write(to_write)
-
-                if sub_to_write:
-                    cv.drawContours(overlay, self.contour_pairs[i:i+3], -1, 
-                                    Colors.CYAN_HIGHLIGHT.value, cv.FILLED)
-                    cv.drawContours(overlay, self.contour_pairs[i:i+3], -1, 
-                                    Colors.BLACK.value, 1)
-
-                    c = self.contour_pairs[i]
-                    M = cv.moments(c)
-                    cX = int(M["m10"] / M["m00"])
-                    cY = int(M["m01"] / M["m00"])
-                    text_to_add.append((str(cur_index), (cX - int(self.font_size * 8), cY + int(self.font_size * 4))))
-
-            mode_string = self.mode_to_string(ToolMode.SEL_AXON)
-            for axon in self.contour_pairless_grouped[mode_string]:
-                sub_to_write = ''
-
-                a = (cv.contourArea(self.scale_contour(
-                                        axon, self.correction_scaling)) 
-                     * adjusted_calibration ** 2)
-                if export_selections['Axon Area']:
-                    sub_to_write += (str(a) + ',')
-
-                if export_selections['Inner Myelin Area']:
-                    sub_to_write += ','
-
-                if export_selections['Outer Myelin Area']:
-                    sub_to_write += ','
-
-                p = (cv.arcLength(self.scale_contour(
-                                      axon, self.correction_scaling), True) 
-                     * adjusted_calibration)
-                if export_selections['Axon Perimeter']:
-                    sub_to_write += (str(p) + ',')
-
-                if export_selections['Inner Myelin Perimeter']:
-                    sub_to_write += ','
-
-                if export_selections['Outer Myelin Perimeter']:
-                    sub_to_write += ','
-
-                d = sqrt(a/pi)*2
-                if export_selections['Axon Diameter']:
-                    sub_to_write += (str(d) + ',')
-
-                if export_selections['Inner Myelin Diameter']:
-                    sub_to_write += ','
-
-                if export_selections['Outer Myelin Diameter']:
-                    sub_to_write += ','
-
-                if len(sub_to_write) != sub_to_write.count(','):
-                    cur_index += 1
-                    to_write = str(cur_index) + ',' + sub_to_write + '\n'
-                    f.write(to_write)
-
-                if len(sub_to_write) != sub_to_write.count(','):
-                    cv.drawContours(overlay, [axon], -1, 
-                                    Colors.ORANGE_HIGHLIGHT.value, 
-                                    cv.FILLED)
-                    cv.drawContours(overlay, [axon], -1, 
-                                    Colors.BLACK.value, 1)
-
-                    c = axon
-                    M = cv.moments(c)
-                    cX = int(M["m10"] / M["m00"])
-                    cY = int(M["m01"] / M["m00"])
-                    text_to_add.append((str(cur_index), (cX - int(self.font_size * 8), cY + int(self.font_size * 4))))
-
-            mode_string = self.mode_to_string(ToolMode.SEL_MYELIN_IN)
-            for inner in self.contour_pairless_grouped[mode_string]:
-                to_write = str(cur_index) + ','
-
-                sub_to_write = ''
-
-                if export_selections['Axon Area']:
-                    sub_to_write += ',' 
-
-                a = (cv.contourArea(self.scale_contour(
-                                        inner, self.correction_scaling)) 
-                     * adjusted_calibration ** 2)
-                if export_selections['Inner Myelin Area']:
-                    sub_to_write += (str(a) + ',') 
-
-                if export_selections['Outer Myelin Area']:
-                    sub_to_write += ',' 
-
-                if export_selections['Axon Perimeter']:
-                    sub_to_write += ',' 
-
-                p = (cv.arcLength(self.scale_contour(
-                                      inner, self.correction_scaling), True) 
-                     * adjusted_calibration)
-                if export_selections['Inner Myelin Perimeter']:
-                    sub_to_write += (str(p) + ',') 
-
-                if export_selections['Outer Myelin Perimeter']:
-                    sub_to_write += ',' 
-
-                if export_selections['Axon Diameter']:
-                    sub_to_write += ',' 
-
-                d = sqrt(a/pi)*2
-                if export_selections['Inner Myelin Diameter']:
-                    sub_to_write += (str(d) + ',')
-
-                if export_selections['Outer Myelin Diameter']:
-                    sub_to_write += ','
-
-                if len(sub_to_write) != sub_to_write.count(','):
-                    cur_index += 1
-                    to_write = str(cur_index) + ',' + sub_to_write + '\n'
-                    f.write(to_write)
-
-                if len(sub_to_write) != sub_to_write.count(','):
-                    cv.drawContours(overlay, [inner], -1, 
-                                    Colors.ORANGE_HIGHLIGHT.value, 
-                                    cv.FILLED)
-                    cv.drawContours(overlay, [inner], -1, 
-                                    Colors.BLACK.value, 1)
-
-                    c = inner
-                    M = cv.moments(c)
-                    cX = int(M["m10"] / M["m00"])
-                    cY = int(M["m01"] / M["m00"])
-                    text_to_add.append((str(cur_index), (cX - int(self.font_size * 8), cY + int(self.font_size * 4))))
-
-            mode_string = self.mode_to_string(ToolMode.SEL_MYELIN_OUT)
-            for outer in self.contour_pairless_grouped[mode_string]:
-                to_write = str(cur_index) + ','
-
-                sub_to_write = ''
-
-                if export_selections['Axon Area']:
-                    sub_to_write += ','
-
-                if export_selections['Inner Myelin Area']:
-                    sub_to_write += ','
-
-                a = (cv.contourArea(self.scale_contour(
-                                        outer, self.correction_scaling)) 
-                     * adjusted_calibration ** 2)
-                if export_selections['Outer Myelin Area']:
-                    sub_to_write += (str(a) + ',')
-
-                if export_selections['Axon Perimeter']:
-                    sub_to_write += ','
-
-                if export_selections['Inner Myelin Perimeter']:
-                    sub_to_write += ','
-
-                p = (cv.arcLength(self.scale_contour(
-                                      outer, self.correction_scaling), True) 
-                     * adjusted_calibration)
-                if export_selections['Outer Myelin Perimeter']:
-                    sub_to_write += (str(p) + ',')
-
-                if export_selections['Axon Diameter']:
-                    sub_to_write += ','
-
-                if export_selections['Inner Myelin Diameter']:
-                    sub_to_write += ','
-
-                d = sqrt(a/pi)*2
-                if export_selections['Outer Myelin Diameter']:
-                    sub_to_write += (str(d) + ',')
-
-                if len(sub_to_write) != sub_to_write.count(','):
-                    cur_index += 1
-                    to_write = str(cur_index) + ',' + sub_to_write + '\n'
-                    f.write(to_write)
-
-                if len(sub_to_write) != sub_to_write.count(','):
-                    cv.drawContours(overlay, [outer], -1, 
-                                    Colors.ORANGE_HIGHLIGHT.value,
-                                    cv.FILLED)
-                    cv.drawContours(overlay, [outer], -1,
-                                    Colors.BLACK.value, 1)
-
-                    c = outer
-                    M = cv.moments(c)
-                    cX = int(M["m10"] / M["m00"])
-                    cY = int(M["m01"] / M["m00"])
-                    text_to_add.append((str(cur_index), (cX - int(self.font_size * 8), cY + int(self.font_size * 4))))
-
-            if (export_selections['Misc. Perimeter']
-                    or export_selections['Misc. Area'] 
-                    or export_selections['Misc. Diameter']):
-                f.write('\nMiscellaneous\n')
-                to_write = 'Number,'
-                if export_selections['Misc. Area']:
-                    to_write += 'Misc. Area,'
-                if export_selections['Misc. Perimeter']:
-                    to_write += 'Misc. Perimeter,'
-                if export_selections['Misc. Diameter']:
-                    to_write += 'Misc. Diameter,'
-                to_write += '\n'
-                f.write(to_write)
-
-                mode_string = self.mode_to_string(ToolMode.SEL_MISC)
-                for misc in self.saved_contours[mode_string]:
-                    to_write = str(cur_index) + ','
-
-                    sub_to_write = ''
-
-                    a = (cv.contourArea(self.scale_contour(
-                                            misc, self.correction_scaling)) 
-                         * adjusted_calibration ** 2)
-                    if export_selections['Misc. Area']:
-                        sub_to_write += (str(a) + ',')
-
-                    p = (cv.arcLength(self.scale_contour(
-                                          misc, self.correction_scaling), True) 
-                         * adjusted_calibration)
-                    if export_selections['Misc. Perimeter']:
-                        sub_to_write += (str(p) + ',')
-
-                    d = sqrt(a/pi)*2
-                    if export_selections['Misc. Diameter']:
-                        sub_to_write += (str(d) + ',')
-
-                    if len(sub_to_write) != sub_to_write.count(','):
-                        cur_index += 1
-                        to_write = str(cur_index) + ',' + sub_to_write + '\n'
-                        f.write(to_write)
-
-                    if len(sub_to_write) != sub_to_write.count(','):
-                        cv.drawContours(overlay, [misc], -1, 
-                                        Colors.CYAN_HIGHLIGHT.value,
-                                        cv.FILLED)
-                        cv.drawContours(overlay, [misc], -1,
-                                        Colors.BLACK.value, 1)
-
-                        c = misc
-                        M = cv.moments(c)
-                        cX = int(M["m10"] / M["m00"])
-                        cY = int(M["m01"] / M["m00"])
-                        text_to_add.append((str(cur_index), (cX - int(self.font_size * 8), cY + int(self.font_size * 4))))
-
-            totals = self.get_totals()
-            f.write('\n')
-            f.write(totals)
-        
-        export_image = cv.addWeighted(overlay, self.alpha, self.image_copy, 
-                                      1-self.alpha, 0)
-        for t in text_to_add:
-            cv.putText(export_image, t[0], t[1], cv.FONT_HERSHEY_SIMPLEX, self.font_size, 
-                       Colors.WHITE.value, int(2*self.font_size))
-
-        if export_selections['Counters']:
-            for point, group in self.counters:
-                if group == 'Unmyelinated Axons':
-                    color = Colors.PURPLE.value
-                elif group == 'Myelinated Axons':
-                    color = Colors.LIME.value
-                else:
-                    color = Colors.PINK.value
-                export_image = cv.circle(export_image, point, 3, color, -1)
-                export_image = cv.circle(export_image, point, 3, 
-                                         Colors.BLACK.value, 2)
-                cv.putText(export_image, group[0], (point[0] + 4, point[1] - 4),
-                           cv.FONT_HERSHEY_SIMPLEX, self.font_size, color, 
-                           int(2*self.font_size))
-
-        is_success, im_buf_arr = cv.imencode(os.path.splitext(new_filename)[-1], export_image)
-        im_buf_arr.tofile(new_filename)
-        
+        if box is None:
+            self.region_callback(None, 0, 0)
+            return
+        region = self.last_img[y0:y1, x0:x1].copy()
+        draw(region, (x0, y0))
+        self.region_callback(region, x0, y0)
 
-    def scale_contour(self, contour, scaling):
+    def compose_frame(self):
         """
-        Scales contour to given scaling
+        Composites the frame from the render layers, redrawing only the
+        layers whose contents changed.
+
+        The overlay is the base image with the outlines and fills pasted
+        over it, blended with the base by alpha. The counters, numbers and
+        lines are pasted over that, and the hovered highlights are blended
+        in only around themselves.
+
+        Zoomed out, the frame is drawn at a fraction of the image's
+        resolution, see frame_shape, and everything is drawn at that scale.
+        """
+        options = self.display_options
+        level = self.detail_level()
+        shape = self.frame_shape()
+        layers = self.layers
+
+        # Base image, or the threshold preview
+        if options['threshold']:
+            base_key = ('threshold', self.blur, self.threshold, level)
+        else:
+            base_key = ('image', level)
+        if base_key != self.base_key:
+            if options['threshold']:
+                thresholded = self.preprocess.thresholded(self.blur,
+                                                          self.threshold)
+                base_image = cv.cvtColor(thresholded, cv.COLOR_GRAY2BGR)
+            else:
+                base_image = self.image_copy
+            if level:
+                base_image = cv.resize(base_image, shape[1::-1],
+                                       interpolation=cv.INTER_AREA)
+            self.base_image = base_image
+            self.base_key = base_key
+
+        # Outlines and fills, blended with the base. The pairing is redone
+        # whenever the selections change, so it identifies them. Zoomed out,
+        # the outlines are simplified to about the size of a screen pixel
+        thickness = self.scaled_size(self.outline_thickness, level)
+        overlay_layers = []
+        if options['outlines']:
+            cur_contours = self.cur_contours
+            overlay_layers.append(layers['candidates'].update(
+                shape, (id(cur_contours), self.outline_thickness, level),
+                (cur_contours,),
+                lambda canvas: cv.drawContours(
+                    canvas, self.outline_contours(cur_contours, level), -1,
+                    Layer.color(Colors.YELLOW.value), thickness)))
+            saved_contours = list(self.saved_contours.values())
+            def draw_outlines(canvas):
+                for c in saved_contours:
+                    cv.drawContours(canvas, self.outline_contours(c, level),
+                                    -1, Layer.color(Colors.BLACK.value),
+                                    thickness)
+            overlay_layers.append(layers['outlines'].update(
+                shape, (id(self.pairing), self.outline_thickness, level),
+                (self.pairing,), draw_outlines))
+        if options['highlights']:
+            pairs = self.scaled_contours(self.contour_pairs, level)
+            pairless = self.scaled_contours(self.contour_pairless, level)
+            misc = self.scaled_contours(self.saved_contours[
+                self.mode_to_string(ToolMode.SEL_MISC)], level)
+            def draw_fills(canvas):
+                cv.drawContours(canvas, pairs, -1,
+                                Layer.color(Colors.CYAN_HIGHLIGHT.value),
+                                cv.FILLED)
+                cv.drawContours(canvas, pairless, -1,
+                                Layer.color(Colors.ORANGE_HIGHLIGHT.value),
+                                cv.FILLED)
+                cv.drawContours(canvas, misc, -1,
+                                Layer.color(Colors.CYAN_HIGHLIGHT.value),
+                                cv.FILLED)
+            overlay_layers.append(layers['fills'].update(
+                shape, (id(self.pairing), level), (self.pairing,),
+                draw_fills))
+        blend_key = (base_key, self.alpha,
+                     tuple((id(layer), layer.version)
+                           for layer in overlay_layers))
+
+        # Counters, numbers and lines, drawn over the blend. Numbers too
+        # small to read at the zoom are left out
+        annotation_layers = []
+        if options['counters']:
+            readable = self.labels_readable()
+            annotation_layers.append(self.counters_layer(shape, readable,
+                                                         level))
+            pairs = self.contour_pairs
+            def draw_labels(canvas):
+                if readable:
+                    self.draw_labels(canvas, pairs, level)
+            annotation_layers.append(layers['labels'].update(
+                shape, (id(pairs), self.font_size, readable, level), (pairs,),
+                draw_labels))
+        if options['lines']:
+            annotation_layers.append(self.lines_layer(shape, level))
+        composed_key = (blend_key, tuple((id(layer), layer.version)
+                                         for layer in annotation_layers))
+
+        # Hovered highlights, blended in their bounding box only
+        box = None
+        if options['highlights'] and self.highlight_contours:
+            boxes = [analysis.contour_bounds(c)
+                     for c, _color in self.highlight_contours]
+            x0 = max(min(box[0] for box in boxes) >> level, 0)
+            y0 = max(min(box[1] for box in boxes) >> level, 0)
+            x1 = min((max(box[2] for box in boxes) >> level) + 1, shape[1])
+            y1 = min((max(box[3] for box in boxes) >> level) + 1, shape[0])
+            if x0 < x1 and y0 < y1:
+                box = (x0, y0, x1, y1)
+
+        # Only the tiles in view (and under the highlights) are composited,
+        # the others are when they come into view. The frame is composited
+        # in place, and the tiles changed are kept in frame_tiles until it's
+        # displayed
+        if blend_key != self.blend[0]:
+            self.blend = (blend_key, np.empty_like(self.base_image),
+                          np.empty_like(self.base_image),
+                          set(TiledImageItem.tiles(shape)))
+        _key, overlay_image, blended_image, blend_stale = self.blend
+        if self.frame is None or self.frame.shape != shape:
+            self.frame = np.zeros_like(self.base_image)
+        frame = self.frame
+        if composed_key != self.composed[0]:
+            self.composed = (composed_key, set(TiledImageItem.tiles(shape)))
+            self.hovered = None
+        _key, composed_stale = self.composed
+        tiles = [tile for tile in TiledImageItem.tiles(
+                     shape, self.view_region(box))
+                 if tile in composed_stale]
+        # in one go if they make up a box, as they usually do
+        boxes = tiles
+        if tiles:
+            bounds = (min(t[0] for t in tiles), min(t[1] for t in tiles),
+                      max(t[2] for t in tiles), max(t[3] for t in tiles))
+            if len(TiledImageItem.tiles(shape, bounds)) == len(tiles):
+                boxes = [bounds]
+        # and the last hovered highlights are composited over
+        if self.hovered is not None:
+            boxes = [self.hovered] + boxes
+            self.hovered = None
+        for bx0, by0, bx1, by1 in boxes:
+            region = (slice(by0, by1), slice(bx0, bx1))
+            box_tiles = TiledImageItem.tiles(shape, (bx0, by0, bx1, by1))
+            if any(tile in blend_stale for tile in box_tiles):
+                overlay_image[region] = self.base_image[region]
+                for layer in overlay_layers:
+                    layer.paste(overlay_image[region], region)
+                cv.addWeighted(overlay_image[region], self.alpha,
+                               self.base_image[region], 1-self.alpha, 0,
+                               dst=blended_image[region])
+                blend_stale.difference_update(box_tiles)
+            frame[region] = blended_image[region]
+            for layer in annotation_layers:
+                layer.paste(frame[region], region)
+            composed_stale.difference_update(box_tiles)
+            self.frame_tiles.update(box_tiles)
+
+        if box is not None:
+            x0, y0, x1, y1 = box
+            region = (slice(y0, y1), slice(x0, x1))
+            overlay_region = overlay_image[region].copy()
+            for c, color in self.highlight_contours:
+                cv.drawContours(overlay_region, (c >> level,), -1, color,
+                                cv.FILLED, offset=(-x0, -y0))
+            cv.addWeighted(overlay_region, self.alpha,
+                           self.base_image[region], 1-self.alpha, 0,
+                           dst=frame[region])
+            for layer in annotation_layers:
+                layer.paste(frame[region], region)
+            self.hovered = box
+            self.frame_tiles.update(TiledImageItem.tiles(shape, box))
+        return frame
+
+    def view_region(self, box=None):
+        """
+        Returns the box (x0, y0, x1, y1) of the frame around the viewport and
+        box, or None if the whole image is in view
+        """
+        if self.viewport is None:
+            return None
+        viewport = self.scaled_box(self.viewport, self.detail_level())
+        boxes = [viewport] if box is None else [viewport, box]
+        return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+                max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+    def set_viewport(self, viewport, zoom):
+        """
+        Sets the part of the image in view and the scale it's viewed at.
+        Redraws if tiles that weren't composited come into view, or the
+        level of detail changes.
 
         Arguments:
-            contour (np.array): contour to scale
-            scaling (float): scaling percent as decimal
-        """
-        M = cv.moments(contour)
-        cx = int(M['m10']/M['m00'])
-        cy = int(M['m01']/M['m00'])
-
-        normalized = contour - [cx, cy]
-        scaled = contour * scaling
-        return scaled.astype(np.int32)
-
-    def get_state(self):
-        """
-        Returns the current state as the current contours, lines, and counters
-        as dictionary. For use with undo/redo.
-        """
-        cur_state = {}
-        cur_state['contours'] = {}
-        for group in self.saved_contours:
-            cur_state['contours'][group] = self.saved_contours[group].copy()
-        cur_state['lines'] = self.lines.copy()
-        cur_state['counters'] = self.counters.copy()
-        return cur_state
-
-    def load_state(self, state):
-        """Loads in contours, lines and counters from state (dict)."""
-        self.saved_contours = state['contours']
-        self.lines = state['lines']
-        self.counters = state['counters']
+            viewport (tuple): the box (x0, y0, x1, y1) in view
+            zoom (float): screen pixels per image pixel
+        """
+        detail = (self.detail_level(), self.labels_readable())
+        self.viewport = viewport
+        self.zoom = zoom
+        stale = self.composed[1]
+        if (detail != (self.detail_level(), self.labels_readable()) or
+            (stale and any(tile in stale for tile in TiledImageItem.tiles(
+                self.frame_shape(), self.view_region())))):
+            self.invalidate('render')
+            self.show()
+
+    def detail_level(self):
+        """
+        Returns the level of detail to draw the frame at: 0 for all of it,
+        down to 1/2 zoom, then one more for each halving of the zoom, see
+        frame_shape
+        """
+        if self.zoom >= 0.5:
+            return 0
+        return int(np.log2(1 / self.zoom))
+
+    def frame_shape(self):
+        """
+        Returns the shape of the frame: the image's, halved for each level
+        of detail, so the frame is drawn at up to twice the resolution it's
+        viewed at. The frame's pixel (x, y) covers the square of 2 ** level
+        image pixels across from (x << level, y << level).
+        """
+        height, width = self.image_copy.shape[:2]
+        scale = 2 ** self.detail_level()
+        return (-(-height // scale), -(-width // scale), 3)
+
+    @staticmethod
+    def scaled_box(box, level):
+        """
+        Returns the box (x0, y0, x1, y1) of the image, in the frame drawn at
+        detail_level level
+        """
+        if level == 0:
+            return box
+        x0, y0, x1, y1 = box
+        scale = 2 ** level
+        return (x0 // scale, y0 // scale, -(-x1 // scale), -(-y1 // scale))
+
+    @staticmethod
+    def scaled_contours(contours, level):
+        """Returns contours in the frame drawn at detail_level level"""
+        if level == 0:
+            return list(contours)
+        return [c >> level for c in contours]
+
+    @staticmethod
+    def scaled_size(size, level):
+        """
+        Returns a thickness or radius in the frame drawn at detail_level
+        level, at least a pixel
+        """
+        if level == 0:
+            return size
+        return max(size >> level, 1)
+
+    def labels_readable(self):
+        """Returns whether numbers and counter initials are big enough to read"""
+        (_width, height), _baseline = cv.getTextSize(
+            '0', cv.FONT_HERSHEY_SIMPLEX, self.font_size,
+            int(2*self.font_size))
+        return height * self.zoom >= self.MIN_LABEL_HEIGHT
+
+    @staticmethod
+    def outline_contours(contours, level):
+        """
+        Returns contours to outline at detail_level level: the ones at
+        least a screen pixel big, simplified to within half a screen pixel,
+        in the frame drawn at that level
+        """
+        if level == 0:
+            return contours
+        screen_pixel = 2 ** level
+        epsilon = screen_pixel / 2
+        outlines = []
+        for c in contours:
+            x0, y0, x1, y1 = analysis.contour_bounds(c)
+            if max(x1 - x0, y1 - y0) >= screen_pixel:
+                outlines.append(cv.approxPolyDP(c, epsilon, True) >> level)
+        return outlines
+
+    def counters_layer(self, shape, initials=True, level=0):
+        """
+        Returns the layer of counters, only drawing the new ones if counters
+        were added since it was last drawn
+        """
+        counters = self.counters
+        layer = self.layers['counters']
+        key = (id(counters), counters.revision, len(counters), self.font_size,
+               initials, level)
+        drawn = layer.key
+        if (drawn is not None and drawn[:2] == key[:2] and
+            drawn[3:] == key[3:] and drawn[2] < key[2]):
+            return layer.extend(key, lambda canvas: self.draw_counters(
+                canvas, counters[drawn[2]:], initials, level))
+        return layer.update(shape, key, (counters,),
+                            lambda canvas: self.draw_counters(canvas, counters,
+                                                              initials, level))
+
+    def lines_layer(self, shape, level=0):
+        """
+        Returns the layer of lines, only drawing the new ones and the last
+        one if lines were added or extended since it was last drawn
+        """
+        lines = self.lines
+        layer = self.layers['lines']
+        key = (id(lines), lines.revision, level, len(lines), lines.size)
+        drawn = layer.key
+        if (drawn is not None and drawn[:3] == key[:3] and drawn[3] > 0 and
+            drawn[3:] < key[3:]):
+            # the last line drawn may have grown, redraw it over itself
+            return layer.extend(key, lambda canvas: self.draw_lines(
+                canvas, lines[drawn[3]-1:], level))
+        return layer.update(shape, key, (lines,),
+                            lambda canvas: self.draw_lines(canvas, lines,
+                                                           level))
+
+    def draw_counters(self, canvas, counters, initials=True, level=0):
+        """
+        Draws counters (list of ((x, y), group)) and their group initials
+        onto canvas, drawn at detail_level level
+        """
+        radius = self.scaled_size(3, level)
+        border = self.scaled_size(2, level)
+        font_size = self.font_size / 2 ** level
+        for (x, y), group in counters:
+            point = (x >> level, y >> level)
+            color = Layer.color(analysis.counter_color(group))
+            cv.circle(canvas, point, radius, color, -1)
+            cv.circle(canvas, point, radius,
+                      Layer.color(Colors.BLACK.value), border)
+            if not initials:
+                continue
+            cv.putText(canvas, group[0], 
+                       (point[0] - int(font_size * 8), point[1] + int(font_size * 4)),
+                       cv.FONT_HERSHEY_SIMPLEX, font_size, color,
+                       max(int(2*font_size), 1))
+
+    def draw_labels(self, canvas, pairs, level=0):
+        """
+        Draws the number of each complete unit in pairs onto canvas, drawn
+        at detail_level level
+        """
+        font_size = self.font_size / 2 ** level
+        for i in range(0,len(pairs),self.NUM_FEATURES):
+            cX, cY = analysis.centroid(pairs[i])
+            cX, cY = cX >> level, cY >> level
+            cv.putText(canvas, str(i//self.NUM_FEATURES+1), (cX - int(font_size * 8), cY + int(font_size * 4)),
+                       cv.FONT_HERSHEY_SIMPLEX, font_size, Layer.color(Colors.WHITE.value),
+                       max(int(2*font_size), 1))
+
+    def draw_lines(self, canvas, lines, level=0):
+        """
+        Draws the cut and draw lines (list of (thickness, color, points))
+        onto canvas, drawn at detail_level level
+        """
+        for thickness, color, points in lines:
+            cv.polylines(canvas, [points >> level], False, Layer.color(color),
+                         self.scaled_size(thickness, level))
+
+    def get_totals(self, count_selections=False, only_complete=False, 
+                   include_counters=True):
+        """Counts up the selections and counters, see analysis.get_totals"""
+        return analysis.get_totals(self.pairing, self.counters,
+                                   count_selections, only_complete,
+                                   include_counters)
+
+    def export(self, directory, export_selections):
+        """Export data specified in export_selections to directory as csv"""
+        settings = {
+            'calibration': self.calibration,
+            'quality': self.quality,
+            'correction_scaling': self.correction_scaling,
+            'alpha': self.alpha,
+            'font_size': self.font_size
+        }
+        table = self.selection_table()
+        analysis.export(directory, self.filename, self.image_copy,
+                        self.pairing,
+                        self.saved_contours[analysis.MISC], self.counters,
+                        export_selections, settings, table)
+
+    def sync_indices(self):
+        """Brings the spatial indices up to date after the lists are replaced"""
+        for group, contours in self.saved_contours.items():
+            if group not in self.selection_index:
+                self.selection_index[group] = analysis.GridIndex(
+                    analysis.contour_bounds)
+            self.selection_index[group].sync(contours)
         
+    def settings(self, base_info):
+        """
+        Returns the settings of the session, everything saved but the
+        selections, lines and counters, starting with base_info (dict)
+        """
+        settings = dict(base_info)
+        settings['version'] = __version__
+        settings['threshold'] = self.threshold
+        settings['blur'] = self.blur
+        settings['min_size'] = self.min_size
+        settings['max_size'] = self.max_size
+        settings['alpha'] = self.alpha
+        settings['calibration'] = self.calibration
+        settings['quality'] = self.quality
+        settings['line_thickness'] = self.line_thickness
+        settings['outline_thickness'] = self.outline_thickness
+        settings['font_size'] = self.font_size
+        settings['eraser_size'] = self.eraser_size
+        settings['filename'] = self.filename
+        return settings
+
+    def state_key(self, base_info):
+        """
+        Returns a key that changes whenever the session to save changes,
+        see settings for base_info (dict). Points added to a freehand line
+        aren't edits, so the number of vertices is part of the key.
+        """
+        return (self.changes, self.lines.size,
+                tuple(sorted(self.settings(base_info).items())))
+
+    def snapshot(self, base_info):
+        """
+        Returns a copy of the session for analysis.write_session, starting
+        with base_info (dict). Only the containers are copied, as contours
+        are never changed in place, so it's cheap enough for the GUI thread
+        and the session can be written on another.
+        """
+        session = self.settings(base_info)
+        session['contours'] = {group: list(contours) for group, contours
+                               in self.saved_contours.items()}
+        session['lines'] = self.lines.copy()
+        session['counters'] = self.counters.copy()
+        return session
+
     def save(self, filename, base_info):
         """
-        Writes all of the current program data to filename (str) as literal
-        dictionary, starting with base_info (dict).
-        """
-        export_data = base_info
-        export_data['version'] = __version__
-        export_data['contours'] = self.saved_contours
-        export_data['threshold'] = self.threshold
-        export_data['blur'] = self.blur
-        export_data['min_size'] = self.min_size
-        export_data['max_size'] = self.max_size
-        export_data['alpha'] = self.alpha
-        export_data['calibration'] = self.calibration
-        export_data['quality'] = self.quality
-        export_data['line_thickness'] = self.line_thickness
-        export_data['outline_thickness'] = self.outline_thickness
-        export_data['font_size'] = self.font_size
-        export_data['eraser_size'] = self.eraser_size
-        export_data['lines'] = self.lines
-        export_data['counters'] = self.counters
-        valid_filename = self.filename.encode('utf-8')
-        export_data['filename'] = valid_filename
-
-        with open(filename, 'w') as f:
-            f.write(str(export_data))
+        Writes all of the current program data to filename (str) as a binary
+        session file (see analysis.write_session), starting with base_info
+        (dict).
+        """
+        key = self.state_key(base_info)
+        analysis.write_session(filename, self.snapshot(base_info))
+        self.saved_key = key
 
     def open(self, import_data):
         if 'contours' in import_data:
-            self.saved_contours = import_data['contours']
-            if 'Axon' in self.saved_contours:
-                mode_string = self.mode_to_string(ToolMode.SEL_AXON)
-                axon = self.saved_contours.pop('Axon')
-                self.saved_contours[mode_string] = axon
-            if 'Myelin_In' in self.saved_contours:
-                mode_string = self.mode_to_string(ToolMode.SEL_MYELIN_IN)
-                inner = self.saved_contours.pop('Myelin_In')
-                self.saved_contours[mode_string] = inner
-            if 'Myelin_Out' in self.saved_contours:
-                mode_string = self.mode_to_string(ToolMode.SEL_MYELIN_OUT)
-                outer = self.saved_contours.pop('Myelin_Out')
-                self.saved_contours[mode_string] = outer
+            self.saved_contours = analysis.normalize_selections(
+                import_data['contours'])
         if 'threshold' in import_data:
             self.threshold = import_data['threshold'] 
         if 'blur' in import_data:
@@ -3147,26 +3867,23 @@ class Axon_Editor:
             self.line_thickness = import_data['line_thickness'] 
         if 'eraser_size' in import_data:
             self.eraser_size = import_data['eraser_size']
-        if 'lines' in import_data:
-            self.lines = import_data['lines']
-        else:
-            self.lines = []
-        if 'counters' in import_data:
-            self.counters = import_data['counters']
-        else:
-            self.counters = []
+        self.lines = analysis.Strokes(import_data.get('lines', []))
+        self.counters = analysis.Counters(import_data.get('counters', []))
+        self.sync_indices()
 
+        # the history doesn't apply to the opened selections
+        self.history.clear()
+        self.changes += 1
         self.check_undo_status()
-        self.force_redraw = True
-        self.redraw_contours = True
+        self.invalidate('contours')
+        self.invalidate('pairs')
         self.show()
         return import_data
 
 if __name__ == "__main__":
     appctxt = ApplicationContext()
 
-    with np.printoptions(threshold=np.inf): # for storing giant strings
-        app = QApplication([])
-        win = MainWindow()
-        exit_code = appctxt.app.exec_()
-        sys.exit(exit_code)
\ No newline at end of file
+    app = QApplication([])
+    win = MainWindow()
+    exit_code = appctxt.app.exec_()
+    sys.exit(exit_code)
\ No newline at end of file
@@ -0,0 +1,149 @@
+"""
+Bulk migration of MyelTracer session files to the binary format.
+
+Versions before the binary format saved sessions as a literal dictionary
+in a text file (<image name>-data.txt). Those are slow to read, so this
+scans folders for them and rewrites each one next to itself as
+<image name>-data.npz on a process pool, without evaluating the files (see
+analysis.parse_legacy_session). The selection groups of versions before
+1.0 are renamed on the way.
+
+Example:
+    python migrate.py "D:/microscopy" --report failures.csv
+
+The text files are left as they are. MyelTracer and batch.py read the
+binary session instead of a text one when it's as new.
+"""
+import argparse
+import csv
+import fnmatch
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import analysis
+
+def find_sessions(inputs, pattern):
+    """
+    Expands folders (recursively) and glob patterns into a sorted list of
+    session files
+
+    Arguments:
+        inputs (list): folders, glob patterns or session filenames
+        pattern (str): the pattern the names of session files match
+
+    Returns:
+        sessions (list): the session files found
+    """
+    sessions = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = [os.path.join(root, f)
+                          for root, _dirs, files in os.walk(item)
+                          for f in fnmatch.filter(files, pattern)]
+        else:
+            candidates = glob.glob(item)
+        for candidate in candidates:
+            if os.path.isfile(candidate):
+                sessions.add(os.path.abspath(candidate))
+    return sorted(sessions)
+
+def migrate_session(filename, overwrite):
+    """
+    Rewrites a single session file as a binary one. Executed in a worker
+    process.
+
+    Arguments:
+        filename (str): the session file written as text
+        overwrite (bool): migrate again even if the binary session is as
+                          new as the text one
+
+    Returns:
+        (filename, wall time in seconds, status, error or None), where
+        status is 'migrated', 'skipped' or 'failed'
+    """
+    start = time.perf_counter()
+    migrated = analysis.migrated_filename(filename)
+    try:
+        if (not overwrite and os.path.exists(migrated) and
+            os.path.getmtime(migrated) >= os.path.getmtime(filename)):
+            status = 'skipped'
+        else:
+            analysis.convert_session(filename, migrated)
+            status = 'migrated'
+        error = None
+    except Exception as e:
+        status = 'failed'
+        error = '{}: {}'.format(type(e).__name__, e)
+    return filename, time.perf_counter() - start, status, error
+
+def write_report(filename, failures):
+    """Writes the failures (list of (session file, error)) as a csv file"""
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Session file', 'Error'])
+        writer.writerows(failures)
+
+def parse_args(argv):
+    """Parses the command line arguments"""
+    parser = argparse.ArgumentParser(
+        description='Rewrite old MyelTracer session files in the binary '
+                    'format')
+    parser.add_argument('inputs', nargs='+',
+                        help='folders (searched recursively), session files '
+                             'or glob patterns')
+    parser.add_argument('--pattern', default='*-data*.txt',
+                        help='the names of session files in folders '
+                             '(default: %(default)s)')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='migrate sessions that were migrated already')
+    parser.add_argument('--report', default=None,
+                        help='csv file to list the sessions that failed in')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes')
+    return parser.parse_args(argv)
+
+def run(argv=None):
+    """Command line entry point, returns the process exit code"""
+    args = parse_args(argv)
+    sessions = find_sessions(args.inputs, args.pattern)
+    if not sessions:
+        print('No session files found')
+        return 1
+
+    print('Migrating {} session files on {} workers'.format(len(sessions),
+                                                          args.workers))
+    counts = {'migrated': 0, 'skipped': 0, 'failed': 0}
+    failures = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(migrate_session, filename, args.overwrite)
+                   for filename in sessions]
+        for future in as_completed(futures):
+            filename, elapsed, status, error = future.result()
+            counts[status] += 1
+            if error:
+                failures.append((filename, error))
+                print('FAILED {} ({:.2f} s): {}'.format(filename, elapsed,
+                                                        error))
+            elif status == 'migrated':
+                print('{} ({:.2f} s)'.format(filename, elapsed))
+    total = time.perf_counter() - start
+
+    print('Migrated {} of {} session files in {:.2f} s ({} up to date, {} '
+          'failed)'.format(counts['migrated'], len(sessions), total,
+                           counts['skipped'], counts['failed']))
+    if failures:
+        failures.sort()
+        print('Failed:')
+        for filename, error in failures:
+            print('  {}: {}'.format(filename, error))
+        if args.report:
+            write_report(args.report, failures)
+            print('Failures written to', args.report)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(run())
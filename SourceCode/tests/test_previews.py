@@ -0,0 +1,156 @@
+"""
+Tests that the frames and tool previews the editor puts on display are up to
+date.
+
+Run from the SourceCode directory with: python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                'src', 'main', 'python'))
+cv = pytest.importorskip('cv2')
+pytest.importorskip('PyQt5')
+pytest.importorskip('fbs_runtime')
+from PyQt5.QtCore import Qt
+
+import main
+
+CONFIG = {
+    'threshold': 122,
+    'blur': 3,
+    'min_size': 100,
+    'max_size': 40000,
+    'alpha': 0.4,
+    'calibration': 1.0,
+    'outline_thickness': 1,
+    'font_size': 1,
+    'line_thickness': 2,
+    'eraser_size': 20,
+    'cur_group': 'Myelinated Axons'
+}
+
+class Parent:
+    """Stands in for DisplayImageWidget"""
+    def set_undo_enabled(self, enable):
+        pass
+
+    def set_redo_enabled(self, enable):
+        pass
+
+    def displayMessage(self, message, title):
+        pass
+
+class Screen:
+    """Keeps what the editor puts on display, like PhotoViewer"""
+    def __init__(self):
+        self.frame = None
+        self.preview = None # (region, x, y) shown over the frame
+
+    def show_image(self, image, new_image, tiles=None, scale=1):
+        if self.frame is None or self.frame.shape != image.shape or \
+           tiles is None:
+            self.frame = image.copy()
+        else:
+            for x0, y0, x1, y1 in tiles:
+                self.frame[y0:y1, x0:x1] = image[y0:y1, x0:x1]
+        self.preview = None
+
+    def show_region(self, image, x, y):
+        self.preview = None if image is None else (image.copy(), x, y)
+
+    def displayed(self):
+        displayed = self.frame.copy()
+        if self.preview is not None:
+            region, x, y = self.preview
+            height, width = region.shape[:2]
+            displayed[y:y + height, x:x + width] = region
+        return displayed
+
+@pytest.fixture
+def image_file(tmp_path):
+    image = np.full((300, 600, 3), 200, np.uint8)
+    for x in (80, 200, 320, 440, 560):
+        cv.circle(image, (x, 150), 40, (40, 40, 40), -1)
+    filename = str(tmp_path / 'image.png')
+    cv.imwrite(filename, image)
+    return filename
+
+@pytest.mark.parametrize('zoom', [1.0, 0.25])
+@pytest.mark.parametrize('regions', [False, True])
+def test_line_preview_after_counter_preview(image_file, regions, zoom):
+    screen = Screen()
+    editor = main.Axon_Editor(
+        image_file, 1.0, CONFIG, screen.show_image, Parent(),
+        region_callback=screen.show_region if regions else None)
+    editor.set_viewport((0, 0, 600, 300), zoom)
+
+    def event(kind, x, y, modifiers=Qt.NoModifier):
+        editor.mouse_event(kind, x, y, None, None, modifiers)
+
+    # hover with the counters, then draw a freehand line
+    editor.set_mode(main.ToolMode.COUNT)
+    event(cv.EVENT_MOUSEMOVE, 50, 50)
+    editor.set_mode(main.ToolMode.DRAW)
+    event(cv.EVENT_LBUTTONDOWN, 20, 250)
+    for x in range(20, 380, 4):
+        event(cv.EVENT_MOUSEMOVE, x, 250)
+    event(cv.EVENT_LBUTTONUP, 380, 250)
+    # preview a straight line from the end of it
+    event(cv.EVENT_MOUSEMOVE, 100, 100, Qt.ShiftModifier)
+    event(cv.EVENT_MOUSEMOVE, 150, 100, Qt.ShiftModifier)
+    previewed = screen.displayed()
+
+    # the same preview over a full render
+    _bounds, draw = editor.line_preview()
+    editor.first_point = None
+    editor.invalidate('render')
+    editor.show()
+    expected = screen.displayed()
+    draw(expected, (0, 0))
+
+    assert np.array_equal(previewed, expected)
+
+def test_display_follows_frame(image_file):
+    screen = Screen()
+    editor = main.Axon_Editor(image_file, 1.0, CONFIG, screen.show_image,
+                              Parent())
+
+    def event(kind, x, y):
+        editor.mouse_event(kind, x, y, None, None, Qt.NoModifier)
+
+    def check():
+        assert np.array_equal(screen.frame, editor.frame)
+
+    # select, hovering over the tile edge at x=256, then deselect
+    editor.set_mode(main.ToolMode.SEL_AXON)
+    for x in (80, 200, 320, 440):
+        event(cv.EVENT_MOUSEMOVE, x, 150)
+        check()
+        event(cv.EVENT_LBUTTONDOWN, x, 150)
+        event(cv.EVENT_LBUTTONUP, x, 150)
+        check()
+    editor.set_mode(main.ToolMode.DESELECT)
+    event(cv.EVENT_MOUSEMOVE, 200, 150)
+    check()
+    event(cv.EVENT_MOUSEMOVE, 10, 10)
+    check()
+    # part of the image in view, then all of it
+    editor.set_viewport((300, 0, 600, 300), 1.0)
+    editor.toggle_highlights(False)
+    check()
+    editor.set_viewport((0, 0, 600, 300), 1.0)
+    check()
+    # zoomed out, at a quarter of the resolution
+    editor.set_viewport((0, 0, 600, 300), 0.25)
+    assert editor.frame.shape == (75, 150, 3)
+    check()
+    editor.toggle_highlights(True)
+    editor.set_mode(main.ToolMode.SEL_AXON)
+    event(cv.EVENT_MOUSEMOVE, 560, 150)
+    check()
+    event(cv.EVENT_MOUSEMOVE, 10, 10)
+    check()